@@ -13,6 +13,8 @@
 #
 from django.conf import settings
 
+from djangoplicity.utils.cachekeys import digest
+
 if settings.USE_I18N:
     from django.utils import translation as django_translation
 
@@ -31,9 +33,9 @@ def _gen_cache_key( prefix, model_name, id, *args, **kwargs ):
     """
     if settings.USE_I18N:
         lang = kwargs['lang'] if 'lang' in kwargs else django_translation.get_language()
-        basekey = '%s%s_%s_%s' % ( prefix, lang, hash(model_name), hash(id) )
+        basekey = '%s%s_%s' % ( prefix, lang, digest( model_name, id ) )
     else:
-        basekey = '%s_%s_%s' % ( prefix, hash(model_name), hash(id) )
+        basekey = '%s_%s' % ( prefix, digest( model_name, id ) )
 
     for a in args:
         basekey = '%s_%s' % ( basekey, a )
@@ -19,19 +19,25 @@ from django.core.exceptions import ImproperlyConfigured, ObjectDoesNotExist
 from django.db import connection, models
 from django.db.models.base import ModelBase
 from django.db.models.fields import FieldDoesNotExist, CharField
-from django.db.models.signals import post_save, pre_save, post_delete
+from django.db.models.fields.related import lazy_related_operation
+from django.db.models.signals import m2m_changed, post_save, pre_save, post_delete
 from django.dispatch import Signal
 from django.utils.functional import curry
 from django.utils.timezone import is_naive, make_aware
 from django.utils.translation import ugettext_lazy as _
 
 from djangoplicity.archives import _gen_cache_key, CACHE_PREFIX
+from djangoplicity.archives.caching import GLOBAL_GENERATION, \
+    bump_generation, versioned_key, stale_get, stale_set
+from djangoplicity.archives.contrib.search.backends import update_search_index, \
+    delete_search_index
 from djangoplicity.archives.contrib.security import StaticFilesProtectorCache
 from djangoplicity.archives.contrib.social.tasks import facebook_refresh
 from djangoplicity.archives.fields import ReleaseDateTimeField
-from djangoplicity.archives.resources import ResourceManager
-from djangoplicity.archives.tasks import clear_archive_list_cache, \
-    embargo_release_date_task
+from djangoplicity.archives.loading import get_archive_modeloptions
+from djangoplicity.archives.resources import ResourceManager, \
+    update_resource_manifest, delete_resource_manifest
+from djangoplicity.archives.tasks import embargo_release_date_task
 
 
 __all__ = ( 'ArchiveModel', 'post_rename' )
@@ -87,6 +93,8 @@ def resource_deletion_handler(sender, instance, **kwargs):
     if not issubclass(sender, ArchiveModel):
         return
 
+    delete_resource_manifest(instance)
+
     if not settings.ARCHIVE_AUTO_RESOURCE_DELETION:
         return
 
@@ -191,7 +199,7 @@ def static_files_protection_handler( sender, instance, **kwargs ):
         return
 
     if issubclass( sender, ArchiveModel ):
-        StaticFilesProtectorCache.run_async()
+        StaticFilesProtectorCache.run_async( instance )
 
 
 def clear_views_cache_handler( sender, instance, **kwargs ):
@@ -201,11 +209,63 @@ def clear_views_cache_handler( sender, instance, **kwargs ):
     if 'raw' in kwargs and kwargs['raw']:
         return
 
-    keylist_key = '%s_keys' % sender.get_cache_key_prefix()
-    cache_keys = cache.get(keylist_key)
-    if cache_keys:
-        cache.delete_many(cache_keys)
-        cache.delete(keylist_key)
+    bump_generation(sender.get_cache_key_prefix())
+
+
+def search_index_handler( sender, instance, **kwargs ):
+    """
+    Post save signal handler to update the search index of the archive item
+    (including translations)
+    """
+    if 'raw' in kwargs and kwargs['raw']:
+        return
+
+    update_search_index( instance )
+
+
+def search_index_m2m_handler( sender, instance, action, reverse, model, pk_set, **kwargs ):
+    """
+    m2m_changed signal handler to update the search index of the archive
+    items when a many to many relation used in their search_fields (e.g.
+    subject_name__name) is changed, from either side of the relation.
+    """
+    if action not in ( 'pre_clear', 'post_add', 'post_remove', 'post_clear' ):
+        return
+
+    archive_model = model if reverse else type( instance )
+    opts = archive_model._meta.concrete_model._meta
+    options = get_archive_modeloptions( opts.app_label, opts.model_name )[1]
+    if options is None:
+        return
+
+    names = [f.name for f in archive_model._meta.many_to_many if f.remote_field.through is sender]
+    search_fields = [f.lstrip( '^=@' ).split( '__' )[0] for f in getattr( options, 'search_fields', () )]
+    names = [name for name in names if name in search_fields]
+    if not names:
+        return
+
+    if not reverse:
+        if action != 'pre_clear':
+            update_search_index( instance )
+        return
+
+    # The archive items are on the other side of the relation
+    if action == 'pre_clear':
+        instance._search_index_pks = list( archive_model._base_manager.filter( **{ names[0]: instance } ).values_list( 'pk', flat=True ) )
+        return
+    elif action == 'post_clear':
+        pk_set = instance.__dict__.pop( '_search_index_pks', None )
+
+    if pk_set:
+        for obj in archive_model._base_manager.filter( pk__in=pk_set ):
+            update_search_index( obj )
+
+
+def search_index_deletion_handler( sender, instance, **kwargs ):
+    """
+    Post delete signal handler to remove the archive item from the search index
+    """
+    delete_search_index( instance )
 
 
 class ArchiveBase( ModelBase ):
@@ -365,6 +425,19 @@ class ArchiveBase( ModelBase ):
 
         post_delete.connect( cache_handler, sender=newclass )
 
+        post_save.connect( search_index_handler, sender=newclass )
+
+        post_delete.connect( search_index_deletion_handler, sender=newclass )
+
+        # The through models of the many to many fields may not be loaded yet
+        def connect_m2m_handler( model, through ):
+            m2m_changed.connect( search_index_m2m_handler, sender=through )
+
+        if not newclass._meta.abstract:
+            for field in newclass._meta.many_to_many:
+                if field.remote_field.through is not None:
+                    lazy_related_operation( connect_m2m_handler, newclass, field.remote_field.through )
+
         if getattr( metaclass, 'release_date', False ) and getattr( metaclass, 'published', False ):
             pre_save.connect( release_date_handler, sender=newclass )
 
@@ -544,7 +617,10 @@ class ArchiveModel( object ):
         for rname in resource_names:
             self._rename_resource( rname, new_pk )
 
+        delete_resource_manifest( self )
+
         new_instance = self.__class__.objects.get( pk=new_pk )
+        update_resource_manifest( new_instance )
 
         # Revoke existing embargo/release tasks and create new one
         # accordingly
@@ -575,6 +651,8 @@ class ArchiveModel( object ):
             except IOError:
                 failed.append( rname )
 
+        update_resource_manifest( self )
+
         if failed:
             raise Exception( "Failed to delete %s resource(s)" % failed )
 
@@ -583,7 +661,7 @@ class ArchiveModel( object ):
     def move_resources( self, new_pk ):
         """ Move all resources """
         try:
-            self.__class__.objects.get( pk=new_pk )
+            new_instance = self.__class__.objects.get( pk=new_pk )
         except ObjectDoesNotExist:
             raise Exception( "Object you are trying to move resources to does not exists." )
 
@@ -598,6 +676,9 @@ class ArchiveModel( object ):
         for rname in resource_names:
             self._rename_resource( rname, new_pk )
 
+        delete_resource_manifest( self )
+        update_resource_manifest( new_instance )
+
         return True
 
     def locked_resources( self ):
@@ -617,14 +698,16 @@ class ArchiveModel( object ):
         Called at the time defined by embargo_date
         '''
         # Clear the cache
-        clear_archive_list_cache()
+        bump_generation( GLOBAL_GENERATION )
+        StaticFilesProtectorCache.run_async( self )
 
     def release_date_action(self):
         '''
         Called at the time defined by release_date
         '''
         # Clear the cache
-        clear_archive_list_cache()
+        bump_generation( GLOBAL_GENERATION )
+        StaticFilesProtectorCache.run_async( self )
 
         from django.contrib.sites.models import Site
         domain = Site.objects.get_current().domain
@@ -733,6 +816,7 @@ class ArchiveModel( object ):
         wasn't there in the first iteration
         '''
         self._resource_cache = {}
+        self._resource_manifest = None
 
     def get_object_identifier( self ):
         """
@@ -748,46 +832,47 @@ class ArchiveModel( object ):
         return cls.__name__
 
     @classmethod
-    def cache_set( cls, key, data ):
+    def get_versioned_cache_key( cls, key ):
         """
-        Caches 'data' with key 'key', stores the key so that it can be
-        cleared. We store the key twice: once so that the archive specific
-        cache can be cleared (e.g.: all Image cache), once for all the
-        archives
+        Returns 'key' versioned with the current cache generation of this
+        archive and the global archives cache generation, so that the entry
+        is invalidated when either of them is bumped.
         """
-        keylist_key = '%s_keys' % cls.get_cache_key_prefix()
-        ca = cache.get(keylist_key)
-
-        # Add key to list of keys for model if necessary
-        if ca:
-            if key not in ca:
-                ca.append(key)
-        else:
-            ca = [key]
-
-        cache.set(keylist_key, ca, 99999999)
-
-        # Also store key in global key list
-        global_keylist_key = 'global_cache_keys'
-        ca = cache.get(global_keylist_key)
-
-        # Add key to list of keys for model if necessary
-        if ca:
-            if key not in ca:
-                ca.append(key)
-        else:
-            ca = [key]
-
-        cache.set(global_keylist_key, ca, 99999999)
+        return versioned_key(key, cls.get_cache_key_prefix(), GLOBAL_GENERATION)
 
-        cache.set(key, data, 60 * 5)
+    @classmethod
+    def cache_set( cls, key, data, timeout=60 * 5 ):
+        """
+        Caches 'data' with key 'key'. The key is versioned with the archive
+        specific and global cache generations, so the entry can be cleared
+        with clear_views_cache_handler (e.g.: all Image cache) or
+        clear_archive_list_cache (all the archives).
+        """
+        cache.set(cls.get_versioned_cache_key(key), data, timeout)
 
     @classmethod
     def cache_get( cls, key ):
         """
         Returns data with key 'key' from cache (or None)
         """
-        return cache.get(key)
+        return cache.get(cls.get_versioned_cache_key(key))
+
+    @classmethod
+    def cache_set_stale( cls, key, data, soft_ttl, stale_ttl ):
+        """
+        Same as cache_set() but for stale-while-revalidate entries, see
+        djangoplicity.archives.caching.stale_set
+        """
+        stale_set(cls.get_versioned_cache_key(key), data, soft_ttl, stale_ttl, stale_key=key)
+
+    @classmethod
+    def cache_get_stale( cls, key, lock_timeout=30, stats_name=None ):
+        """
+        Same as cache_get() but for stale-while-revalidate entries. Returns
+        a tuple (data, state), see djangoplicity.archives.caching.stale_get
+        """
+        return stale_get(cls.get_versioned_cache_key(key), stale_key=key,
+            lock_timeout=lock_timeout, stats_name=stats_name)
 
     @classmethod
     def get_object_identifier_for_pk( cls, pk='' ):
@@ -19,7 +19,8 @@ from django.utils.http import urlencode
 from django.utils.translation import ugettext_lazy as _
 
 from djangoplicity.archives.queries import urlname_for_query
-from djangoplicity.utils.pagination import DjangoplicityPaginator
+from djangoplicity.archives.resources import prefetch_resources
+from djangoplicity.utils.pagination import DjangoplicityPaginator, KeysetPaginator
 
 __all__ = ( 'ArchiveBrowser', )
 
@@ -104,11 +105,32 @@ class ArchiveBrowser( object ):
     This is done by an ArchiveQuery.
     """
 
-    def __init__( self, verbose_name=None, paginate_by=None, index_template=None, allow_empty=None, template_name=None, extra_context=None, content_type=None, display=True ):
+    # GET parameters (besides the ones declared by the query) that the
+    # list view can be cached on, see ArchiveQuery.cache_params
+    cache_params = ()
+
+    # Use keyset pagination (see djangoplicity.utils.pagination.KeysetPaginator)
+    # with the total count cached for count_cache_timeout seconds
+    keyset_pagination = False
+    count_cache_timeout = 60 * 5
+
+    # Resources (e.g. 'thumb') used by the browser's templates, which are
+    # resolved for the whole page at once (see prefetch_resources)
+    resources = ()
+
+    # Browsers which render the page as an iterator of chunks (sent with a
+    # StreamingHttpResponse). Their pages are not cached.
+    streaming = False
+
+    def __init__( self, verbose_name=None, paginate_by=None, index_template=None, allow_empty=None, template_name=None, extra_context=None, content_type=None, display=True, keyset_pagination=None, resources=None ):
         """
             verbose_name -
             paginate_by -
             allow_empty -
+            keyset_pagination - Avoid OFFSET/COUNT queries for deep pages, see
+                            djangoplicity.utils.pagination.KeysetPaginator
+            resources -   Resources used by the templates, resolved for the whole
+                            page at once.
             extra_context - A dictionary of values to add to the template context. By default, this
                             is an empty dictionary. If a value in the dictionary is callable, the
                             generic view will call it just before rendering the template.
@@ -123,15 +145,39 @@ class ArchiveBrowser( object ):
         self.extra_context = extra_context
         self.content_type = content_type
         self.display = True
+        if keyset_pagination is not None:
+            self.keyset_pagination = keyset_pagination
+        if resources is not None:
+            self.resources = resources
 
     def paginate_by( self, request ):
         return self._paginate_by
 
-    def pagination( self, options, qs, request, page=1 ):
+    def get_paginator( self, qs, request, cache_key=None ):
+        model = getattr( qs, 'model', None )
+
+        if self.keyset_pagination and hasattr( model, 'get_versioned_cache_key' ):
+            # The archive's cache generation is part of the key so cached
+            # counts and page boundaries are cleared when the archive changes
+            return KeysetPaginator( qs, per_page=self.paginate_by( request ), allow_empty_first_page=self.allow_empty,
+                cache_key_prefix=model.get_versioned_cache_key( '%s_pagination' % model.get_cache_key_prefix() ),
+                cache_key=cache_key, cache_timeout=self.count_cache_timeout )
+
+        return DjangoplicityPaginator( qs, per_page=self.paginate_by( request ), allow_empty_first_page=self.allow_empty )
+
+    def pagination( self, options, qs, request, page=1, evaluate=True, cache_key=None ):
+        """
+        Returns a tuple (paginator, page number, page). Unless evaluate is
+        False, the objects of the page are fetched and pre-processed,
+        otherwise this is left to the caller.
+
+        cache_key identifies the query and its parameters (but not the page)
+        for the keyset paginator, see archives.views.archive_list.
+        """
         #
         # Get data and paginator
         #
-        paginator = DjangoplicityPaginator( qs, per_page=self.paginate_by( request ), allow_empty_first_page=self.allow_empty )
+        paginator = self.get_paginator( qs, request, cache_key=cache_key )
 
         # Determine page to view
         try:
@@ -148,7 +194,9 @@ class ArchiveBrowser( object ):
         # Evaluate query set - i.e. get the actual data.
         try:
             page_obj = paginator.page( page_number )
-            options.process_object_list( page_obj.object_list )
+            if evaluate:
+                options.process_object_list( page_obj.object_list )
+                prefetch_resources( page_obj.object_list, self.resources )
         except InvalidPage:
             raise Http404
 
@@ -173,7 +221,8 @@ class ArchiveBrowser( object ):
         # Pagination (will evaluate query set)
         #
         try:
-            ( paginator, _page_number, page_obj ) = self.pagination( options, qs, request, page=kwargs['page'] )
+            ( paginator, _page_number, page_obj ) = self.pagination( options, qs, request, page=kwargs['page'],
+                cache_key=kwargs.get( 'pagination_key' ) )
         except KeyError:
             raise Http404
 
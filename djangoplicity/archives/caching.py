@@ -0,0 +1,184 @@
+# Djangoplicity
+# Copyright 2007-2008 ESA/Hubble
+#
+# Authors:
+#   Lars Holm Nielsen <lnielsen@eso.org>
+#   Luis Clara Gomes <lcgomes@eso.org>
+#
+
+"""
+Cache helpers for the archive views.
+
+List view cache entries are invalidated through generation counters instead
+of lists of keys: a counter is kept per archive model, plus one global counter
+for all archives. The current values of the counters are folded into the
+cache keys, so invalidating all list views of a model (or of all archives)
+is a single atomic increment. Entries belonging to an old generation are never
+read again and simply expire.
+
+It also provides an optional stale-while-revalidate mode (see stale_get and
+stale_set) used by the archive views to avoid cache stampedes.
+"""
+
+import time
+
+from django.core.cache import cache
+
+
+GENERATION_PREFIX = 'djangoplicity.archives_generation_'
+GLOBAL_GENERATION = 'global'
+
+
+def _generation_key( name ):
+    return '%s%s' % ( GENERATION_PREFIX, name )
+
+
+def _initial_generation():
+    """
+    Counters are initialised from the current time in milliseconds so that a
+    counter that was evicted from the cache doesn't restart at a value
+    which has already been used by entries that might still be cached.
+    """
+    return int( time.time() * 1000 )
+
+
+def get_generations( *names ):
+    """
+    Return the current generation for each of the given counter names
+    using a single cache round trip. Missing counters are initialised.
+    """
+    keys = [_generation_key( name ) for name in names]
+    values = cache.get_many( keys )
+
+    generations = []
+    for key in keys:
+        gen = values.get( key )
+        if gen is None:
+            gen = _initial_generation()
+            # Another process might have initialised the counter meanwhile,
+            # in which case we use its value.
+            if not cache.add( key, gen, None ):
+                gen = cache.get( key, gen )
+        generations.append( gen )
+
+    return generations
+
+
+def get_generation( name ):
+    """
+    Return the current generation for the counter 'name'
+    """
+    return get_generations( name )[0]
+
+
+def bump_generation( name ):
+    """
+    Increment the generation counter 'name', thereby invalidating all cache
+    entries whose key was built with a previous generation.
+    """
+    key = _generation_key( name )
+    try:
+        return cache.incr( key )
+    except ValueError:
+        # Counter doesn't exist (never used or evicted)
+        gen = _initial_generation()
+        cache.set( key, gen, None )
+        return gen
+
+
+def versioned_key( key, *names ):
+    """
+    Return 'key' suffixed with the current generation of the given counters
+    """
+    return '%s_%s' % ( key, '_'.join( [str( g ) for g in get_generations( *names )] ) )
+
+
+#
+# Stale-while-revalidate
+#
+# Entries are stored together with a soft expiry time. Once an entry is past
+# its soft expiry, the first request to notice takes a short lock and
+# re-renders the page, while concurrent requests keep being served the
+# stale copy. A copy of each entry is also kept under a separate stale key
+# which is not touched by invalidation (deleted detail keys, bumped
+# generations), so that the same applies right after an invalidation.
+#
+CACHE_HIT = 'hit'
+CACHE_STALE = 'stale'
+CACHE_MISS = 'miss'
+
+STATS_PREFIX = 'djangoplicity.archives_stats_'
+
+
+def _stale_key( key ):
+    return '%s_stale' % key
+
+
+def _lock_key( key ):
+    return '%s_lock' % key
+
+
+def incr_stat( name, stat ):
+    """
+    Increment the counter for 'stat' (hit, stale or miss) for 'name'
+    """
+    key = '%s%s_%s' % ( STATS_PREFIX, name, stat )
+    try:
+        cache.incr( key )
+    except ValueError:
+        if not cache.add( key, 1, None ):
+            cache.incr( key )
+
+
+def get_stats( name ):
+    """
+    Returns a dictionary with hit, stale and miss counts for 'name'
+    """
+    keys = dict( [( '%s%s_%s' % ( STATS_PREFIX, name, stat ), stat ) for stat in ( CACHE_HIT, CACHE_STALE, CACHE_MISS )] )
+    values = cache.get_many( keys.keys() )
+    return dict( [( stat, values.get( key, 0 ) ) for ( key, stat ) in keys.items()] )
+
+
+def stale_get( key, stale_key=None, lock_timeout=30, stats_name=None ):
+    """
+    Lookup an entry stored with stale_set(). 'stale_key' is the base key
+    of the stale copy and defaults to 'key'.
+
+    Returns a tuple (data, state):
+     * (data, CACHE_HIT) if the entry is fresh.
+     * (data, CACHE_STALE) if the entry is stale but another request is
+       already re-rendering it: the data should be served as is.
+     * (None, CACHE_MISS) if there is no entry or if the caller acquired the
+       lock: the caller must render the page and call stale_set().
+    """
+    stale_key = _stale_key( key if stale_key is None else stale_key )
+    values = cache.get_many( [key, stale_key] )
+
+    state = CACHE_MISS
+    data = None
+
+    entry = values.get( key )
+    if entry is not None and entry[0] > time.time():
+        data, state = entry[1], CACHE_HIT
+    else:
+        if entry is None:
+            entry = values.get( stale_key )
+        if entry is not None and not cache.add( _lock_key( stale_key ), 1, lock_timeout ):
+            data, state = entry[1], CACHE_STALE
+
+    if stats_name:
+        incr_stat( stats_name, state )
+
+    return ( data, state )
+
+
+def stale_set( key, data, soft_ttl, stale_ttl, stale_key=None ):
+    """
+    Store 'data' under 'key' (and its stale copy) for soft_ttl + stale_ttl
+    seconds, considering it fresh for soft_ttl seconds and release the lock
+    acquired in stale_get().
+    """
+    stale_key = _stale_key( key if stale_key is None else stale_key )
+    entry = ( time.time() + soft_ttl, data )
+    cache.set_many( {key: entry, stale_key: entry}, soft_ttl + stale_ttl )
+    cache.delete( _lock_key( stale_key ) )
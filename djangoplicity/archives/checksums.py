@@ -0,0 +1,194 @@
+# Djangoplicity
+# Copyright 2007-2008 ESA/Hubble
+#
+# Authors:
+#   Lars Holm Nielsen <lnielsen@eso.org>
+#   Luis Clara Gomes <lcgomes@eso.org>
+#
+
+"""
+Computation of the sha256 checksums of archive resources.
+
+Checksums are stored in the ``checksums`` field of archive items as a
+dictionary of resource name to entry. An entry records the size and
+modification time of the file which was hashed::
+
+    {'original': {'sha256': '...', 'size': 1234, 'mtime': 1490000000}}
+
+so that unchanged files are not hashed again. Older entries only hold the
+hexadecimal digest, which is still accepted (see checksum_value) but is
+always recomputed.
+"""
+
+import hashlib
+import os
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+
+
+DEFAULT_MIN_SIZE = 104857600  # 100MB
+
+# Number of files hashed concurrently. hashlib releases the GIL while
+# hashing, so threads are enough.
+CHECKSUM_THREADS = getattr(settings, 'DJANGOPLICITY_CHECKSUM_THREADS', min(4, cpu_count()))
+
+# Size of the reads, a multiple of the page size.
+CHECKSUM_READ_SIZE = 16 * 2**20
+
+
+def checksum_value(entry):
+    '''
+    Return the hexadecimal digest of a checksum entry (or None)
+    '''
+    if isinstance(entry, dict):
+        return entry.get('sha256')
+    return entry
+
+
+def checksum_entry(hexdigest, st):
+    '''
+    Return the checksum entry for the file with the given os.stat() result
+    '''
+    return {
+        'sha256': hexdigest,
+        'size': st.st_size,
+        'mtime': int(st.st_mtime),
+    }
+
+
+def checksum_is_current(entry, st):
+    '''
+    Return True if the checksum entry was computed for the file with the
+    given os.stat() result
+    '''
+    return isinstance(entry, dict) and entry.get('sha256') is not None and \
+        entry.get('size') == st.st_size and entry.get('mtime') == int(st.st_mtime)
+
+
+def file_checksum(path):
+    '''
+    Return the sha256 hexadecimal digest of the file
+    '''
+    h = hashlib.sha256()
+    buf = bytearray(CHECKSUM_READ_SIZE)
+    view = memoryview(buf)
+
+    # Unbuffered, the data is read directly into buf
+    with open(path, 'rb', 0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+
+    return h.hexdigest()
+
+
+def hash_files(paths, processes=None):
+    '''
+    Compute the checksums of the given files in parallel. Returns a
+    dictionary of path to hexadecimal digest.
+    '''
+    paths = list(paths)
+    if processes is None:
+        processes = CHECKSUM_THREADS
+    processes = min(processes, len(paths))
+
+    if processes <= 1:
+        return dict((p, file_checksum(p)) for p in paths)
+
+    pool = ThreadPool(processes)
+    try:
+        return dict(zip(paths, pool.map(file_checksum, paths, chunksize=1)))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def resource_files(instance, formats=None, min_size=DEFAULT_MIN_SIZE):
+    '''
+    Return a dictionary of resource name to (path, os.stat() result) of the
+    instance's resources files of at least min_size, for all formats or only
+    the given ones. Non-file resources (e.g. zoomable) are skipped.
+    '''
+    from djangoplicity.archives.resources import ResourceManager
+
+    files = {}
+
+    for r_name in dir(instance.Archive):
+        if not isinstance(getattr(instance.Archive, r_name), ResourceManager):
+            continue
+
+        if formats and r_name not in formats:
+            continue
+
+        resource = getattr(instance, 'resource_%s' % r_name)
+        if not resource:
+            continue
+
+        try:
+            st = os.stat(resource.path)
+        except OSError:
+            continue
+
+        if not os.path.isfile(resource.path) or st.st_size < min_size:
+            continue
+
+        files[r_name] = (resource.path, st)
+
+    return files
+
+
+def compute_instance_checksums(instance, formats=None, min_size=DEFAULT_MIN_SIZE,
+        incremental=True, processes=None):
+    '''
+    Compute the checksums of the instance's resources files of at least
+    min_size. If a list of formats is given then only these checksums are
+    updated, otherwise checksums of removed resources are dropped.
+
+    In incremental mode, files whose size and modification time match the
+    stored entry are not hashed again.
+
+    Returns a tuple (checksums, hashed) where hashed is a dictionary of
+    resource name to size of the files which were hashed.
+    '''
+    current = getattr(instance, 'checksums', None) or {}
+    checksums = dict(current) if formats else {}
+    todo = {}
+
+    for r_name, (path, st) in resource_files(instance, formats, min_size).items():
+        if incremental and checksum_is_current(current.get(r_name), st):
+            checksums[r_name] = current[r_name]
+        else:
+            todo[r_name] = (path, st)
+
+    digests = hash_files([path for (path, st) in todo.values()], processes)
+
+    hashed = {}
+    for r_name, (path, st) in todo.items():
+        checksums[r_name] = checksum_entry(digests[path], st)
+        hashed[r_name] = st.st_size
+
+    return (checksums, hashed)
+
+
+def store_checksums(instance, checksums):
+    '''
+    Save the checksums of the instance (and its translations) and update
+    its resource manifest
+    '''
+    from djangoplicity.archives.resources import update_resource_manifest
+
+    cls = type(instance)
+
+    if checksums != instance.checksums:
+        cls.objects.filter(pk=instance.pk).update(checksums=checksums)
+        if settings.USE_I18N:
+            # Normally this would be done automatically in TranslationModel.save()
+            # But we use update to avoid an infinite task loop
+            cls.objects.filter(source=instance.pk).update(checksums=checksums)
+
+    instance.checksums = checksums
+    update_resource_manifest(instance)
@@ -7,8 +7,9 @@
 #
 from django.utils.translation import ugettext_noop as _
 from djangoplicity.archives.browsers import ArchiveBrowser
-from django.http import Http404, HttpResponse
-from djangoplicity.archives.contrib.serialization import Serialization
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from djangoplicity.archives.contrib.serialization import Serialization, iter_batches
+from djangoplicity.archives.resources import prefetch_resources
 
 __all__ = ( 'NormalBrowser', 'ViewAllBrowser', 'ListBrowser', 'SerializationBrowser' )
 
@@ -37,7 +38,14 @@ class ListBrowser(ArchiveBrowser):
 
 
 class SerializationBrowser( ArchiveBrowser ):
-    def __init__(self, serializer=None, emitter=None, paginate_by=100, display=False, verbose_name="", include_pagination_data_in_response=False ):
+    cache_params = ( 'tz', )
+
+    def __init__(self, serializer=None, emitter=None, paginate_by=100, display=False, verbose_name="", include_pagination_data_in_response=False, stream=False ):
+        """
+        stream - Fetch, serialize and send the objects of the page in
+                 batches, so memory usage doesn't depend on the page size.
+                 Streamed pages are not cached.
+        """
         self.serializer = serializer
         self.emitter = emitter
         self._paginate_by = paginate_by
@@ -46,13 +54,15 @@ class SerializationBrowser( ArchiveBrowser ):
         self.allow_empty = True
         # By default the response is a plain array, but this include extra data like count, page_size, etc
         self.include_pagination_data_in_response = include_pagination_data_in_response
+        self.streaming = stream
 
     def render( self, request, model, options, query, query_name, qs, query_data, search_str, **kwargs ):
         #
         # Pagination (will evaluate query set)
         #
         try:
-            (_paginator, _page_number, page_obj) = self.pagination( options, qs, request, page=kwargs['page'])
+            (_paginator, _page_number, page_obj) = self.pagination( options, qs, request, page=kwargs['page'],
+                evaluate=not self.streaming, cache_key=kwargs.get( 'pagination_key' ) )
         except KeyError:
             raise Http404
 
@@ -63,6 +73,18 @@ class SerializationBrowser( ArchiveBrowser ):
         if tz and hasattr(serializer, "timezone"):
             serializer.timezone = tz
 
+        if self.streaming:
+            extra = None
+            if self.include_pagination_data_in_response:
+                extra = {
+                    "count": _paginator.count,
+                    "total_pages": _paginator.num_pages,
+                    "page_size": self._paginate_by,
+                    "current_page": _page_number,
+                }
+            batches = self._iter_batches( options, page_obj.object_list, serializer )
+            return emitter.stream( serializer.serialize_batches( batches ), extra )
+
         if hasattr( serializer, 'serialize_list' ):
             data = serializer.serialize_list( page_obj.object_list )
         else:
@@ -82,5 +104,15 @@ class SerializationBrowser( ArchiveBrowser ):
 
         return emitter.emit( data )
 
+    def _iter_batches( self, options, object_list, serializer ):
+        for batch in iter_batches( object_list, serializer.batch_size ):
+            options.process_object_list( batch )
+            prefetch_resources( batch, self.resources )
+            yield batch
+
     def response( self, content, **kwargs ):
-        return self.emitter().response( HttpResponse( content, content_type=self.emitter.content_type ) )
+        if self.streaming:
+            response = StreamingHttpResponse( content, content_type=self.emitter.content_type )
+        else:
+            response = HttpResponse( content, content_type=self.emitter.content_type )
+        return self.emitter().response( response )
@@ -479,6 +479,12 @@ class AdvancedSearchQuery (AllPublicQuery):
 
             raise Http404()
 
+    def cache_params( self, model, request ):
+        """
+        Advanced search results are never cached
+        """
+        return None
+
     def queryset( self, model, options, request, **kwargs ):
 
         # get form
@@ -14,14 +14,16 @@ import csv
 
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required, permission_required
+from django.core.paginator import InvalidPage, Paginator
 from django.core.urlresolvers import reverse
-from django.http import Http404, HttpResponse
+from django.db.models import Min, OuterRef, Subquery, Sum
+from django.http import Http404, HttpResponse, StreamingHttpResponse
 from django.shortcuts import render
 from django.utils.encoding import force_unicode
 from djangoplicity.archives.contrib.satchmo.export import factory
 from product import views
 from product.models import Product, Category
-from satchmo_store.shop.models import Order
+from satchmo_store.shop.models import Order, OrderItem, OrderVariable
 from satchmo_store.shop.views.home import home
 
 satchmo_category_view = views.category_view
@@ -96,13 +98,76 @@ def _order_file( request, order_id, exporter_type=None ):
     return response
 
 
+ORDERS_PER_PAGE = 100
+
+_ORDER_HEADER = [
+    "Last name",
+    "First name",
+    "Email",
+    "Timestamp",
+    "Qty",
+    "Total",
+    "Discount code",
+    "Shipping addressee",
+    "Shipping street 1",
+    "Shipping street 2",
+    "Shipping city",
+    "Shipping state",
+    "Shipping postal code",
+    "Shipping country",
+    "Billing addressee",
+    "Billing street 1",
+    "Billing street 2",
+    "Billing city",
+    "Billing state",
+    "Billing postal code",
+    "Billing country",
+]
+
+PRODUCT_ORDERS_HEADER = ["", "Order no.", "Status", "ID", "Invoice"] + _ORDER_HEADER
+CATEGORY_ORDERS_HEADER = ["", "Order no.", "Status", "ID", "Product ID"] + _ORDER_HEADER
+
+
+def _round( val, places=2 ):
+    from satchmo_utils.numbers import round_decimal
+    return str( round_decimal( val=val, places=places, normalize=False ) )
+
+
+def _order_variable( key, order ):
+    """
+    Subquery for the value of an order variable (see Order.get_variable),
+    order is the name of the outer query's order field.
+    """
+    return Subquery( OrderVariable.objects.filter( order=OuterRef( order ), key=key ).values( 'value' )[:1] )
+
+
+def _quantity( items ):
+    """
+    Subquery for the sum of the quantities of the given order items,
+    which must be filtered on a single order with OuterRef.
+    """
+    return Subquery( items.order_by().values( 'order' ).annotate( total=Sum( 'quantity' ) ).values( 'total' ) )
+
+
+def _total_sold( items ):
+    return items.exclude( order__status='' ).aggregate( total=Sum( 'quantity' ) )['total'] or 0
+
+
 def _get_product_orders(product_id):
-    """ Get all product orders associated with a product """
+    """
+    Get all orders associated with a product, annotated with the
+    quantity ordered (qty) and the order number (order_no).
+    """
     p = Product.objects.get(pk=product_id)
-    orders = Order.objects.filter(orderitem__product=p).select_related('contact').exclude(status='')
+    items = OrderItem.objects.filter(product=p)
+
+    orders = Order.objects.filter(pk__in=items.values('order')).select_related('contact').exclude(status='').annotate(
+        qty=_quantity(items.filter(order=OuterRef('pk'))),
+        order_no=_order_variable('ORDER_ID', 'pk'),
+    )
 
     # Conferences are ordered by last name, other by timestamp
-    if p.category.filter(parent__name='Conferences'):
+    if p.category.filter(parent__name='Conferences').exists():
         orders = orders.order_by('contact__last_name')
     else:
         orders = orders.order_by('-time_stamp')
@@ -110,121 +175,102 @@ def _get_product_orders(product_id):
     return (p, orders)
 
 
-@login_required
-@staff_member_required
-@permission_required("shop.change_order" )
-def orders_for_product( request, product_id, format=None, **kwargs ):
+def _get_category_items(category):
     """
+    Get one order item per order and product of the category, annotated
+    with the quantity ordered (qty) and the order number (order_no).
     """
-    from satchmo_utils.numbers import round_decimal
-    try:
-        ( product, orders ) = _get_product_orders( int( product_id ) )
-    except ( ValueError, Product.DoesNotExist ):
-        raise Http404
-
-    header = [
-        "",
-        "Order no.",
-        "Status",
-        "ID",
-        "Invoice",
-        "Last name",
-        "First name",
-        "Email",
-        "Timestamp",
-        "Qty",
-        "Total",
-        "Discount code",
-        "Shipping addressee",
-        "Shipping street 1",
-        "Shipping street 2",
-        "Shipping city",
-        "Shipping state",
-        "Shipping postal code",
-        "Shipping country",
-        "Billing addressee",
-        "Billing street 1",
-        "Billing street 2",
-        "Billing city",
-        "Billing state",
-        "Billing postal code",
-        "Billing country",
+    items = OrderItem.objects.filter(product__category=category).exclude(order__status='')
+    first_items = items.order_by().values('order', 'product').annotate(first=Min('pk')).values('first')
+
+    return OrderItem.objects.filter(pk__in=first_items).select_related('order__contact', 'product').annotate(
+        qty=_quantity(OrderItem.objects.filter(order=OuterRef('order'), product=OuterRef('product'))),
+        order_no=_order_variable('ORDER_ID', 'order'),
+    ).order_by('-order__pk', 'pk')
+
+
+def _order_row( n, o, order_no, column, qty ):
+    return [
+        n,
+        order_no,
+        o.status,
+        o.id,
+        column,
+        o.contact.last_name,
+        o.contact.first_name,
+        o.contact.email,
+        str(o.time_stamp),
+        _round( qty or 0, places=0 ),
+        _round(o.total),
+        o.discount_code,
+        o.ship_addressee,
+        o.ship_street1,
+        o.ship_street2,
+        o.ship_city,
+        o.ship_state,
+        o.ship_postal_code,
+        o.ship_country,
+        o.bill_addressee,
+        o.bill_street1,
+        o.bill_street2,
+        o.bill_city,
+        o.bill_state,
+        o.bill_postal_code,
+        o.bill_country,
     ]
 
-    def _round( val, places=2 ):
-        return str( round_decimal( val=val, places=places, normalize=False ) )
 
-    table = []
+def _product_order_rows( orders, start=1 ):
+    for n, o in enumerate( orders, start ):
+        invoice = '<a href="%s">invoice</a>' % reverse('satchmo_print_shipping', None, None, {'doc': 'invoice', 'id': o.id})
+        yield _order_row( n, o, o.order_no or 'unknown', invoice, o.qty )
 
-    total_sold = 0
 
-    n = 0
-    for n, o in enumerate(orders):
-        qty = 0
-        for i in o.orderitem_set.filter( product=product ):
-            qty += i.quantity
+def _category_order_rows( items, start=1 ):
+    for n, i in enumerate( items, start ):
+        o = i.order
+        order_no = '<a href="%s">%s</a>' % (reverse('adminshop_site:shop_order_change', args=[o.id]), i.order_no or 'unknown')
+        yield _order_row( n, o, order_no, i.product.sku, i.qty )
+
+
+class _Echo( object ):
+    """
+    File-like object for csv.writer which returns the written line
+    instead of buffering it.
+    """
+    def write( self, value ):
+        return value
 
-        try:
-            order_id = o.get_variable( "ORDER_ID" ).value
-        except AttributeError:
-            order_id = 'unknown'
-
-        row = [
-            n + 1,
-            order_id,
-            o.status,
-            o.id,
-            '<a href="%s">invoice</a>' % reverse('satchmo_print_shipping', None, None, {'doc': 'invoice', 'id': o.id}),
-            o.contact.last_name,
-            o.contact.first_name,
-            o.contact.email,
-            str(o.time_stamp),
-            _round( qty, places=0 ),
-            _round(o.total),
-            o.discount_code,
-            o.ship_addressee,
-            o.ship_street1,
-            o.ship_street2,
-            o.ship_city,
-            o.ship_state,
-            o.ship_postal_code,
-            o.ship_country,
-            o.bill_addressee,
-            o.bill_street1,
-            o.bill_street2,
-            o.bill_city,
-            o.bill_state,
-            o.bill_postal_code,
-            o.bill_country,
-        ]
-        table.append( row )
-
-        total_sold += qty
 
+def _csv_lines( header, rows ):
+    writer = csv.writer( _Echo() )
+    yield writer.writerow( [unicode( x ).encode( 'utf8', 'replace' ) for x in header] )
+    for row in rows:
+        yield writer.writerow( [unicode( x ).encode( 'utf8', 'replace' ) for x in row] )
+
+
+def _orders_report( request, format, queryset, header, rows, template, filename, context ):
+    """
+    Render an orders report as a paginated HTML page, or stream it as CSV.
+    The rows are built from a single query per page or per export.
+    """
     if format is None or format == 'html':
-        opts = Product._meta
-        app_label = opts.app_label
+        paginator = Paginator( queryset, ORDERS_PER_PAGE )
+        try:
+            page = paginator.page( request.GET.get( 'p', 1 ) )
+        except InvalidPage:
+            raise Http404
 
-        context = {
-            "object_name": force_unicode( opts.verbose_name ),
-            'objects': table,
+        context.update( {
+            'objects': list( rows( page.object_list, page.start_index() ) ),
             'header': header,
-            'product': product,
-            "opts": opts,
-            "app_label": app_label,
-            "total_sold": total_sold,
-        }
-        return render(request, "admin/%s/%s/%s" % ( app_label, opts.object_name.lower(), "orders_for_product.html" ), context)
+            'paginator': paginator,
+            'page': page,
+        } )
+        return render( request, template, context )
     elif format == 'csv':
-        response = HttpResponse( content_type="text/plain" )
-        response['Content-Disposition'] = "attachment; filename=%s.txt" % product.slug
-        writer = csv.writer( response )
-        header = [unicode( x ).encode( 'utf8', 'replace' ) for x in header]
-        writer.writerow( header )
-
-        for row in table:
-            row = [unicode( x ).encode( 'utf8', 'replace' ) for x in row]
-            writer.writerow( row )
+        response = StreamingHttpResponse( _csv_lines( header, rows( queryset.iterator() ) ), content_type="text/plain" )
+        response['Content-Disposition'] = "attachment; filename=%s.txt" % filename
         return response
     else:
         raise Http404
@@ -233,126 +279,63 @@ def orders_for_product( request, product_id, format=None, **kwargs ):
 @login_required
 @staff_member_required
 @permission_required("shop.change_order" )
-def orders_for_category( request, category_id, format=None, **kwargs ):
+def orders_for_product( request, product_id, format=None, **kwargs ):
     """
     """
-    from satchmo_utils.numbers import round_decimal
+    try:
+        ( product, orders ) = _get_product_orders( int( product_id ) )
+    except ( ValueError, Product.DoesNotExist ):
+        raise Http404
+
+    opts = Product._meta
+    app_label = opts.app_label
+
+    context = {
+        "object_name": force_unicode( opts.verbose_name ),
+        'product': product,
+        "opts": opts,
+        "app_label": app_label,
+    }
+
+    if format is None or format == 'html':
+        context['total_sold'] = _total_sold( OrderItem.objects.filter( product=product ) )
+
+    return _orders_report(
+        request, format, orders, PRODUCT_ORDERS_HEADER, _product_order_rows,
+        "admin/%s/%s/%s" % ( app_label, opts.object_name.lower(), "orders_for_product.html" ),
+        product.slug, context
+    )
 
+
+@login_required
+@staff_member_required
+@permission_required("shop.change_order" )
+def orders_for_category( request, category_id, format=None, **kwargs ):
+    """
+    """
     try:
         category = Category.objects.get(pk=category_id)
-        orders = Order.objects.filter( orderitem__product__category=category ).exclude( status='' ).order_by('-pk').distinct()
-    except ( ValueError, Product.DoesNotExists ):
+    except ( ValueError, Category.DoesNotExist ):
         raise Http404
 
-    header = [
-        "",
-        "Order no.",
-        "Status",
-        "ID",
-        "Product ID",
-        "Last name",
-        "First name",
-        "Email",
-        "Timestamp",
-        "Qty",
-        "Total",
-        "Discount code",
-        "Shipping addressee",
-        "Shipping street 1",
-        "Shipping street 2",
-        "Shipping city",
-        "Shipping state",
-        "Shipping postal code",
-        "Shipping country",
-        "Billing addressee",
-        "Billing street 1",
-        "Billing street 2",
-        "Billing city",
-        "Billing state",
-        "Billing postal code",
-        "Billing country",
-    ]
+    opts = Category._meta
+    app_label = opts.app_label
 
-    def _round( val, places=2 ):
-        return str( round_decimal( val=val, places=places, normalize=False ) )
-
-    table = []
-
-    total_sold = 0
-    n = 0
-
-    for o in orders:
-        qty = 0
-        for product in [i.product for i in o.orderitem_set.filter(product__category=category)]:
-
-            for i in o.orderitem_set.filter( product=product ):
-                qty += i.quantity
-
-            try:
-                order_id = o.get_variable( "ORDER_ID" ).value
-            except AttributeError:
-                order_id = 'unknown'
-
-            row = [
-                n + 1,
-                '<a href="%s">%s</a>' % (reverse('adminshop_site:shop_order_change', args=[o.id]), order_id),
-                o.status,
-                o.id,
-                product.sku,
-                o.contact.last_name,
-                o.contact.first_name,
-                o.contact.email,
-                str(o.time_stamp),
-                _round( qty, places=0 ),
-                _round(o.total),
-                o.discount_code,
-                o.ship_addressee,
-                o.ship_street1,
-                o.ship_street2,
-                o.ship_city,
-                o.ship_state,
-                o.ship_postal_code,
-                o.ship_country,
-                o.bill_addressee,
-                o.bill_street1,
-                o.bill_street2,
-                o.bill_city,
-                o.bill_state,
-                o.bill_postal_code,
-                o.bill_country,
-            ]
-            table.append( row )
-            n += 1
-
-        total_sold += qty
+    context = {
+        "object_name": force_unicode( opts.verbose_name ),
+        'category': category,
+        "opts": opts,
+        "app_label": app_label,
+    }
 
     if format is None or format == 'html':
-        opts = Category._meta
-        app_label = opts.app_label
+        context['total_sold'] = _total_sold( OrderItem.objects.filter( product__category=category ) )
 
-        context = {
-            "object_name": force_unicode( opts.verbose_name ),
-            'objects': table,
-            'header': header,
-            'category': category,
-            "opts": opts,
-            "app_label": app_label,
-            "total_sold": total_sold,
-        }
-        return render(request, "admin/%s/%s/%s" % ( app_label, opts.object_name.lower(), "orders_for_category.html" ), context)
-    elif format == 'csv':
-        response = HttpResponse( content_type="text/plain" )
-        response['Content-Disposition'] = "attachment; filename=%s.txt" % category.slug
-        writer = csv.writer( response )
-        header = [unicode( x ).encode( 'utf8', 'replace' ) for x in header]
-        writer.writerow( header )
-
-        for row in table:
-            row = [unicode( x ).encode( 'utf8', 'replace' ) for x in row]
-            writer.writerow( row )
-        return response
-    else:
-        raise Http404
+    return _orders_report(
+        request, format, _get_category_items( category ), CATEGORY_ORDERS_HEADER, _category_order_rows,
+        "admin/%s/%s/%s" % ( app_label, opts.object_name.lower(), "orders_for_category.html" ),
+        category.slug, context
+    )
 
 
 def fb_home(request):
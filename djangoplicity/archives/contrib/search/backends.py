@@ -0,0 +1,433 @@
+# -*- coding: utf-8 -*-
+#
+# djangoplicity-archives
+# Copyright (c) 2007-2011, European Southern Observatory (ESO)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#
+#    * Neither the name of the European Southern Observatory nor the names
+#      of its contributors may be used to endorse or promote products derived
+#      from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY ESO ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL ESO BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE
+
+"""
+Search backends for the keyword search of the archives (see
+ArchiveOptions.search).
+
+The backend is set with ``ArchiveOptions.search_backend`` or for all archives
+with ``settings.ARCHIVE_SEARCH_BACKEND`` (dotted path to the class).
+
+* DefaultSearchBackend - filters the query set with ``__icontains`` lookups
+  on the ``search_fields`` of the archive. No index is needed but every search
+  is a sequential scan.
+* PostgresSearchBackend - full-text search on a tsvector column with a GIN
+  index, results are ordered by relevance. Accents are ignored if the
+  unaccent extension is installed.
+* SQLiteSearchBackend - same as PostgresSearchBackend with an FTS5 table, e.g.
+  for local development. Note that the archives otherwise need PostgreSQL
+  for their JSON fields (checksums, resource manifest) to be written.
+
+The full-text backends index the ``search_fields`` of each archive item in
+SearchDocument when it's saved. Existing archives are indexed with the
+rebuild_search_index management command.
+"""
+
+import operator
+import re
+
+from django.conf import settings
+from django.db import connection, models
+from django.utils.encoding import force_text
+from django.utils.module_loading import import_string
+
+__all__ = ['SearchBackend', 'DefaultSearchBackend', 'PostgresSearchBackend',
+    'SQLiteSearchBackend', 'get_search_backend', 'update_search_index',
+    'delete_search_index']
+
+DEFAULT_SEARCH_BACKEND = 'djangoplicity.archives.contrib.search.backends.DefaultSearchBackend'
+
+# Search fields which are indexed with a higher weight
+TITLE_FIELDS = ('id', 'title')
+
+_backends = {}
+
+
+def get_search_backend( options ):
+    """
+    Return the search backend instance for the given archive options
+    """
+    path = getattr( options, 'search_backend', None ) or \
+        getattr( settings, 'ARCHIVE_SEARCH_BACKEND', DEFAULT_SEARCH_BACKEND )
+
+    if path not in _backends:
+        _backends[path] = import_string( path )()
+    return _backends[path]
+
+
+def _split_criteria( criteria ):
+    """
+    Split the criteria in mandatory included, mandatory excluded and
+    optional criteria
+    """
+    include, exclude, optional = [], [], []
+
+    for c in criteria:
+        if not c.is_mandatory():
+            optional.append( c )
+        elif c.is_include():
+            include.append( c )
+        else:
+            exclude.append( c )
+
+    return include, exclude, optional
+
+
+def _field_values( obj, path ):
+    """
+    Return the values of the field 'path' (e.g. 'subject_name__name') of obj,
+    following foreign keys and many to many relations
+    """
+    objs = [obj]
+    for attr in path.split( '__' ):
+        values = []
+        for o in objs:
+            value = getattr( o, attr, None )
+            if value is None:
+                continue
+            if isinstance( value, models.Manager ):
+                values.extend( value.all() )
+            else:
+                values.append( value )
+        objs = values
+
+    return [force_text( v ) for v in objs if v != '']
+
+
+class SearchBackend( object ):
+    """
+    Interface of the search backends
+    """
+    def search( self, options, qs, criteria ):
+        """
+        Return the query set filtered with the criteria parsed from the search
+        string (see AstronomyQueryParser). Criteria are mandatory (+) by
+        default, unless specifically excluded (-) or optional.
+        """
+        raise NotImplementedError
+
+    def index( self, options, instance ):
+        """
+        Update the index for the instance
+        """
+        pass
+
+    def delete( self, options, instance ):
+        """
+        Remove the instance from the index
+        """
+        pass
+
+
+class DefaultSearchBackend( SearchBackend ):
+    """
+    Search with lookups on the search_fields:
+
+        search_fields = ('id','fk__attr', '^title', '=title', '@title' )
+    """
+    def construct_search( self, field_name ):
+        if connection.vendor == 'postgresql' and \
+                'django.contrib.postgres' in settings.INSTALLED_APPS:
+            # Use Postgres Unaccent module
+            field_name = field_name + '__unaccent'
+
+        if field_name.startswith('^'):
+            return "%s__istartswith" % field_name[1:]
+        elif field_name.startswith('='):
+            return "%s__iexact" % field_name[1:]
+        elif field_name.startswith('@'):
+            return "%s__search" % field_name[1:]
+        else:
+            return "%s__icontains" % field_name
+
+    def construct_criteria_search( self, options, criteria ):
+        or_queries = [models.Q( **{ self.construct_search( str( field_name ) ): criteria.keyword } ) for field_name in options.search_fields]
+        return reduce(operator.or_, or_queries)
+
+    def search( self, options, qs, criteria ):
+        include, exclude, optional = _split_criteria( criteria )
+
+        # Mandatory keywords (AND'ed together and can possibly be negated)
+        if include:
+            qs = qs.filter( reduce(operator.and_, [self.construct_criteria_search( options, c ) for c in include]) )
+
+        if exclude:
+            qs = qs.exclude( reduce(operator.and_, [self.construct_criteria_search( options, c ) for c in exclude]) )
+
+        # Non-mandatory keywords (OR'ed together)
+        if optional:
+            qs = qs.filter( reduce(operator.or_, [self.construct_criteria_search( options, c ) for c in optional]) )
+
+        # Ensure proper results when search related models as well.
+        for field_name in options.search_fields:
+            if '__' in field_name:
+                qs = qs.distinct()
+                break
+
+        return qs
+
+
+class FullTextSearchBackend( SearchBackend ):
+    """
+    Base class for the backends using SearchDocument. Subclasses define the
+    syntax of the full-text queries and the SQL to match and rank them.
+    """
+    # Order the results by relevance
+    ranking = True
+
+    def words( self, criterion ):
+        return re.findall( r'\w+', criterion.keyword, re.UNICODE )
+
+    def criterion_query( self, criterion ):
+        raise NotImplementedError
+
+    def and_query( self, queries ):
+        raise NotImplementedError
+
+    def or_query( self, queries ):
+        raise NotImplementedError
+
+    def match_sql( self ):
+        """
+        SQL selecting the object_id of the documents of a table (first
+        parameter) matching a query (second parameter)
+        """
+        raise NotImplementedError
+
+    def rank_sql( self ):
+        """
+        SQL selecting the rank of the document of a table (first parameter)
+        for the object id given as '%(object_id)s' and a query (second
+        parameter)
+        """
+        raise NotImplementedError
+
+    def write_index( self, doc ):
+        pass
+
+    def delete_index( self, doc ):
+        pass
+
+    def _query( self, criteria ):
+        queries = [self.criterion_query( c ) for c in criteria if self.words( c )]
+        return self.and_query( queries ) if queries else None
+
+    def search( self, options, qs, criteria ):
+        include, exclude, optional = _split_criteria( criteria )
+
+        model = qs.model
+        db_table = model._meta.db_table
+        qn = connection.ops.quote_name
+        object_id = 'CAST(%s.%s AS TEXT)' % ( qn( db_table ), qn( model._meta.pk.column ) )
+
+        query = self._query( include )
+        optional = [self.criterion_query( c ) for c in optional if self.words( c )]
+        if optional:
+            optional = self.or_query( optional )
+            query = self.and_query( [query, optional] ) if query else optional
+
+        if query:
+            qs = qs.extra(
+                where=['%s IN (%s)' % ( object_id, self.match_sql() )],
+                params=[db_table, query],
+            )
+
+            if self.ranking:
+                ordering = list( qs.query.order_by )
+                if not ordering and qs.query.default_ordering:
+                    ordering = list( model._meta.ordering )
+
+                qs = qs.extra(
+                    select={'search_rank': self.rank_sql() % {'object_id': object_id}},
+                    select_params=[db_table, query],
+                ).order_by( '-search_rank', *ordering )
+
+        # As with DefaultSearchBackend, items matching all the excluded
+        # criteria are excluded
+        query = self._query( exclude )
+        if query:
+            qs = qs.extra(
+                where=['%s NOT IN (%s)' % ( object_id, self.match_sql() )],
+                params=[db_table, query],
+            )
+
+        return qs
+
+    def index( self, options, instance ):
+        from djangoplicity.archives.models import SearchDocument
+
+        title = []
+        body = []
+        for field_name in getattr( options, 'search_fields', () ):
+            field_name = field_name.lstrip( '^=@' )
+            values = _field_values( instance, field_name )
+            ( title if field_name in TITLE_FIELDS else body ).extend( values )
+
+        doc, _created = SearchDocument.objects.update_or_create(
+            db_table=instance._meta.db_table,
+            object_id=force_text( instance.pk ),
+            defaults={
+                'lang': getattr( instance, 'lang', '' ) or '',
+                'title': u'\n'.join( title ),
+                'body': u'\n'.join( body ),
+            }
+        )
+        self.write_index( doc )
+
+    def delete( self, options, instance ):
+        from djangoplicity.archives.models import SearchDocument
+
+        for doc in SearchDocument.objects.filter( db_table=instance._meta.db_table, object_id=force_text( instance.pk ) ):
+            self.delete_index( doc )
+            doc.delete()
+
+
+class PostgresSearchBackend( FullTextSearchBackend ):
+    """
+    Search on the tsvector column of SearchDocument. Words are matched by
+    prefix, the id and title have a higher weight than the other fields.
+
+    If the unaccent extension is installed (see the archives' initial
+    migration) accents are removed from both the indexed text and the
+    queries, so that e.g. "nebulosa" matches "nébulosa". Run
+    rebuild_search_index after installing the extension.
+    """
+    # Text search configuration, 'simple' doesn't do any stemming as the
+    # archives are in several languages
+    config = 'simple'
+
+    _unaccent = None
+
+    def has_unaccent( self ):
+        if self._unaccent is None:
+            with connection.cursor() as cursor:
+                cursor.execute( "SELECT 1 FROM pg_extension WHERE extname = 'unaccent'" )
+                self._unaccent = cursor.fetchone() is not None
+        return self._unaccent
+
+    def text_sql( self, sql ):
+        return 'unaccent(%s)' % sql if self.has_unaccent() else sql
+
+    def criterion_query( self, criterion ):
+        op = ' <-> ' if criterion.is_phrase else ' & '
+        return '(%s)' % op.join( ['%s:*' % w.lower() for w in self.words( criterion )] )
+
+    def and_query( self, queries ):
+        return ' & '.join( queries )
+
+    def or_query( self, queries ):
+        return '(%s)' % ' | '.join( queries )
+
+    def match_sql( self ):
+        return "SELECT object_id FROM archives_searchdocument " \
+            "WHERE db_table = %s AND vector @@ to_tsquery('" + self.config + "', " + self.text_sql( '%s' ) + ")"
+
+    def rank_sql( self ):
+        return "SELECT ts_rank(d.vector, q.query) FROM archives_searchdocument d, " \
+            "(SELECT %%s AS db_table, to_tsquery('" + self.config + "', " + self.text_sql( '%%s' ) + ") AS query) q " \
+            "WHERE d.db_table = q.db_table AND d.object_id = %(object_id)s"
+
+    def write_index( self, doc ):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "UPDATE archives_searchdocument SET vector = "
+                "setweight(to_tsvector(%s, " + self.text_sql( 'title' ) + "), 'A') || "
+                "setweight(to_tsvector(%s, " + self.text_sql( 'body' ) + "), 'B') "
+                "WHERE id = %s",
+                [self.config, self.config, doc.pk]
+            )
+
+
+class SQLiteSearchBackend( FullTextSearchBackend ):
+    """
+    Search on the FTS5 table archives_searchdocument_fts, whose rowids are the
+    ids of the SearchDocuments
+    """
+    def criterion_query( self, criterion ):
+        words = self.words( criterion )
+        if criterion.is_phrase:
+            return '"%s"' % ' '.join( words )
+        return '(%s)' % ' AND '.join( ['"%s"*' % w for w in words] )
+
+    def and_query( self, queries ):
+        return ' AND '.join( queries )
+
+    def or_query( self, queries ):
+        return '(%s)' % ' OR '.join( queries )
+
+    def match_sql( self ):
+        return "SELECT d.object_id FROM archives_searchdocument d " \
+            "JOIN archives_searchdocument_fts ON archives_searchdocument_fts.rowid = d.id " \
+            "WHERE d.db_table = %s AND archives_searchdocument_fts MATCH %s"
+
+    def rank_sql( self ):
+        # bm25() returns lower values for better matches
+        return "SELECT -bm25(archives_searchdocument_fts, 10.0, 1.0) FROM archives_searchdocument d " \
+            "JOIN archives_searchdocument_fts ON archives_searchdocument_fts.rowid = d.id " \
+            "WHERE d.db_table = %%s AND d.object_id = %(object_id)s AND archives_searchdocument_fts MATCH %%s"
+
+    def write_index( self, doc ):
+        with connection.cursor() as cursor:
+            cursor.execute( "DELETE FROM archives_searchdocument_fts WHERE rowid = %s", [doc.pk] )
+            cursor.execute(
+                "INSERT INTO archives_searchdocument_fts (rowid, title, body) VALUES (%s, %s, %s)",
+                [doc.pk, doc.title, doc.body]
+            )
+
+    def delete_index( self, doc ):
+        with connection.cursor() as cursor:
+            cursor.execute( "DELETE FROM archives_searchdocument_fts WHERE rowid = %s", [doc.pk] )
+
+
+def _archive_options( instance ):
+    from djangoplicity.archives.loading import get_archive_modeloptions
+
+    opts = instance._meta.concrete_model._meta
+    return get_archive_modeloptions( opts.app_label, opts.model_name )[1]
+
+
+def update_search_index( instance ):
+    """
+    Update the search index for the archive item (no-op if the archive's
+    backend doesn't use an index)
+    """
+    options = _archive_options( instance )
+    if options is not None:
+        get_search_backend( options ).index( options, instance )
+
+
+def delete_search_index( instance ):
+    """
+    Remove the archive item from the search index
+    """
+    options = _archive_options( instance )
+    if options is not None:
+        get_search_backend( options ).delete( options, instance )
@@ -9,10 +9,15 @@
 """
 Restrict access to an archives static resources
 
-Generates and caches a list of protected resources, access is then checked by
+Generates and caches an index of protected resources, access is then checked by
 djangoplicity and serving the files themselves is done by NGINX using
 X-Accel-Redirect
 
+The index maps each protected path prefix (the root of an archive, e.g.
+'images') to a dictionary of protected object ids and their security level.
+Resources are stored as <root>/<format>/<id>.<ext>, so checking a path is a
+dictionary lookup of the id parsed from the path.
+
 Install
 =======
 The ArchiveOptions class for an archive is expected to have
@@ -50,15 +55,18 @@ To update the current static files protection cache run:
     StaticFilesProtectorCache.run()
 
 This will be done automatically in post_save of any objects inheriting from
-ArchiveBase
+ArchiveBase, in which case only the entry for the saved object is updated::
+
+    StaticFilesProtectorCache.run_instance( Image, 'heic0601a' )
 """
 
 from django.conf import settings
 from django.core.cache import cache
+from django.utils.encoding import force_text
 from djangoplicity.archives.contrib.security.tasks import update_static_files_protection_cache
 import logging
 import os
-import re
+import time
 
 logger = logging.getLogger('djangoplicity')
 
@@ -66,42 +74,112 @@ UNPUBLISHED_PERMS = 2
 STAGING_PERMS = 3
 EMBARGO = 1
 
-PROTECTED_PATH_KEY = '%s:static_protected_paths' % settings.SHORT_NAME
+PROTECTED_PATH_KEY = '%s:static_protected_index' % settings.SHORT_NAME
+PROTECTED_PATH_LOCK_KEY = '%s:static_protected_index_lock' % settings.SHORT_NAME
 TIMEOUT = 1200
+LOCK_TIMEOUT = 60
 
 
 class StaticFilesProtectorCache(object):
     @classmethod
-    def run_async(cls):
+    def run_async(cls, instance=None):
         """
-        Call a background task to do the job instead.
+        Call a background task to do the job instead. If an instance is
+        given only its entry in the index is updated.
         """
-        update_static_files_protection_cache.delay()
+        if instance is None:
+            update_static_files_protection_cache.delay()
+        else:
+            opts = instance._meta
+            update_static_files_protection_cache.delay(opts.app_label, opts.model_name, instance.pk)
 
     @classmethod
     def run(cls):
         '''
         Generate a dict with path prefix as keys (e.g.: 'images', 'videos')
-        and a list of compiled regex as values (e.g.: ur'^videos/[^/]+/ann18036a..*$')
+        and a dict of protected ids and their security level as values
+        (e.g.: {'ann18036a': EMBARGO})
+
+        The index is generated while holding the index lock, so that it
+        can't be overwritten by an older version from run_instance().
         '''
+        locked = _acquire_lock(wait=True)
+        try:
+            return cls._run()
+        finally:
+            if locked:
+                cache.delete(PROTECTED_PATH_LOCK_KEY)
+
+    @classmethod
+    def _run(cls):
         protected_paths = {}
 
         for (model_string, option_string) in settings.ARCHIVES:
             mdl = _do_import(model_string)
             opt = _do_import(option_string)
 
-            # Get directory for current model:
-            protected_path = mdl.Archive.Meta.root
-            if protected_path[-1] == os.path.sep:
-                protected_path = protected_path[:-1]
+            protected_path = cls.protected_path(mdl)
 
             # Should only append to protected_path if we actually have some objects to protect
             protected_resources = cls.run_model(mdl, opt, protected_path)
             if protected_resources:
                 protected_paths[protected_path] = protected_resources
 
-        # Remove empty values from protected_paths
-        protected_paths = {k: v for k, v in protected_paths.iteritems() if v is not None}
+        cache.set(PROTECTED_PATH_KEY, protected_paths, TIMEOUT)
+        return protected_paths
+
+    @classmethod
+    def run_instance(cls, model, pk):
+        """
+        Update the security level of a single archive item in the index,
+        e.g. after its published or embargo state changed. The whole
+        index is generated if it's not in the cache.
+
+        The index is read and written back while holding the index lock. If
+        another process holds it, the whole index is generated instead once
+        the lock is released, so no update is lost.
+        """
+        if not _acquire_lock():
+            return cls.run()
+
+        try:
+            return cls._update_instance(model, pk)
+        finally:
+            cache.delete(PROTECTED_PATH_LOCK_KEY)
+
+    @classmethod
+    def _update_instance(cls, model, pk):
+        protected_paths = cache.get(PROTECTED_PATH_KEY)
+        if protected_paths is None:
+            return cls._run()
+
+        for (model_string, option_string) in settings.ARCHIVES:
+            mdl = _do_import(model_string)
+            if mdl._meta.concrete_model is not model._meta.concrete_model:
+                continue
+
+            opt = _do_import(option_string)
+            protected_path = cls.protected_path(mdl)
+            protected_resources = protected_paths.get(protected_path, {})
+
+            security_level = None
+            for query, level in cls.get_protections(opt):
+                qs, _tmp = query(browsers=(None,)).queryset(mdl, opt, None, only_source=True)
+                if qs.filter(pk=pk).exists():
+                    security_level = level
+                    break
+
+            pk = force_text(pk)
+            if security_level is None:
+                protected_resources.pop(pk, None)
+            else:
+                protected_resources[pk] = security_level
+
+            if protected_resources:
+                protected_paths[protected_path] = protected_resources
+            else:
+                protected_paths.pop(protected_path, None)
+            break
 
         cache.set(PROTECTED_PATH_KEY, protected_paths, TIMEOUT)
         return protected_paths
@@ -109,11 +187,28 @@ class StaticFilesProtectorCache(object):
     @classmethod
     def run_model(cls, model, options, protected_path):
         """
-        Run static file protection for one archive
+        Run static file protection for one archive. Returns a dict of
+        protected ids and their security level.
         """
+        protected_resources = {}
 
+        # If an id matches several queries, the first one is used
+        for query, security_level in cls.get_protections(options):
+            qs, _tmp = query(browsers=(None,)).queryset(model, options, None, only_source=True)
+
+            for pk in qs.all().values_list('id', flat=True):
+                protected_resources.setdefault(force_text(pk), security_level)
+
+        return protected_resources
+
+    @classmethod
+    def get_protections(cls, options):
+        """
+        Returns a list of (query, security level) defined in the
+        ResourceProtection class of the archive options.
+        """
         if not hasattr(options, 'ResourceProtection'):
-            return
+            return []
 
         # Find all attributes defined on the ResourceProtection class.
         attributes = []
@@ -133,27 +228,41 @@ class StaticFilesProtectorCache(object):
         # else:
             # ips = ''
 
-        # Collect queries for each security level
-        queries_dict = {}
-        for query, security_level in attributes:
-            access_level = cls.access_level(security_level)
-            if access_level:
-                if access_level not in queries_dict:
-                    queries_dict[access_level] = []
-                queries_dict[access_level].append(query)
+        return attributes
 
-        protected_resources = []
+    @classmethod
+    def protected_path(cls, model):
+        """
+        Returns the path prefix of the resources of an archive
+        """
+        protected_path = model.Archive.Meta.root
+        if protected_path[-1] == os.path.sep:
+            protected_path = protected_path[:-1]
+        return protected_path
 
-        # Loop over found queries to protect
-        for query, security_level in attributes:
-            qs, _tmp = query(browsers=(None,)).queryset(model, options, None, only_source=True)
+    @classmethod
+    def security_level(cls, protected_resources, prefix, path):
+        """
+        Returns the security level for the resource 'path' (e.g.
+        'images/screen/heic0601a.jpg') or None if it's not protected.
+        """
+        rest = path[len(prefix):]
+        if not rest.startswith('/'):
+            return None
 
-            # Eliminate duplicates and generate regular expressions for quick
-            # string matching
-            for pk in set(qs.all().values_list('id', flat=True)):
-                protected_resources.append((re.compile(r'^%s/[^/]+/%s\..*$' % (protected_path, pk)), security_level))
+        # <root>/<format>/<id>.<ext> - the id itself might contain dots.
+        _fmt, sep, filename = rest[1:].partition('/')
+        if not sep:
+            return None
 
-        return protected_resources
+        i = filename.find('.')
+        while i > 0:
+            security_level = protected_resources.get(filename[:i])
+            if security_level is not None:
+                return security_level
+            i = filename.find('.', i + 1)
+
+        return None
 
     @classmethod
     def access_level(cls, perm):
@@ -182,3 +291,17 @@ def _do_import(s):
     for comp in components[1:]:
         mod = getattr(mod, comp)
     return getattr(mod, cls)
+
+
+def _acquire_lock(wait=False):
+    """
+    Acquire the lock of the protected paths index. If wait is True, wait
+    for the holder to release it (or for it to expire). Returns True if
+    the lock was acquired.
+    """
+    deadline = time.time() + LOCK_TIMEOUT
+    while not cache.add(PROTECTED_PATH_LOCK_KEY, 1, LOCK_TIMEOUT):
+        if not wait or time.time() > deadline:
+            return False
+        time.sleep(0.1)
+    return True
@@ -10,13 +10,19 @@ from celery.task import task
 
 
 @task
-def update_static_files_protection_cache():
+def update_static_files_protection_cache(app_label=None, model_name=None, pk=None):
     """
-    Celery task to run static files protection
+    Celery task to run static files protection, for all archives or only
+    for a single archive item.
     """
+    from django.apps import apps
     from djangoplicity.archives.contrib.security import StaticFilesProtectorCache
     logger = update_static_files_protection_cache.get_logger()
 
-    logger.info('Running static file protection for all')
-    StaticFilesProtectorCache.run()
+    if app_label is None:
+        logger.info('Running static file protection for all')
+        StaticFilesProtectorCache.run()
+    else:
+        logger.info('Running static file protection for %s.%s %s', app_label, model_name, pk)
+        StaticFilesProtectorCache.run_instance(apps.get_model(app_label, model_name), pk)
     logger.info('Finished running static file protection')
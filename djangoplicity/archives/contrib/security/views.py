@@ -33,27 +33,27 @@ def serve_static_file(request, path):
         prefix = path.split('/')[0]
 
     try:
-        protected_archives = protected_paths[prefix]
+        protected_resources = protected_paths[prefix]
     except KeyError:
         # path prefix is not protected
         return serve_file(request, path)
 
-    for (regexp, security_level) in protected_archives:
-        if regexp.match(path):
-            # Resource is protected
-            if security_level == UNPUBLISHED_PERMS:
-                if not request.user.is_staff:
-                    return HttpResponseRedirect('%s?next=%s%s' % (settings.LOGIN_URL, settings.MEDIA_URL, path))
-            elif security_level == STAGING_PERMS:
-                if not request.user.is_staff:
-                    return HttpResponseRedirect('%s?next=%s%s' % (settings.LOGIN_URL, settings.MEDIA_URL, path))
-            elif security_level == EMBARGO:
-                if not request.user.is_active:
-                    return HttpResponseRedirect('%s?next=%s%s' % (settings.LOGIN_URL, settings.MEDIA_URL, path))
-            else:
-                # This shouldn't happen
-                logger.warning('Unkown security_level (%s) for path: "%s"', security_level, path)
-            break
+    security_level = StaticFilesProtectorCache.security_level(protected_resources, prefix, path)
+
+    if security_level is not None:
+        # Resource is protected
+        if security_level == UNPUBLISHED_PERMS:
+            if not request.user.is_staff:
+                return HttpResponseRedirect('%s?next=%s%s' % (settings.LOGIN_URL, settings.MEDIA_URL, path))
+        elif security_level == STAGING_PERMS:
+            if not request.user.is_staff:
+                return HttpResponseRedirect('%s?next=%s%s' % (settings.LOGIN_URL, settings.MEDIA_URL, path))
+        elif security_level == EMBARGO:
+            if not request.user.is_active:
+                return HttpResponseRedirect('%s?next=%s%s' % (settings.LOGIN_URL, settings.MEDIA_URL, path))
+        else:
+            # This shouldn't happen
+            logger.warning('Unkown security_level (%s) for path: "%s"', security_level, path)
 
     return serve_file(request, path)
 
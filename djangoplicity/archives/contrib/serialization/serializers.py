@@ -1,8 +1,11 @@
 from datetime import datetime
+from itertools import islice
 import json
 
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
+from django.db.models.fields.related_descriptors import ManyToManyDescriptor
+from django.db.models.query import QuerySet, prefetch_related_objects
 from django.utils.encoding import smart_unicode
 from django.utils.functional import curry
 
@@ -13,10 +16,142 @@ class SerializationError( Exception ):
     pass
 
 
+def iter_batches( objects, batch_size ):
+    """
+    Yield lists of at most batch_size objects. Query sets are fetched with
+    iterator() (i.e. without filling their result cache) and their
+    prefetch_related lookups are done for each batch.
+    """
+    prefetch = ()
+    if isinstance( objects, QuerySet ):
+        prefetch = objects._prefetch_related_lookups
+        objects = objects.iterator()
+
+    objects = iter( objects )
+    while True:
+        batch = list( islice( objects, batch_size ) )
+        if not batch:
+            break
+        if prefetch:
+            prefetch_related_objects( batch, *prefetch )
+        yield batch
+
+
+class RelatedCache( object ):
+    """
+    The objects related through ``field`` to a list of objects, fetched with
+    a single query and indexed by the primary key of the object they are
+    related to. Supports many-to-many relations (in both directions) and
+    reverse foreign keys (e.g. ``imagecontact_set``).
+
+    The related objects can be restricted with a query set of the related
+    model and/or a filter specification (as in ``related_fields``).
+
+    For translations, relations to sources only are looked up with the
+    primary key of the source, as done by the translation related managers.
+    """
+    def __init__( self, objects, field, queryset=None, filter_spec=None ):
+        self.descriptor = None
+        self._objects = {}
+
+        if not objects:
+            return
+
+        self.descriptor = getattr( objects[0].__class__, field )
+        pks = set( self._key( obj ) for obj in objects )
+        for pk in pks:
+            self._objects[pk] = []
+
+        if isinstance( self.descriptor, ManyToManyDescriptor ):
+            rows = self._many_to_many_rows( pks, queryset, filter_spec )
+        else:
+            rows = self._reverse_foreign_key_rows( pks, queryset, filter_spec )
+
+        for pk, relobj in rows:
+            self._objects[pk].append( relobj )
+
+    def _key( self, obj ):
+        if getattr( self.descriptor, 'only_sources', False ) and getattr( obj, 'source_id', None ):
+            return obj.source_id
+        return obj.pk
+
+    def _reverse_foreign_key_rows( self, pks, queryset, filter_spec ):
+        fk = self.descriptor.field
+
+        if queryset is None:
+            queryset = self.descriptor.rel.related_model._default_manager.all()
+        if filter_spec:
+            queryset = queryset.filter( **filter_spec )
+
+        queryset = queryset.filter( **{ '%s__in' % fk.name: pks } )
+        return [( getattr( relobj, fk.attname ), relobj ) for relobj in queryset]
+
+    def _many_to_many_rows( self, pks, queryset, filter_spec ):
+        field = self.descriptor.field
+        through = self.descriptor.through
+
+        if self.descriptor.reverse:
+            source_name, target_name = field.m2m_reverse_field_name(), field.m2m_field_name()
+            target_model = field.model
+        else:
+            source_name, target_name = field.m2m_field_name(), field.m2m_reverse_field_name()
+            target_model = field.remote_field.model
+
+        rows = through._default_manager.filter( **{ '%s__in' % source_name: pks } )
+
+        if queryset is not None:
+            rows = rows.filter( **{ '%s__in' % target_name: queryset } )
+        if filter_spec:
+            rows = rows.filter( **dict( [( '%s__%s' % ( target_name, k ), v ) for ( k, v ) in filter_spec.items()] ) )
+
+        # Same order as the related manager
+        ordering = [
+            '%s%s__%s' % ( '-' if o.startswith( '-' ) else '', target_name, o.lstrip( '-' ) )
+            for o in target_model._meta.ordering if isinstance( o, basestring ) and o != '?'
+        ]
+        rows = rows.select_related( target_name ).order_by( *( ordering + ['pk'] ) )
+
+        source_attname = through._meta.get_field( source_name ).attname
+        return [( getattr( row, source_attname ), getattr( row, target_name ) ) for row in rows]
+
+    def get( self, obj ):
+        """
+        Returns the list of objects related to obj, or None if obj was not
+        in the list of objects.
+        """
+        if self.descriptor is None:
+            return None
+        return self._objects.get( self._key( obj ) )
+
+
 class Serializer( object ):
+    # Number of objects fetched and serialized at once by iter_serialize()
+    batch_size = 100
+
     def serialize( self, obj ):
         raise NotImplementedError
 
+    def serialize_batches( self, batches ):
+        """
+        Serialize lists of objects, yielding the data of each object. Uses
+        serialize_list() if the serializer has one, so its query
+        optimizations are done for each batch.
+        """
+        for batch in batches:
+            if hasattr( self, 'serialize_list' ):
+                for data in self.serialize_list( batch ).data:
+                    yield data
+            else:
+                for obj in batch:
+                    yield self.serialize( obj ).data
+
+    def iter_serialize( self, objects ):
+        """
+        Serialize objects lazily, yielding the data of each object. Only
+        batch_size objects are in memory at a time.
+        """
+        return self.serialize_batches( iter_batches( objects, self.batch_size ) )
+
 
 class SimpleSerializer( Serializer ):
     fields = []
@@ -33,11 +168,10 @@ class SimpleSerializer( Serializer ):
         query optimizations.
         """
         datalist = []
+        objects = list( objects )
 
         if self.related_cache:
-            pks = [obj.pk for obj in objects]
-            if pks:
-                self._prime_cache( obj.__class__, pks )
+            self._prime_cache( objects )
 
         for obj in objects:
             datalist.append( self.serialize( obj ).data )
@@ -126,36 +260,45 @@ class SimpleSerializer( Serializer ):
         Helper function to get all related objects
         """
         if field in self.related_cache:
-            return self._get_cached_objects( obj, field, filter_spec )
+            objects = self._get_cached_objects( obj, field )
+            if objects is not None:
+                return objects
 
         if filter_spec:
             return getattr( obj, field ).filter( **filter_spec )
         else:
             return getattr( obj, field ).all()
 
-    def _get_cached_objects( self, obj, field, filter_spec ):
+    def _get_cached_objects( self, obj, field ):
         """
-        Get cached related objects for this pk
+        Get cached related objects for this object (or None if the cache
+        wasn't primed with this object, e.g. when serializing one object)
         """
-        if self._cached_objects:  # We only cache objects for list serializations
-            return [relobj for ( pk, relobj ) in self._cached_objects[field] if pk == obj.pk]
+        if field in self._cached_objects:
+            return self._cached_objects[field].get( obj )
+        return None
 
-    def _prime_cache( self, model, pks ):
+    def _related_filter_spec( self, field ):
         """
-        Prime cache with all related objects
+        Returns the filter specification of field in related_fields
         """
-        for field, _val in self.related_cache.items():
-            reldescriptor = getattr( model, field )
-
-            through_model_fieldname = reldescriptor.field.related.m2m_reverse_field_name()
-            through_relatedmodel_fieldname = reldescriptor.field.related.m2m_field_name()
+        for f_spec in self.related_fields:
+            if not isinstance( f_spec, basestring ) and f_spec[0] == field and len( f_spec ) > 2:
+                return f_spec[2]
+        return None
 
-            filter_spec = { "%s__in" % through_model_fieldname: pks }
+    def _prime_cache( self, objects ):
+        """
+        Prime cache with all related objects of the fields in related_cache
+        (one query per field)
+        """
+        self._cached_objects = {}
 
-            self._cached_objects[field] = [
-                ( getattr( x, "%s_id" % through_model_fieldname ), getattr( x, through_relatedmodel_fieldname ) )
-                for x in reldescriptor.through.objects.filter( **filter_spec ).select_related( through_relatedmodel_fieldname )
-            ]
+        # related_cache is a list of field names (or a dictionary with the
+        # field names as keys)
+        for field in self.related_cache:
+            self._cached_objects[field] = RelatedCache( objects, field,
+                filter_spec=self._related_filter_spec( field ) )
 
     def append_timezone( self, date ):
         """
@@ -178,6 +321,19 @@ class Emitter( object ):
     def emit( self, serialization ):
         raise NotImplementedError
 
+    def stream( self, items, extra=None ):
+        """
+        Emit a list of serialized objects piece by piece, yielding chunks of
+        the output. If extra is given, the list is emitted as the "results"
+        member of a dictionary with the members of extra.
+
+        By default, the whole output is emitted at once.
+        """
+        data = list( items )
+        if extra is not None:
+            data = dict( extra, results=data )
+        yield self.emit( Serialization( data ) )
+
     def response( self, response ):
         return response
 
@@ -239,6 +395,25 @@ class JSONEmitter( Emitter ):
     def emit( self, serialization ):
         return json.dumps( serialization.data, default=self.default_encode )
 
+    def stream( self, items, extra=None ):
+        encoder = json.JSONEncoder( default=self.default_encode )
+
+        if extra is not None:
+            yield '{'
+            for k, v in extra.items():
+                yield '%s: %s, ' % ( encoder.encode( k ), encoder.encode( v ) )
+            yield '"results": '
+
+        yield '['
+        for i, data in enumerate( items ):
+            if i:
+                yield ', '
+            yield encoder.encode( data )
+        yield ']'
+
+        if extra is not None:
+            yield '}'
+
     def default_encode( self, v ):
         if hasattr( v, 'as_json' ) and callable( v.as_json ):
             return v.as_json()
@@ -261,32 +436,51 @@ class ICalEmitter( Emitter ):
     name = "ical"
     content_type = "text/calendar"
 
-    def emit( self, serialization ):
+    def _calendar( self ):
         try:
-            from icalendar import Calendar, Event
-            from icalendar import vText
+            from icalendar import Calendar
         except ImportError:
             raise SerializationError( "iCalendar module could not be loaded." )
 
         cal = Calendar()
         cal.add( 'prodid', '-//European Southern Observatory//Djangoplicity//EN' )
         cal.add( 'version', '2.0' )
+        return cal
 
-        for e in serialization.data:
-            event = Event()
-            event.add( 'summary', smart_unicode( e['summary'] ) )
-            event.add( 'description', smart_unicode( e['description'] ) )
-            event.add( 'dtstart', e['dtstart'] )
-            event.add( 'dtend', e['dtend'] )
-            event.add( 'dtstamp', e['dtstamp'] )
+    def _event( self, e ):
+        from icalendar import Event, vText
 
-            if 'location' in e:
-                event['location'] = vText( smart_unicode( e['location'] ) )
+        event = Event()
+        event.add( 'summary', smart_unicode( e['summary'] ) )
+        event.add( 'description', smart_unicode( e['description'] ) )
+        event.add( 'dtstart', e['dtstart'] )
+        event.add( 'dtend', e['dtend'] )
+        event.add( 'dtstamp', e['dtstamp'] )
 
-            cal.add_component( event )
+        if 'location' in e:
+            event['location'] = vText( smart_unicode( e['location'] ) )
+
+        return event
+
+    def emit( self, serialization ):
+        cal = self._calendar()
+
+        for e in serialization.data:
+            cal.add_component( self._event( e ) )
 
         return cal.as_string()
 
+    def stream( self, items, extra=None ):
+        # The events are written between the calendar's properties and its
+        # END line.
+        content = self._calendar().as_string()
+        end = content.rindex( 'END:VCALENDAR' )
+
+        yield content[:end]
+        for e in items:
+            yield self._event( e ).as_string()
+        yield content[end:]
+
     def response( self, response ):
         response['Content-Disposition'] = "attachment; filename=calendar.ics"
         return response
@@ -16,6 +16,7 @@ from django.contrib.sites.models import Site
 from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.http import Http404
+from djangoplicity.archives.resources import prefetch_resources
 from djangoplicity.feeds import conf as feedsconf
 from djangoplicity.feeds.feeds import DjangoplicityFeed
 
@@ -46,6 +47,7 @@ class DjangoplicityArchiveFeed( DjangoplicityFeed ):
         options = None
         latest_fieldname = None
         enclosure_resources = { '': None }
+        resources = ()  # Other resources used by the feed, see resource_formats()
         default_query = None
         category_query = None
         items_to_display = 25
@@ -136,13 +138,39 @@ class DjangoplicityArchiveFeed( DjangoplicityFeed ):
             qs, _b = self.Meta.default_query.queryset( self.Meta.model, self.Meta.options, None )
             if not self.Meta.include_unpublished and self.Meta.model.Archive.Meta.published:
                 qs = qs.filter( published=True )
-            return qs.order_by( '-' + self.Meta.latest_fieldname )[:self.Meta.items_to_display]
+            return self.prefetch( qs.order_by( '-' + self.Meta.latest_fieldname )[:self.Meta.items_to_display] )
 
         else:  # category feed
             qs, _b = self.Meta.category_query.queryset( self.Meta.model, self.Meta.options, None, stringparam=self.category )
             if not self.Meta.include_unpublished and self.Meta.model.Archive.Meta.published:
                 qs = qs.filter( published=True )
-            return qs.order_by( '-' + self.Meta.latest_fieldname )[:self.Meta.items_to_display]
+            return self.prefetch( qs.order_by( '-' + self.Meta.latest_fieldname )[:self.Meta.items_to_display] )
+
+    def resource_formats( self ):
+        """
+        Returns the resources used by the feed: the enclosure resources and
+        Meta.resources (e.g. used in item_link)
+        """
+        prefix = self.Meta.model.Archive.Meta.resource_fields_prefix
+        formats = set( getattr( self.Meta, 'resources', () ) )
+
+        for names in self.Meta.enclosure_resources.values():
+            if not names:
+                continue
+            if not isinstance( names, list ):
+                names = [names]
+            formats.update( [n[len( prefix ):] for n in names if n.startswith( prefix )] )
+
+        return list( formats )
+
+    def prefetch( self, items ):
+        """
+        Evaluates the items and resolves their resources at once instead of
+        item by item (see prefetch_resources)
+        """
+        items = list( items )
+        prefetch_resources( items, self.resource_formats() )
+        return items
 
     def _get_resource( self, item ):
         """
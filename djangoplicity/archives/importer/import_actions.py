@@ -44,7 +44,7 @@ def move_resources( taskset, model, options, obj, data, form_values, conf={}, re
     """
     if not reimport:
         exclude_formats = obj.locked_resources()
-        taskset.add( "archives.move_resources", args=[conf['import_root'], conf['archive_root']], kwargs={ 'archive_id': obj.pk, 'exclude': exclude_formats } )
+        taskset.add( "archives.move_resources", args=[conf['import_root'], conf['archive_root']], kwargs={ 'archive_id': obj.pk, 'exclude': exclude_formats, 'app_label': obj._meta.app_label, 'module_name': obj._meta.model_name } )
     return taskset, conf
 
 
@@ -73,7 +73,7 @@ def rename_resource_ext( fmt, old_ext, new_ext ):
             src = os.path.join( fmt_path, obj.pk + '.%s' % old_ext )
             dst = os.path.splitext( src )[0] + '.%s' % new_ext
 
-            taskset.add( 'archives.move_file', args=[ src, dst ] )
+            taskset.add( 'archives.move_file', args=[ src, dst ], kwargs={ 'archive_id': obj.pk, 'app_label': obj._meta.app_label, 'module_name': obj._meta.model_name, 'fmt': fmt } )
         return taskset, conf
     return action
 
@@ -0,0 +1,104 @@
+import time
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from djangoplicity.archives.base import ArchiveModel
+from djangoplicity.archives.checksums import DEFAULT_MIN_SIZE, \
+    checksum_value, compute_instance_checksums, hash_files, resource_files, \
+    store_checksums
+from djangoplicity.translation.models import TranslationModel
+
+
+class Command(BaseCommand):
+    help = 'Compute missing or outdated checksums of archive resources, or verify them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='*', metavar='app_label.ModelName',
+            help='Archive models to process (default: all)')
+        parser.add_argument('--verify', action='store_true',
+            help='Hash all files again and report checksums which don\'t match, without updating them')
+        parser.add_argument('--force', action='store_true',
+            help='Recompute checksums even if the files didn\'t change')
+        parser.add_argument('--min-size', type=int, default=DEFAULT_MIN_SIZE,
+            help='Minimum size of the files to hash (default: %d)' % DEFAULT_MIN_SIZE)
+        parser.add_argument('--threads', type=int, default=None,
+            help='Number of files hashed concurrently')
+
+    def handle(self, *args, **options):
+        if options['models']:
+            try:
+                models = [apps.get_model(label) for label in options['models']]
+            except (LookupError, ValueError) as e:
+                raise CommandError(e)
+        else:
+            models = [
+                m for m in apps.get_models()
+                if issubclass(m, ArchiveModel) and not m._meta.proxy and
+                    any(f.name == 'checksums' for f in m._meta.fields)
+            ]
+
+        self.start = time.time()
+        self.total_files = 0
+        self.total_bytes = 0
+        self.errors = 0
+
+        for model in models:
+            qs = model.objects.all()
+            if issubclass(model, TranslationModel):
+                qs = qs.filter(source__isnull=True)
+
+            count = qs.count()
+            for i, instance in enumerate(qs.iterator(), 1):
+                try:
+                    if options['verify']:
+                        self.verify(instance, options)
+                    else:
+                        self.update(instance, options)
+                except (IOError, OSError) as e:
+                    self.errors += 1
+                    self.stderr.write('%s %s: %s' % (model._meta.label, instance.pk, e))
+
+                if i % 100 == 0 or i == count:
+                    self.stdout.write('%s: %d/%d items, %s' % (model._meta.label, i, count, self.throughput()))
+
+        self.stdout.write('Done: %d files, %s' % (self.total_files, self.throughput()))
+
+        if self.errors:
+            raise CommandError('%d errors' % self.errors)
+
+    def throughput(self):
+        elapsed = max(time.time() - self.start, 0.001)
+        mb = self.total_bytes / 2.0**20
+        return '%.1f MB hashed in %.1fs (%.1f MB/s)' % (mb, elapsed, mb / elapsed)
+
+    def update(self, instance, options):
+        checksums, hashed = compute_instance_checksums(instance,
+            min_size=options['min_size'], incremental=not options['force'],
+            processes=options['threads'])
+        store_checksums(instance, checksums)
+
+        self.total_files += len(hashed)
+        self.total_bytes += sum(hashed.values())
+
+        if options['verbosity'] > 1:
+            for r_name in sorted(hashed):
+                self.stdout.write('%s %s (%s): %s' % (type(instance)._meta.label,
+                    instance.pk, r_name, checksum_value(checksums[r_name])))
+
+    def verify(self, instance, options):
+        current = instance.checksums or {}
+        files = dict(
+            (r_name, path_st)
+            for r_name, path_st in resource_files(instance, min_size=options['min_size']).items()
+            if r_name in current
+        )
+        digests = hash_files([path for (path, st) in files.values()], options['threads'])
+
+        for r_name, (path, st) in sorted(files.items()):
+            self.total_files += 1
+            self.total_bytes += st.st_size
+            if digests[path] != checksum_value(current[r_name]):
+                self.errors += 1
+                self.stderr.write('%s %s (%s): checksum mismatch for %s' % (
+                    type(instance)._meta.label, instance.pk, r_name, path))
@@ -0,0 +1,40 @@
+from django.apps import apps
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from djangoplicity.archives.base import ArchiveModel
+from djangoplicity.archives.resources import update_resource_manifest
+from djangoplicity.translation.models import TranslationModel
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the resource manifest of archive items from the file system'
+
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='*', metavar='app_label.ModelName',
+            help='Archive models to rebuild (default: all)')
+
+    def handle(self, *args, **options):
+        if not getattr(settings, 'ARCHIVE_RESOURCE_MANIFEST', False):
+            raise CommandError('settings.ARCHIVE_RESOURCE_MANIFEST is not enabled')
+
+        if options['models']:
+            try:
+                models = [apps.get_model(label) for label in options['models']]
+            except (LookupError, ValueError) as e:
+                raise CommandError(e)
+        else:
+            models = [
+                m for m in apps.get_models()
+                if issubclass(m, ArchiveModel) and not m._meta.proxy
+            ]
+
+        for model in models:
+            count = 0
+            for instance in model.objects.all().iterator():
+                if isinstance(instance, TranslationModel) and instance.is_translation():
+                    continue
+                update_resource_manifest(instance)
+                count += 1
+
+            self.stdout.write('%s: updated %d manifests' % (model._meta.label, count))
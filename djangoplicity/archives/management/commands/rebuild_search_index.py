@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from djangoplicity.archives.contrib.search.backends import get_search_backend, \
+    DefaultSearchBackend
+from djangoplicity.archives.loading import get_archives
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text search index of the archives'
+
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='*', metavar='app_label.ModelName',
+            help='Archive models to index (default: all)')
+
+    def handle(self, *args, **options):
+        archives = get_archives()
+
+        if options['models']:
+            labels = set(options['models'])
+            archives = [(m, o) for (m, o) in archives if m._meta.label in labels]
+            if len(archives) != len(labels):
+                raise CommandError('Unknown archive models: %s' % ', '.join(
+                    labels - set(m._meta.label for (m, o) in archives)))
+
+        for model, model_options in archives:
+            backend = get_search_backend(model_options)
+            if isinstance(backend, DefaultSearchBackend):
+                self.stdout.write('%s: %s doesn\'t use an index' % (model._meta.label, backend.__class__.__name__))
+                continue
+
+            count = 0
+            for instance in model.objects.all().iterator():
+                backend.index(model_options, instance)
+                count += 1
+
+            self.stdout.write('%s: indexed %d items' % (model._meta.label, count))
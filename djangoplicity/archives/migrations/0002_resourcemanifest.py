@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('archives', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ResourceManifest',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('root', models.CharField(max_length=255)),
+                ('archive_id', models.CharField(max_length=255)),
+                ('resources', django.contrib.postgres.fields.jsonb.JSONField(default=dict)),
+                ('last_modified', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='resourcemanifest',
+            unique_together=set([('root', 'archive_id')]),
+        ),
+    ]
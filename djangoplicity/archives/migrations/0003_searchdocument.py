@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        schema_editor.execute('ALTER TABLE archives_searchdocument ADD COLUMN vector tsvector')
+        schema_editor.execute('CREATE INDEX archives_searchdocument_vector ON archives_searchdocument USING gin(vector)')
+    elif vendor == 'sqlite':
+        schema_editor.execute(
+            "CREATE VIRTUAL TABLE archives_searchdocument_fts USING fts5("
+            "title, body, tokenize='unicode61 remove_diacritics 1')"
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE IF EXISTS archives_searchdocument_fts')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('archives', '0002_resourcemanifest'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchDocument',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('db_table', models.CharField(max_length=255)),
+                ('object_id', models.CharField(max_length=255)),
+                ('lang', models.CharField(blank=True, max_length=7)),
+                ('title', models.TextField(blank=True)),
+                ('body', models.TextField(blank=True)),
+                ('last_modified', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='searchdocument',
+            unique_together=set([('db_table', 'object_id')]),
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,59 @@
+# Djangoplicity
+# Copyright 2007-2008 ESA/Hubble
+#
+# Authors:
+#   Lars Holm Nielsen <lnielsen@eso.org>
+#   Luis Clara Gomes <lcgomes@eso.org>
+#
+
+from django.contrib.postgres.fields import JSONField
+from django.db import models
+
+
+class ResourceManifest( models.Model ):
+    """
+    Resource files of an archive item, stored so that looking up resources
+    doesn't require accessing the file system (see
+    djangoplicity.archives.resources.update_resource_manifest).
+
+    Items are identified by the archive root and archive id, as resources
+    are stored as <root>/<format>/<id>.<ext>. The resources are stored as
+    a dictionary: format -> {'ext', 'size', 'mtime', 'checksum'}
+
+    The resources are stored in a PostgreSQL JSON field, the manifest
+    (settings.ARCHIVE_RESOURCE_MANIFEST) requires PostgreSQL.
+    """
+    root = models.CharField( max_length=255 )
+    archive_id = models.CharField( max_length=255 )
+    resources = JSONField( default=dict )
+    last_modified = models.DateTimeField( auto_now=True )
+
+    class Meta:
+        unique_together = ( 'root', 'archive_id' )
+
+    def __unicode__( self ):
+        return u'%s%s' % ( self.root, self.archive_id )
+
+
+class SearchDocument( models.Model ):
+    """
+    Text of an archive item indexed by the full-text search backends (see
+    djangoplicity.archives.contrib.search.backends). Translations are indexed
+    as separate items.
+
+    Items are identified by the database table of their archive and their
+    primary key. The backends maintain their own index next to this table
+    (a tsvector column on PostgreSQL, an FTS5 table on SQLite).
+    """
+    db_table = models.CharField( max_length=255 )
+    object_id = models.CharField( max_length=255 )
+    lang = models.CharField( max_length=7, blank=True )
+    title = models.TextField( blank=True )
+    body = models.TextField( blank=True )
+    last_modified = models.DateTimeField( auto_now=True )
+
+    class Meta:
+        unique_together = ( 'db_table', 'object_id' )
+
+    def __unicode__( self ):
+        return u'%s:%s' % ( self.db_table, self.object_id )
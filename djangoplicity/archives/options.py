@@ -7,14 +7,12 @@
 #   Lars Holm Nielsen <lnielsen@eso.org>
 #   Luis Clara Gomes <lcgomes@eso.org>
 
-import operator
-
 from django.conf import settings
 from django.conf.urls import url
 from django.core.exceptions import ImproperlyConfigured
-from django.db import connection, models
 from django.shortcuts import redirect
 
+from djangoplicity.archives.contrib.search.backends import get_search_backend
 from djangoplicity.archives.contrib.search.queryparser import \
     AstronomyQueryParser
 from djangoplicity.archives.views import archive_detail
@@ -38,6 +36,26 @@ class ArchiveOptions(object):
     # Enables cache for detail views
     allow_detail_cache = True
 
+    # Enables stale-while-revalidate for the detail and list views caches:
+    # once a cached page is older than cache_soft_ttl seconds (or has been
+    # invalidated), one request re-renders it while concurrent requests are
+    # served the stale page for up to cache_stale_ttl seconds.
+    # cache_lock_timeout is the maximum time allowed for the re-rendering
+    # before another request takes over.
+    cache_stale_while_revalidate = False
+    cache_soft_ttl = 60 * 5
+    cache_stale_ttl = 60 * 60
+    cache_lock_timeout = 30
+
+    # Cache timeout in seconds for list pages of keyword searches. By default
+    # searches are not cached.
+    search_cache_timeout = 0
+
+    # Dotted path to the search backend class, by default
+    # settings.ARCHIVE_SEARCH_BACKEND (see
+    # djangoplicity.archives.contrib.search.backends)
+    search_backend = None
+
     # The default template for the downloadable resources - template
     # will be included in other templates
     description_template = 'archives/object_description.html'
@@ -287,67 +305,4 @@ class ArchiveOptions(object):
 
         criteria = queryparserclass.parse( searchstr )
 
-        # Apply search criteria.
-        mandatory = []
-        nonmandatory = []
-
-        for c in criteria:
-            # mandatory.append( c )
-            if c.is_mandatory():
-                mandatory.append( c )
-            else:
-                nonmandatory.append( c )
-
-        # Build search query (helper mehtods)
-        def construct_search( field_name ):
-            if connection.vendor == 'postgresql' and \
-                    'django.contrib.postgres' in settings.INSTALLED_APPS:
-                # Use Postgres Unaccent module
-                field_name = field_name + '__unaccent'
-
-            if field_name.startswith('^'):
-                return "%s__istartswith" % field_name[1:]
-            elif field_name.startswith('='):
-                return "%s__iexact" % field_name[1:]
-            elif field_name.startswith('@'):
-                return "%s__search" % field_name[1:]
-            else:
-                return "%s__icontains" % field_name
-
-        def construct_criteria_search( criteria ):
-            or_queries = [models.Q( **{ construct_search( str( field_name ) ): criteria.keyword } ) for field_name in cls.search_fields]
-            or_queries = reduce(operator.or_, or_queries)
-            return or_queries
-
-        # TODO: take care of several search_fields. Currently only takes care of a single search field.
-
-        # Mandatory keywords (AND'ed together and can possibly be negated)
-        and_queries_incl = []
-        and_queries_excl = []
-        for c in mandatory:
-            if c.is_include():
-                and_queries_incl.append( construct_criteria_search( c ) )
-            else:
-                and_queries_excl.append( construct_criteria_search( c ) )
-
-        if and_queries_incl:
-            qs = qs.filter( reduce(operator.and_, and_queries_incl) )
-
-        if and_queries_excl:
-            qs = qs.exclude( reduce(operator.and_, and_queries_excl) )
-
-        # Non-mandatory keywords (OR'ed together)
-        or_queries = []
-        for c in nonmandatory:
-            or_queries.append( construct_criteria_search( c ) )
-
-        if or_queries:
-            qs = qs.filter( reduce(operator.or_, or_queries) )
-
-        # Ensure proper results when search related models as well.
-        for field_name in cls.search_fields:
-            if '__' in field_name:
-                qs = qs.distinct()
-                break
-
-        return qs
+        return get_search_backend( cls ).search( cls, qs, criteria )
@@ -101,6 +101,25 @@ class ArchiveQuery(object):
                         order.append( f )
         return order
 
+    def cache_params( self, model, request ):
+        """
+        Hook to determine the GET parameters the list view can be cached on
+        (in addition to the ones declared by the browser). Pages requested
+        with any other GET parameter are not cached.
+
+        Return None if pages requested with GET parameters should never be
+        cached.
+        """
+        params = []
+        sort_fields = self.sort_fields if self.sort_fields else ( model.Archive.Meta.sort_fields if hasattr( model.Archive.Meta, 'sort_fields') else [] )
+
+        if sort_fields:
+            params.append( 'sort' )
+        if self.viewmode_param is not None:
+            params.append( self.viewmode_param )
+
+        return params
+
     def queryset(self, model, options, request, only_source=False, mode='fallback', **kwargs ):
         """
         Hook to specify the queryset for this query.
@@ -7,26 +7,31 @@
 
 import logging
 import os.path
+import time
 
 from django.conf import settings
 from django.contrib.sites.models import Site
+from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
 from django.core.files.images import ImageFile
 from django.core.files import File
 from django.core.files.storage import FileSystemStorage
-from django.db import models
+from django.db import models, transaction
 from django.utils.encoding import smart_unicode, smart_str
 from django.utils.translation import ugettext_lazy as _, ugettext_noop
 
+from djangoplicity.archives.checksums import checksum_value
 from djangoplicity.media.consts import MEDIA_CONTENT_SERVERS
 from djangoplicity.translation.models import TranslationModel
+from djangoplicity.utils.cachekeys import digest
 
 logger = logging.getLogger(__name__)
 
 __all__ = (
     'FileType', 'ImageFileType', 'ResourceFile', 'ImageResourceFile',
     'ResourceManager', 'ImageResourceManager', 'get_instance_resource',
-    'ResourceError'
+    'ResourceError', 'update_resource_manifest', 'delete_resource_manifest',
+    'prefetch_resources', 'mark_resources_ready', 'wait_for_resources_ready'
 )
 
 
@@ -67,6 +72,323 @@ def get_instance_resource( obj, resource_name ):
     return getattr( obj, resattr )
 
 
+#
+# Resource manifest
+#
+# With settings.ARCHIVE_RESOURCE_MANIFEST enabled, the resources of each
+# archive item are looked up in a ResourceManifest instead of checking on the
+# file system which file exists for each format and extension. The tasks
+# creating, moving and deleting resources update the manifest, and items
+# without manifest are scanned (and their manifest stored) on first access.
+#
+# Like the checksums of the archive items, the manifest is stored in a
+# PostgreSQL JSON field: the manifest requires PostgreSQL.
+#
+def _manifest_enabled():
+    return getattr( settings, 'ARCHIVE_RESOURCE_MANIFEST', False )
+
+
+def _source_instance( instance ):
+    """ Return the instance owning the resources (the source for translations) """
+    if settings.USE_I18N and isinstance( instance, TranslationModel ) and instance.is_translation():
+        return instance.source
+    return instance
+
+
+def _resource_managers( instance, formats=None ):
+    """ Return a list of (name, resource manager) of the instance's archive """
+    managers = []
+    for name in dir( instance.Archive ):
+        rm = getattr( instance.Archive, name, None )
+        if isinstance( rm, ResourceManager ) and ( formats is None or name in formats ):
+            managers.append( ( name, rm ) )
+    return managers
+
+
+def _scan_resource( instance, name, exts, revalidate=False ):
+    """
+    Look for the file of the resource 'name' on the file system, and return
+    its manifest entry (or None if it doesn't exist)
+
+    If revalidate is True files are opened to get their current attributes,
+    as NFS clients only revalidate their attributes cache when opening files.
+    """
+    localbase = os.path.join( _root_for_instance( instance, name ), _archive_instance_id( instance ) )
+    storage = FileSystemStorage()
+
+    for ext in list( exts ) + [None]:
+        path = storage.path( localbase if ext is None else '%s.%s' % ( localbase, ext ) )
+        try:
+            st = os.stat( path )
+            isdir = os.path.isdir( path )
+            if revalidate and not isdir:
+                fd = os.open( path, os.O_RDONLY )
+                try:
+                    st = os.fstat( fd )
+                finally:
+                    os.close( fd )
+        except OSError:
+            continue
+
+        return {
+            'ext': ext,
+            'size': None if isdir else st.st_size,
+            'mtime': st.st_mtime,
+            'checksum': None,
+        }
+
+    return None
+
+
+def scan_resources( instance, formats=None ):
+    """
+    Return the manifest entries (format -> entry or None) of the instance's
+    resources as found on the file system.
+    """
+    instance = _source_instance( instance )
+    return dict( [( name, _scan_resource( instance, name, rm.exts ) ) for name, rm in _resource_managers( instance, formats )] )
+
+
+def get_resource_manifest( instance ):
+    """
+    Return the resources manifest (format -> entry) of an instance, the
+    manifest is created if it doesn't exist yet. The result is cached on the
+    instance until clear_resource_cache() is called.
+    """
+    manifest = getattr( instance, '_resource_manifest', None )
+    if manifest is None:
+        from djangoplicity.archives.models import ResourceManifest
+
+        source = _source_instance( instance )
+        try:
+            manifest = ResourceManifest.objects.get( root=source.Archive.Meta.root, archive_id=_archive_instance_id( source ) ).resources
+        except ResourceManifest.DoesNotExist:
+            manifest = update_resource_manifest( source )
+        instance._resource_manifest = manifest
+
+    return manifest
+
+
+def update_resource_manifest( instance, formats=None ):
+    """
+    Update the manifest of the instance's resources from the file system,
+    for all formats or only the given ones. Must be called whenever resources
+    files are added, modified, moved or deleted.
+
+    If the manifest is disabled, only the instance's resource cache is
+    cleared.
+    """
+    from djangoplicity.archives.models import ResourceManifest
+
+    if not _manifest_enabled():
+        if hasattr( instance, 'clear_resource_cache' ):
+            instance.clear_resource_cache()
+        return None
+
+    instance = _source_instance( instance )
+    checksums = getattr( instance, 'checksums', None ) or {}
+
+    with transaction.atomic():
+        manifest, created = ResourceManifest.objects.get_or_create( root=instance.Archive.Meta.root, archive_id=_archive_instance_id( instance ) )
+        if created:
+            formats = None
+        else:
+            # Tasks update different formats of the same item concurrently
+            # (e.g. derivatives and checksums), lock the row so that none of
+            # the updates is lost
+            manifest = ResourceManifest.objects.select_for_update().get( pk=manifest.pk )
+
+        for name, entry in scan_resources( instance, formats ).items():
+            if entry is None:
+                manifest.resources.pop( name, None )
+            else:
+                entry['checksum'] = checksum_value( checksums.get( name ) )
+                manifest.resources[name] = entry
+
+        manifest.save()
+
+    if hasattr( instance, 'clear_resource_cache' ):
+        instance.clear_resource_cache()
+    instance._resource_manifest = manifest.resources
+
+    return manifest.resources
+
+
+def delete_resource_manifest( instance ):
+    """
+    Delete the manifest of the instance's resources (translations don't
+    have their own manifest)
+    """
+    from djangoplicity.archives.models import ResourceManifest
+
+    if not _manifest_enabled() or _source_instance( instance ) is not instance:
+        return
+
+    ResourceManifest.objects.filter( root=instance.Archive.Meta.root, archive_id=_archive_instance_id( instance ) ).delete()
+
+
+#
+# Resource readiness
+#
+# Tasks writing resources record the size and modification time of the files
+# (mark_resources_ready). The next task of an import, possibly running on a
+# server whose NFS client hasn't caught up yet, waits until it sees the same
+# files (wait_for_resources_ready) instead of sleeping for a fixed time.
+#
+# Each format is recorded under its own cache key, so tasks writing different
+# formats of the same item concurrently can't overwrite each other's entries.
+#
+READY_KEY_PREFIX = 'djangoplicity.archives_resources_ready_'
+READY_TIMEOUT = 60 * 60 * 24
+READY_MAX_DELAY = 5
+
+
+def _ready_key( instance, name ):
+    instance = _source_instance( instance )
+    return '%s%s' % ( READY_KEY_PREFIX, digest( instance.Archive.Meta.root, _archive_instance_id( instance ), name ) )
+
+
+def _ready_expected( instance, formats=None ):
+    """
+    Return the recorded entries (format -> entry or None) of the instance's
+    resources (all or the given formats). Formats which were not recorded
+    are left out.
+    """
+    keys = dict( [( _ready_key( instance, name ), name ) for name, rm in _resource_managers( instance, formats )] )
+    # Entries are stored wrapped in a tuple, to tell a recorded missing
+    # resource (None) from a format which wasn't recorded.
+    return dict( [( keys[key], value[0] ) for key, value in cache.get_many( keys.keys() ).items()] )
+
+
+def _is_ready( instance, name, expected ):
+    rm = getattr( instance.Archive, name )
+    current = _scan_resource( _source_instance( instance ), name, rm.exts, revalidate=True )
+
+    if name not in expected:
+        return current is not None
+
+    entry = expected[name]
+    if entry is None or current is None:
+        return entry is current
+
+    return current['ext'] == entry['ext'] and current['size'] == entry['size'] and \
+        int( current['mtime'] ) == int( entry['mtime'] )
+
+
+def mark_resources_ready( instance, formats=None ):
+    """
+    Record the current state of the instance's resources (all or the given
+    formats), to be called by a task once it's done writing or renaming them.
+    """
+    entries = scan_resources( instance, formats )
+    cache.set_many( dict( [( _ready_key( instance, name ), ( entry, ) ) for name, entry in entries.items()] ), READY_TIMEOUT )
+
+
+def wait_for_resources_ready( instance, formats=None, timeout=120 ):
+    """
+    Wait until the instance's resources (the given formats or all the ones
+    recorded) are seen as recorded by mark_resources_ready(), or, for formats
+    which were not recorded, until they exist. Checks are retried with an
+    exponential backoff.
+
+    Returns True if the resources are ready, False if they are not after
+    timeout seconds. In both cases the resource cache of the instance is
+    cleared.
+    """
+    expected = _ready_expected( instance, formats )
+    if formats is None:
+        formats = expected.keys()
+
+    pending = list( formats )
+    deadline = time.time() + timeout
+    delay = 0.1
+
+    while True:
+        pending = [name for name in pending if not _is_ready( instance, name, expected )]
+        if not pending:
+            break
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            logger.warning( 'Resources %s for "%s" not ready after %ss', ', '.join( pending ), instance.pk, timeout )
+            break
+
+        time.sleep( min( delay, remaining ) )
+        delay = min( delay * 2, READY_MAX_DELAY )
+
+    update_resource_manifest( instance, formats )
+
+    return not pending
+
+
+def prefetch_resources( objects, formats=() ):
+    """
+    Resolve the resources of a list of archive items (e.g. a list page) at
+    once instead of item by item:
+
+    * With the resource manifest, the manifests of all items are loaded with
+      a single query.
+    * Otherwise the directory of each of the given formats is listed once
+      and the resource cache of the items filled for these formats.
+    """
+    objects = [obj for obj in objects if hasattr( obj, 'Archive' )]
+    if not objects:
+        return
+
+    if _manifest_enabled():
+        from djangoplicity.archives.models import ResourceManifest
+
+        ids = {}
+        for obj in objects:
+            if getattr( obj, '_resource_manifest', None ) is None:
+                source = _source_instance( obj )
+                ids.setdefault( ( source.Archive.Meta.root, _archive_instance_id( source ) ), [] ).append( obj )
+
+        roots = set( [root for root, _archive_id in ids] )
+        for root in roots:
+            manifests = ResourceManifest.objects.filter( root=root, archive_id__in=[a for r, a in ids if r == root] )
+            for manifest in manifests:
+                for obj in ids[( root, manifest.archive_id )]:
+                    obj._resource_manifest = manifest.resources
+        # Items without manifest get one on first access
+        return
+
+    storage = FileSystemStorage()
+    model = objects[0].__class__
+
+    for name in formats:
+        rm = getattr( model.Archive, name, None )
+        if not isinstance( rm, ResourceManager ):
+            continue
+
+        listings = {}
+        for obj in objects:
+            if name in getattr( obj, '_resource_cache', {} ):
+                continue
+
+            root = _root_for_instance( obj, name )
+            if root not in listings:
+                try:
+                    listings[root] = set( os.listdir( storage.path( root ) ) )
+                except OSError:
+                    listings[root] = set()
+            files = listings[root]
+
+            archive_id = _archive_instance_id( obj )
+            located = ( False, None )
+            for ext in rm.exts:
+                if '%s.%s' % ( archive_id, ext ) in files:
+                    located = ( True, ext )
+                    break
+            else:
+                if archive_id in files:
+                    located = ( True, None )
+
+            if not hasattr( obj, '_resource_cache' ):
+                obj._resource_cache = {}
+            obj._resource_cache[name] = rm.get_resource_for_instance( obj, located=located )
+
+
 class FileType(object):
     """
     Metadata for a specific file type of a file resource. For an derived image
@@ -228,9 +550,12 @@ class ResourceManager(object):
     def __repr__(self):
         return "<%s: %s>" % (self.__class__.__name__, self or "None")
 
-    def get_resource_for_instance( self, instance, fileclass=ResourceFile ):
+    def get_resource_for_instance( self, instance, fileclass=ResourceFile, located=None ):
         """
         Hook for getting the file (resource) for a model instance (can be any model instance).
+
+        located - (exists, ext) if the file has already been looked up, e.g.
+        by prefetch_resources()
         """
         # Note 'name' has been ingested into the ResourceManager by ArchiveBase
         localbase = os.path.join( _root_for_instance( instance, self.name ), _archive_instance_id( instance ) )
@@ -241,17 +566,31 @@ class ResourceManager(object):
         # Identify the file extension if any
         ext = None
         name = base
-        for e in self.exts:
-            name = '%s.%s' % (base, e)
-            localname = '%s.%s' % (localbase, e)
-            if storage.exists(localname):
-                ext = e
+        if located is None and _manifest_enabled():
+            entry = get_resource_manifest( instance ).get( self.name )
+            if entry is not None:
+                located = ( True, entry['ext'] )
+            else:
+                located = ( False, None )
+
+        if located is not None:
+            exists, ext = located
+            if exists:
+                if ext:
+                    name = '%s.%s' % (base, ext)
                 resource = fileclass(name, storage)
-                break
         else:
-            if storage.exists(localbase):
-                # No extension, but the file exists
-                resource = fileclass(name, storage)
+            for e in self.exts:
+                name = '%s.%s' % (base, e)
+                localname = '%s.%s' % (localbase, e)
+                if storage.exists(localname):
+                    ext = e
+                    resource = fileclass(name, storage)
+                    break
+            else:
+                if storage.exists(localbase):
+                    # No extension, but the file exists
+                    resource = fileclass(name, storage)
 
         # Check whether a content server is defined for this resource
         if resource and hasattr(instance, 'content_server') and instance.content_server and instance.content_server_ready:
@@ -302,11 +641,11 @@ class ImageResourceManager( ResourceManager ):
 
         super( ImageResourceManager, self ).__init__( *args, **kwargs )
 
-    def get_resource_for_instance( self, instance, fileclass=ImageResourceFile ):
+    def get_resource_for_instance( self, instance, fileclass=ImageResourceFile, located=None ):
         """
         Hook for getting the file for this specific resource.
         """
-        return super( ImageResourceManager, self ).get_resource_for_instance( instance, fileclass=ImageResourceFile )
+        return super( ImageResourceManager, self ).get_resource_for_instance( instance, fileclass=ImageResourceFile, located=located )
 
 
 class AudioResourceManager(ResourceManager):
@@ -8,28 +8,30 @@
 
 from __future__ import with_statement
 import glob
-import hashlib
 import os
 import shutil
-import time
 
 from celery import current_app
 from celery import task
 from celery.utils.log import get_task_logger
 from django.apps import apps
-from django.conf import settings
-from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
 
+from djangoplicity.archives.checksums import DEFAULT_MIN_SIZE, \
+    checksum_value, compute_instance_checksums, store_checksums
+from djangoplicity.archives.caching import GLOBAL_GENERATION, bump_generation
 from djangoplicity.archives.contrib.security import StaticFilesProtectorCache
-from djangoplicity.archives.resources import ResourceManager
+from djangoplicity.archives.resources import update_resource_manifest, \
+    mark_resources_ready, wait_for_resources_ready
 from djangoplicity.celery.serialtaskset import str_keys
 
 
 @task( name="archives.move_file" )
-def move_file( src, dst, overwrite=True, sendtask_callback=None, sendtask_tasksetid=None ):
+def move_file( src, dst, overwrite=True, archive_id=None, app_label=None, module_name=None, fmt=None, sendtask_callback=None, sendtask_tasksetid=None ):
     """
-    Celery task for moving a file on a local file system.
+    Celery task for moving a file on a local file system. If the model of
+    the archive and the format of the file are given, the resource manifest
+    of the archive item is updated.
     """
     logger = move_file.get_logger()
 
@@ -54,6 +56,14 @@ def move_file( src, dst, overwrite=True, sendtask_callback=None, sendtask_taskse
     except Exception, e:
         logger.warning( unicode( e ) )
 
+    if archive_id is not None and app_label and module_name and fmt:
+        try:
+            obj = apps.get_model( app_label, module_name ).objects.get( pk=archive_id )
+            update_resource_manifest( obj, [fmt] )
+            mark_resources_ready( obj, [fmt] )
+        except ObjectDoesNotExist:
+            logger.warning( "Could not find model object %s.%s:%s" % ( app_label, module_name, archive_id ) )
+
     # send_task callback
     if sendtask_callback:
         args, kwargs = sendtask_callback  # pylint: disable=W0633
@@ -61,9 +71,11 @@ def move_file( src, dst, overwrite=True, sendtask_callback=None, sendtask_taskse
 
 
 @task( name="archives.move_resources" )
-def move_resources( src, dst, overwrite=True, archive_id=None, exclude=[], sendtask_callback=None, sendtask_tasksetid=None ):
+def move_resources( src, dst, overwrite=True, archive_id=None, exclude=[], app_label=None, module_name=None, sendtask_callback=None, sendtask_tasksetid=None ):
     """
-    Celery task for moving resources on a local file system.
+    Celery task for moving resources on a local file system. If the model of
+    the archive is given, the resource manifest of the archive item is
+    updated.
     """
     logger = move_resources.get_logger()
 
@@ -102,14 +114,18 @@ def move_resources( src, dst, overwrite=True, archive_id=None, exclude=[], sendt
     if archive_id is None:
         # Remove source directory
         shutil.rmtree( src )
+    elif app_label and module_name:
+        try:
+            obj = apps.get_model( app_label, module_name ).objects.get( pk=archive_id )
+            update_resource_manifest( obj )
+            # Subsequent tasks might run on a different server, they wait
+            # until NFS shows them the moved files
+            mark_resources_ready( obj )
+        except ObjectDoesNotExist:
+            logger.warning( "Could not find model object %s.%s:%s" % ( app_label, module_name, archive_id ) )
 
     # send_task callback
     if sendtask_callback:
-        # We sleep for 30s to give enough time for NFS to catch up in case
-        # subsequent task will run on a different server, otherwise we have the risk
-        # of getting the information from the placeholder file
-        time.sleep(30)
-
         args, kwargs = sendtask_callback  # pylint: disable=W0633
         current_app.send_task( *args, **str_keys( kwargs ) )
 
@@ -143,6 +159,8 @@ def delete_resources( app_label, module_name, object_id, resources, sendtask_cal
             except Exception:
                 logger.error( "Error while deleting resource %s for model object %s.%s:%s" % ( r, app_label, module_name, object_id ) )
 
+        update_resource_manifest( obj, resources )
+
     # send_task callback
     if sendtask_callback:
         args, kwargs = sendtask_callback  # pylint: disable=W0633
@@ -214,11 +232,7 @@ def clear_archive_list_cache():
     '''
     Clear the cache for all archive list views
     '''
-    global_keylist_key = 'global_cache_keys'
-    cache_keys = cache.get(global_keylist_key)
-    if cache_keys:
-        cache.delete_many(cache_keys)
-        cache.delete(global_keylist_key)
+    bump_generation(GLOBAL_GENERATION)
     StaticFilesProtectorCache.run_async()
 
 
@@ -244,11 +258,13 @@ def embargo_release_date_task(app_label, module_name, object_id, typ):
 
 
 @task
-def compute_checksums(app_label, module_name, pk, min_size=104857600,
-        formats=None, sendtask_callback=None, sendtask_tasksetid=None):
+def compute_checksums(app_label, module_name, pk, min_size=DEFAULT_MIN_SIZE,
+        formats=None, incremental=True, sendtask_callback=None, sendtask_tasksetid=None):
     '''
     Computes sha256 checksum for resources files of at least min_size
     If a list of formats is given then only these checkums are updated
+    In incremental mode files which didn't change since their checksum was
+    computed are skipped
     '''
     logger = get_task_logger(__name__)
 
@@ -260,45 +276,17 @@ def compute_checksums(app_label, module_name, pk, min_size=104857600,
         logger.warning("Could not find model object %s.%s:%s" % (app_label, module_name, pk))
         return
 
-    if formats:
-        checksums = instance.checksums
-    else:
-        checksums = {}
-
-    for r_name in dir(instance.Archive):
-        if not isinstance(getattr(instance.Archive, r_name), ResourceManager):
-            continue
-
-        if formats and r_name not in formats:
-            continue
-
-        resource = getattr(instance, 'resource_%s' % r_name)
-
-        # Skip non-file resources (e.g. zoomable):
-        if not resource or not os.path.isfile(resource.path):
-            continue
-
-        # Skip files smaller than min_size
-        if resource.size < min_size:
-            continue
-
-        h = hashlib.sha256()
+    # Make sure we read the latest version of the files if they were written
+    # on another server
+    wait_for_resources_ready(instance, formats)
 
-        with open(resource.path) as f:
-            while True:
-                buf = f.read(2**20)  # Read 1MB at a time
-                if not buf:
-                    break
-                h.update(buf)
+    checksums, hashed = compute_instance_checksums(instance, formats,
+        min_size=min_size, incremental=incremental)
 
-        checksums[r_name] = h.hexdigest()
-        logger.info('Computed checksum for "%s (%s)": %s', pk, r_name, checksums[r_name])
+    for r_name in hashed:
+        logger.info('Computed checksum for "%s (%s)": %s', pk, r_name, checksum_value(checksums[r_name]))
 
-    cls.objects.filter(pk=pk).update(checksums=checksums)
-    if settings.USE_I18N:
-        # Normally this would be done automatically in TranslationModel.save()
-        # But we use update to avoid an infinite task loop
-        cls.objects.filter(source=pk).update(checksums=checksums)
+    store_checksums(instance, checksums)
 
     # send_task callback
     if sendtask_callback:
@@ -8,22 +8,48 @@ from datetime import datetime, timedelta
 from django.contrib.admin.options import get_content_type_for_model
 from django.contrib.auth.models import Permission
 from django.contrib.contenttypes.models import ContentType
-from django.test import override_settings
+from django.core.cache import cache
+from django.test import override_settings, RequestFactory
 import djangoplicity.archives as package
 from djangoplicity.announcements.models import Announcement, AnnouncementImage, AnnouncementProxy
-from djangoplicity.archives.base import resource_deletion_handler, ArchiveModel
+from djangoplicity.archives.base import resource_deletion_handler, ArchiveModel, \
+    clear_views_cache_handler
+from djangoplicity.archives.checksums import checksum_value, \
+    compute_instance_checksums, store_checksums
+from djangoplicity.archives.caching import GLOBAL_GENERATION, get_generation, \
+    stale_get, stale_set, get_stats, CACHE_HIT, CACHE_MISS, CACHE_STALE
+from djangoplicity.archives.tasks import clear_archive_list_cache
 from djangoplicity.archives.contrib.admin import ArchiveAdmin, RenameAdmin
+from djangoplicity.archives.contrib.search.backends import update_search_index, \
+    delete_search_index, get_search_backend
+from djangoplicity.archives.contrib.serialization import JSONEmitter, iter_batches
+from djangoplicity.archives.contrib.security import StaticFilesProtectorCache, \
+    PROTECTED_PATH_KEY, PROTECTED_PATH_LOCK_KEY, EMBARGO, UNPUBLISHED_PERMS
 from djangoplicity.archives.contrib.admin.defaults import TranslationDuplicateAdmin, SyncTranslationAdmin
 from djangoplicity.contrib import admin as dpadmin
-from djangoplicity.archives.resources import ImageResourceManager
-from django.db import models
+from djangoplicity.archives.browsers import ArchiveBrowser
+from djangoplicity.archives.queries import ArchiveQuery
+from djangoplicity.archives.models import ResourceManifest
+from djangoplicity.archives.resources import ImageResourceManager, \
+    update_resource_manifest, prefetch_resources, mark_resources_ready, \
+    wait_for_resources_ready
+from djangoplicity.archives.utils import get_instance_checksum
+from djangoplicity.archives.views import _list_cache_params
+from django.db import connection, models
 from django.contrib.admin.models import ADDITION, CHANGE, DELETION, LogEntry
 from djangoplicity.contrib.admin.sites import AdminSite
 from djangoplicity.media.models.images import Image
+from djangoplicity.media.options import ImageOptions
+from djangoplicity.media.serializers import MiniImageSerializer
+from djangoplicity.metadata.models import SubjectName
 from djangoplicity.test.base_tests import BasicTestCase
 from django.http import HttpRequest
 from django.template import RequestContext, Template
+import hashlib
+import json
 import os
+import shutil
+import tempfile
 from djangoplicity.archives.contrib import types
 
 try:
@@ -83,7 +109,451 @@ class ArchiveInitTestCase(BasicTestCase):
     @override_settings(USE_I18N=False)
     def test_init_archive_app(self):
         cache_key = package._gen_cache_key('public_', 'archive', 5555, 'help')
-        self.assertEqual(cache_key, 'public__7617057745003194269_5555_help')
+        self.assertEqual(cache_key, 'public__617e45847f1b1bf5d57806fa6017fe421639292e_help')
+
+
+class ArchiveCacheGenerationTestCase(BasicTestCase):
+
+    def test_cache_set_get(self):
+        Image.cache_set('test_key', 'content')
+        self.assertEqual(Image.cache_get('test_key'), 'content')
+        self.assertIsNone(Image.cache_get('other_key'))
+
+    def test_clear_views_cache_handler(self):
+        Image.cache_set('test_key', 'content')
+        Announcement.cache_set('test_key', 'content')
+        generation = get_generation(Image.get_cache_key_prefix())
+
+        clear_views_cache_handler(sender=Image, instance=None)
+
+        self.assertNotEqual(get_generation(Image.get_cache_key_prefix()), generation)
+        self.assertIsNone(Image.cache_get('test_key'))
+        self.assertEqual(Announcement.cache_get('test_key'), 'content')
+
+    @patch('djangoplicity.archives.contrib.security.StaticFilesProtectorCache.run_async')
+    def test_clear_archive_list_cache(self, static_files_protector_cache_mock):
+        Image.cache_set('test_key', 'content')
+        Announcement.cache_set('test_key', 'content')
+        generation = get_generation(GLOBAL_GENERATION)
+
+        clear_archive_list_cache()
+
+        self.assertNotEqual(get_generation(GLOBAL_GENERATION), generation)
+        self.assertIsNone(Image.cache_get('test_key'))
+        self.assertIsNone(Announcement.cache_get('test_key'))
+
+
+class ArchiveStaleCacheTestCase(BasicTestCase):
+
+    def test_stale_while_revalidate(self):
+        # Nothing cached: caller must render
+        self.assertEqual(stale_get('swr_key', stats_name='test'), (None, CACHE_MISS))
+
+        stale_set('swr_key', 'content', 60, 60)
+        self.assertEqual(stale_get('swr_key', stats_name='test'), ('content', CACHE_HIT))
+
+        # Soft TTL expired: first request re-renders, the others get the stale copy
+        stale_set('swr_key', 'content', -1, 60)
+        self.assertEqual(stale_get('swr_key', stats_name='test'), (None, CACHE_MISS))
+        self.assertEqual(stale_get('swr_key', stats_name='test'), ('content', CACHE_STALE))
+
+        # Storing the new version releases the lock
+        stale_set('swr_key', 'new content', 60, 60)
+        self.assertEqual(stale_get('swr_key', stats_name='test'), ('new content', CACHE_HIT))
+
+        self.assertEqual(get_stats('test'), {CACHE_HIT: 2, CACHE_STALE: 1, CACHE_MISS: 2})
+
+    def test_stale_after_invalidation(self):
+        Image.cache_set_stale('swr_list_key', 'content', 60, 60)
+        self.assertEqual(Image.cache_get_stale('swr_list_key'), ('content', CACHE_HIT))
+
+        clear_views_cache_handler(sender=Image, instance=None)
+
+        self.assertEqual(Image.cache_get_stale('swr_list_key'), (None, CACHE_MISS))
+        self.assertEqual(Image.cache_get_stale('swr_list_key'), ('content', CACHE_STALE))
+
+
+class ArchiveDetailCacheTestCase(BasicTestCase):
+    fixtures = ['media']
+
+    def test_detail_cache_record(self):
+        response = self.client.get('/images/image-1/')
+        self.assertEqual(response.status_code, 200)
+
+        key = package._gen_cache_key(package.CACHE_PREFIX['detail_view'], 'Image', 'image-1', lang='en')
+        record = cache.get(key)
+
+        # Only the fields needed for the state checks are cached, not the object
+        self.assertEqual(record['pk'], 'image-1')
+        self.assertNotIn('obj', record)
+        self.assertEqual(set(record['fields']), set(['published', 'release_date', 'embargo_date', 'last_modified']))
+
+        # Second request is served from the cache without loading the object
+        with patch('djangoplicity.archives.views._get_detail_object') as get_detail_object_mock:
+            cached_response = self.client.get('/images/image-1/')
+            self.assertFalse(get_detail_object_mock.called)
+        self.assertEqual(cached_response.content, response.content)
+
+    def test_detail_conditional_get(self):
+        response = self.client.get('/images/image-1/')
+        self.assertIn('Last-Modified', response)
+
+        # Revalidation neither loads the object nor fetches the page
+        with patch('djangoplicity.archives.views._get_detail_object') as get_detail_object_mock:
+            cached_response = self.client.get('/images/image-1/', HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertFalse(get_detail_object_mock.called)
+        self.assertEqual(cached_response.status_code, 304)
+        self.assertEqual(cached_response['ETag'], response['ETag'])
+
+        # Saving the image changes the ETag
+        Image.objects.get(pk='image-1').save()
+        response = self.client.get('/images/image-1/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+
+    @patch('djangoplicity.archives.contrib.security.StaticFilesProtectorCache.run_async')
+    def test_list_conditional_get(self, static_files_protector_cache_mock):
+        response = self.client.get('/images/')
+        self.assertEqual(self.client.get('/images/', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+        clear_archive_list_cache()
+        self.assertEqual(self.client.get('/images/', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+
+
+class ArchiveListCacheParamsTestCase(BasicTestCase):
+
+    def test_list_cache_params(self):
+        factory = RequestFactory()
+        query = ArchiveQuery(browsers=('normal', ), viewmode_param='display', sort_fields=['release_date'])
+        browser = ArchiveBrowser(paginate_by=10)
+        options = MagicMock(search_cache_timeout=0)
+
+        request = factory.get('/images/')
+        self.assertEqual(_list_cache_params(request, Image, options, query, browser), [])
+
+        request = factory.get('/images/', {'sort': '-release_date', 'display': 'list'})
+        self.assertEqual(
+            sorted(_list_cache_params(request, Image, options, query, browser)),
+            [('display', 'list'), ('sort', '-release_date')]
+        )
+
+        # Unknown parameters and searches are not cached
+        request = factory.get('/images/', {'sort': '-release_date', 'foo': 'bar'})
+        self.assertIsNone(_list_cache_params(request, Image, options, query, browser))
+        request = factory.get('/images/', {'search': 'galaxy'})
+        self.assertIsNone(_list_cache_params(request, Image, options, query, browser))
+
+        # Unless a search cache timeout is defined
+        options.search_cache_timeout = 60
+        self.assertEqual(_list_cache_params(request, Image, options, query, browser), [('search', 'galaxy')])
+
+
+class SerializationStreamingTestCase(BasicTestCase):
+    fixtures = ['media']
+
+    def test_iter_batches(self):
+        qs = Image.objects.order_by('pk')
+        batches = list(iter_batches(qs, 2))
+        self.assertTrue(all(0 < len(batch) <= 2 for batch in batches))
+        self.assertEqual([i.pk for batch in batches for i in batch], [i.pk for i in qs])
+
+    def test_json_stream(self):
+        """ streamed JSON is the same as the emitted one """
+        serializer = MiniImageSerializer()
+        emitter = JSONEmitter()
+        qs = Image.objects.order_by('pk')
+        expected = json.loads(emitter.emit(serializer.serialize_list(list(qs))))
+
+        self.assertEqual(json.loads(''.join(emitter.stream(serializer.iter_serialize(qs)))), expected)
+        self.assertEqual(
+            json.loads(''.join(emitter.stream(serializer.iter_serialize(qs), {'count': len(expected)}))),
+            {'count': len(expected), 'results': expected}
+        )
+
+
+class StaticFilesProtectorCacheTestCase(BasicTestCase):
+    fixtures = ['media']
+
+    def test_security_level(self):
+        protected = {'heic0601a': EMBARGO, 'eso.1234': UNPUBLISHED_PERMS}
+        level = StaticFilesProtectorCache.security_level
+
+        self.assertEqual(level(protected, 'images', 'images/screen/heic0601a.jpg'), EMBARGO)
+        self.assertEqual(level(protected, 'images', 'images/large/eso.1234.tif'), UNPUBLISHED_PERMS)
+        self.assertIsNone(level(protected, 'images', 'images/screen/heic0601b.jpg'))
+        self.assertIsNone(level(protected, 'images', 'images/screen/heic0601a'))
+        self.assertIsNone(level(protected, 'images', 'images/heic0601a.jpg'))
+        self.assertIsNone(level(protected, 'images', 'imagesx/screen/heic0601a.jpg'))
+
+    def test_run_instance(self):
+        cache.delete(PROTECTED_PATH_KEY)
+        protected_path = StaticFilesProtectorCache.protected_path(Image)
+
+        protected_paths = StaticFilesProtectorCache.run_instance(Image, 'image-1')
+        self.assertEqual(cache.get(PROTECTED_PATH_KEY), protected_paths)
+        self.assertNotIn('image-1', protected_paths.get(protected_path, {}))
+
+        Image.objects.filter(id='image-1').update(published=False)
+        protected_paths = StaticFilesProtectorCache.run_instance(Image, 'image-1')
+        self.assertEqual(protected_paths[protected_path]['image-1'], UNPUBLISHED_PERMS)
+        self.assertEqual(StaticFilesProtectorCache.run(), protected_paths)
+
+        Image.objects.filter(id='image-1').update(published=True)
+        protected_paths = StaticFilesProtectorCache.run_instance(Image, 'image-1')
+        self.assertNotIn('image-1', protected_paths.get(protected_path, {}))
+        self.assertIsNone(cache.get(PROTECTED_PATH_LOCK_KEY))
+
+    def test_run_instance_locked(self):
+        StaticFilesProtectorCache.run()
+        protected_path = StaticFilesProtectorCache.protected_path(Image)
+        Image.objects.filter(id='image-1').update(published=False)
+
+        # Another process is updating the index: generate the whole index
+        # once it's done instead of writing back an entry read before
+        cache.add(PROTECTED_PATH_LOCK_KEY, 1)
+        try:
+            with patch.object(StaticFilesProtectorCache, 'run', return_value={}) as run_mock:
+                StaticFilesProtectorCache.run_instance(Image, 'image-1')
+                self.assertTrue(run_mock.called)
+            self.assertNotIn('image-1', cache.get(PROTECTED_PATH_KEY).get(protected_path, {}))
+        finally:
+            cache.delete(PROTECTED_PATH_LOCK_KEY)
+
+        self.assertEqual(StaticFilesProtectorCache.run()[protected_path]['image-1'], UNPUBLISHED_PERMS)
+
+
+class ResourceManifestTestCase(BasicTestCase):
+    fixtures = ['media']
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.screen_dir = os.path.join(self.media_root, Image.Archive.Meta.root, 'screen')
+        os.makedirs(self.screen_dir)
+        with open(os.path.join(self.screen_dir, 'image-1.jpg'), 'w') as f:
+            f.write('test')
+
+    def tearDown(self):
+        shutil.rmtree(self.media_root)
+
+    def test_resource_manifest(self):
+        with override_settings(ARCHIVE_RESOURCE_MANIFEST=True, MEDIA_ROOT=self.media_root):
+            instance = Image.objects.get(id='image-1')
+            self.assertTrue(instance.resource_screen.name.endswith('screen/image-1.jpg'))
+
+            manifest = ResourceManifest.objects.get(root=Image.Archive.Meta.root, archive_id='image-1')
+            self.assertEqual(manifest.resources['screen']['ext'], 'jpg')
+            self.assertEqual(manifest.resources['screen']['size'], 4)
+            self.assertNotIn('thumb350x', manifest.resources)
+
+            # Resources are looked up without accessing the file system
+            instance = Image.objects.get(id='image-1')
+            with patch('os.stat') as stat_mock, patch('os.path.exists') as exists_mock:
+                self.assertIsNotNone(instance.resource_screen)
+                self.assertIsNone(instance.resource_thumb350x)
+                self.assertFalse(stat_mock.called)
+                self.assertFalse(exists_mock.called)
+
+            os.remove(os.path.join(self.screen_dir, 'image-1.jpg'))
+            update_resource_manifest(instance, ['screen'])
+            self.assertIsNone(instance.resource_screen)
+            self.assertNotIn('screen', ResourceManifest.objects.get(pk=manifest.pk).resources)
+
+    def test_prefetch_resources(self):
+        with override_settings(MEDIA_ROOT=self.media_root):
+            objects = list(Image.objects.filter(id__in=['image-1', 'image-2']).order_by('id'))
+            prefetch_resources(objects, ['screen'])
+
+            with patch('os.path.exists') as exists_mock:
+                self.assertTrue(objects[0].resource_screen.name.endswith('screen/image-1.jpg'))
+                self.assertIsNone(objects[1].resource_screen)
+                self.assertFalse(exists_mock.called)
+
+        with override_settings(ARCHIVE_RESOURCE_MANIFEST=True, MEDIA_ROOT=self.media_root):
+            for obj in objects:
+                update_resource_manifest(obj)
+
+            objects = list(Image.objects.filter(id__in=['image-1', 'image-2']).order_by('id'))
+            with self.assertNumQueries(1):
+                prefetch_resources(objects)
+
+            with self.assertNumQueries(0):
+                self.assertIsNotNone(objects[0].resource_screen)
+                self.assertIsNone(objects[1].resource_screen)
+
+    def test_wait_for_resources_ready(self):
+        with override_settings(MEDIA_ROOT=self.media_root):
+            instance = Image.objects.get(id='image-1')
+
+            # Nothing recorded: wait until the files exist
+            self.assertTrue(wait_for_resources_ready(instance, ['screen'], timeout=0))
+            self.assertFalse(wait_for_resources_ready(instance, ['thumb350x'], timeout=0))
+
+            mark_resources_ready(instance, ['screen'])
+            self.assertTrue(wait_for_resources_ready(instance, timeout=0))
+
+            # The file seen doesn't match the one recorded
+            with open(os.path.join(self.screen_dir, 'image-1.jpg'), 'w') as f:
+                f.write('modified')
+            self.assertFalse(wait_for_resources_ready(instance, timeout=0))
+
+    def test_video_import_ready(self):
+        from djangoplicity.archives.tasks import move_file, move_resources
+        from djangoplicity.media.models import Video
+        from djangoplicity.media.tasks import fast_start, fragment_mp4
+
+        import_root = tempfile.mkdtemp()
+        video_root = os.path.join(self.media_root, Video.Archive.Meta.root)
+        for fmt in ('hd_and_apple', 'hd_1080p25_screen'):
+            os.makedirs(os.path.join(import_root, fmt))
+            with open(os.path.join(import_root, fmt, 'video-1.mp4'), 'w') as f:
+                f.write('video')
+
+        def system(cmd):
+            # MP4Box rewrites the file in place, mp4fragment writes a new one
+            with open(cmd.split()[-1], 'w') as f:
+                f.write('processed by %s' % cmd)
+            return 0
+
+        try:
+            with override_settings(MEDIA_ROOT=self.media_root, TMP_DIR=self.media_root):
+                # Same chain as the video import actions
+                move_resources(import_root, video_root, archive_id='video-1', app_label='media', module_name='video')
+                src = os.path.join(video_root, 'hd_and_apple', 'video-1.mp4')
+                move_file(src, os.path.splitext(src)[0] + '.m4v', archive_id='video-1',
+                    app_label='media', module_name='video', fmt='hd_and_apple')
+                with patch('djangoplicity.media.tasks.os.system', side_effect=system):
+                    fast_start('video-1', 'hd_and_apple')
+                    fragment_mp4('media', 'video', 'video-1', 'hd_1080p25_screen')
+
+                # The files seen are the ones recorded by the last tasks
+                video = Video.objects.get(id='video-1')
+                with patch('djangoplicity.archives.resources.time.sleep') as sleep_mock:
+                    self.assertTrue(wait_for_resources_ready(video, timeout=0))
+                    self.assertFalse(sleep_mock.called)
+                self.assertTrue(video.resource_hd_and_apple.name.endswith('video-1.m4v'))
+        finally:
+            shutil.rmtree(import_root)
+
+    def test_write_metadata_ready(self):
+        from djangoplicity.media.tasks import write_metadata
+
+        def avm_to_file(path, data, replace=False):
+            with open(path, 'w') as f:
+                f.write('with avm')
+
+        with override_settings(MEDIA_ROOT=self.media_root, SITE_ENVIRONMENT='prod'):
+            instance = Image.objects.get(id='image-1')
+            # Recorded by the task which moved the files
+            mark_resources_ready(instance)
+
+            with patch('libavm.utils.avm_to_file', side_effect=avm_to_file), \
+                    patch('djangoplicity.media.tasks.XMPEmitter'), \
+                    patch('djangoplicity.archives.resources.time.sleep') as sleep_mock:
+                write_metadata('image-1', ['screen'], cdn_sync=False)
+                self.assertFalse(sleep_mock.called)
+
+                # Later tasks don't wait either
+                self.assertTrue(wait_for_resources_ready(instance, timeout=0))
+
+    def test_compute_checksums(self):
+        path = os.path.join(self.screen_dir, 'image-1.jpg')
+        with override_settings(MEDIA_ROOT=self.media_root):
+            instance = Image.objects.get(id='image-1')
+            instance.checksums = {'screen': 'legacy'}
+
+            checksums, hashed = compute_instance_checksums(instance, min_size=0, processes=2)
+            self.assertEqual(hashed, {'screen': 4})
+            self.assertEqual(checksum_value(checksums['screen']), hashlib.sha256('test').hexdigest())
+            self.assertEqual(checksums['screen']['size'], 4)
+
+            # Unchanged files are not hashed again
+            store_checksums(instance, checksums)
+            self.assertEqual(Image.objects.get(id='image-1').checksums, checksums)
+            with patch('djangoplicity.archives.checksums.file_checksum') as file_checksum_mock:
+                self.assertEqual(compute_instance_checksums(instance, min_size=0), (checksums, {}))
+                self.assertFalse(file_checksum_mock.called)
+
+            with open(path, 'w') as f:
+                f.write('modified')
+            checksums, hashed = compute_instance_checksums(instance, min_size=0)
+            self.assertEqual(hashed, {'screen': 8})
+            self.assertEqual(get_instance_checksum(Image(checksums=checksums), 'screen'), hashlib.sha256('modified').hexdigest())
+
+            # Files smaller than min_size are skipped
+            self.assertEqual(compute_instance_checksums(instance), ({}, {}))
+
+
+class SearchBackendTestCase(BasicTestCase):
+    fixtures = ['media']
+
+    def search(self, searchstr):
+        return sorted(o.id for o in ImageOptions.search(None, Image.objects.all(), searchstr))
+
+    def test_default_backend(self):
+        self.assertEqual(self.search('description 3'), ['image-3'])
+        self.assertEqual(self.search('description -3'), ['image-1', 'image-2'])
+
+    def test_full_text_backend(self):
+        if connection.vendor == 'postgresql':
+            backend = 'djangoplicity.archives.contrib.search.backends.PostgresSearchBackend'
+        else:
+            backend = 'djangoplicity.archives.contrib.search.backends.SQLiteSearchBackend'
+
+        with override_settings(ARCHIVE_SEARCH_BACKEND=backend):
+            for obj in Image.objects.all():
+                update_search_index(obj)
+
+            self.assertEqual(self.search('descrip'), ['image-1', 'image-2', 'image-3'])
+            self.assertEqual(self.search('description 3'), ['image-3'])
+            self.assertEqual(self.search('description -3'), ['image-1', 'image-2'])
+            self.assertEqual(self.search('"test image 2"'), ['image-2'])
+
+            # Results are ordered by relevance
+            qs = ImageOptions.search(None, Image.objects.all(), 'test')
+            self.assertTrue(hasattr(qs[0], 'search_rank'))
+
+            delete_search_index(Image.objects.get(id='image-3'))
+            self.assertEqual(self.search('description'), ['image-1', 'image-2'])
+
+    def test_full_text_backend_m2m(self):
+        if connection.vendor == 'postgresql':
+            backend = 'djangoplicity.archives.contrib.search.backends.PostgresSearchBackend'
+        else:
+            backend = 'djangoplicity.archives.contrib.search.backends.SQLiteSearchBackend'
+
+        with override_settings(ARCHIVE_SEARCH_BACKEND=backend):
+            for obj in Image.objects.all():
+                update_search_index(obj)
+
+            # subject_name__name is in the search fields, the index is
+            # updated when the relation changes from either side
+            image = Image.objects.get(id='image-1')
+            subject = SubjectName.objects.create(name='Andromeda Galaxy')
+            image.subject_name.add(subject)
+            self.assertEqual(self.search('andromeda'), ['image-1'])
+
+            subject.image_set.add(Image.objects.get(id='image-2'))
+            self.assertEqual(self.search('andromeda'), ['image-1', 'image-2'])
+
+            image.subject_name.remove(subject)
+            self.assertEqual(self.search('andromeda'), ['image-2'])
+
+            subject.image_set.clear()
+            self.assertEqual(self.search('andromeda'), [])
+
+    def test_postgres_backend_unaccent(self):
+        if connection.vendor != 'postgresql':
+            self.skipTest('Requires PostgreSQL')
+
+        backend = 'djangoplicity.archives.contrib.search.backends.PostgresSearchBackend'
+        with override_settings(ARCHIVE_SEARCH_BACKEND=backend):
+            self.assertTrue(get_search_backend(ImageOptions).has_unaccent())
+
+            image = Image.objects.get(id='image-1')
+            image.title = u'N\xe9buleuse de la Car\xe8ne'
+            image.save()
+
+            self.assertEqual(self.search('nebuleuse'), ['image-1'])
+            self.assertEqual(self.search(u'car\xe8ne'), ['image-1'])
 
 
 class ArchiveBaseTestCase(BasicTestCase):
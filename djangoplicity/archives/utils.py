@@ -7,10 +7,8 @@
 #
 
 import hashlib
-import logging
 from math import ceil
 from os.path import isfile
-from time import sleep
 
 from django.conf import settings
 from django.core.cache import cache
@@ -20,7 +18,9 @@ from django.db.models.signals import post_save, post_delete, pre_save
 from django.utils.functional import curry
 
 from djangoplicity.archives.base import ArchiveModel
-from djangoplicity.archives.resources import ResourceManager
+from djangoplicity.archives.checksums import checksum_value
+from djangoplicity.archives.resources import ResourceManager, \
+    prefetch_resources, wait_for_resources_ready
 from djangoplicity.translation.models import TranslationModel
 from djangoplicity.utils.d2d import D2dDict
 
@@ -48,28 +48,15 @@ class FormatTokenGenerator( object ):
         return token == cls.create_token( format, id )
 
 
-def wait_for_resource(archive, resource_name='original'):
+def wait_for_resource(archive, resource_name='original', timeout=120):
     '''
-    Returns the specified resource
-    If the resource doesn't exist sleeps for 5 seconds and try again up to
-    2 minutes total time in case the NFS share is slow to update
+    Returns the specified resource once it's ready (see
+    djangoplicity.archives.resources.wait_for_resources_ready) in case the
+    NFS share is slow to update, or None if it still doesn't exist after
+    timeout seconds.
     '''
-    for _t in range(0, 120, 5):
-        resource = getattr(archive, 'resource_%s' % resource_name)
-
-        if resource:
-            return resource
-
-        logging.warning('No %s format found for "%s", waiting 5s...',
-            resource_name, archive.pk)
-
-        # We clear the resource_cache to make sure we check again on the disk
-        # for the next iteration
-        archive.clear_resource_cache()
-
-        sleep(5)
-
-    return None
+    wait_for_resources_ready(archive, [resource_name], timeout=timeout)
+    return getattr(archive, 'resource_%s' % resource_name)
 
 
 def is_internal( request ):
@@ -199,31 +186,74 @@ def get_instance_archives(instance):
         getattr(instance, 'resource_%s' % x) is not None]
 
 
-def get_instance_resources(instance):
+# Formats of the D2D resources lists, see get_instance_resources
+D2D_IMAGE_FORMATS = [
+    ('Original', ('original', 'Image')),
+    ('Large', ('large', 'Image')),
+    ('Medium', ('wallpaper5', 'Image')),
+    ('Small', ('screen', 'Image')),
+    ('Thumbnail', ('potwmedium', 'Image')),
+    ('Icon', ('newsmini', 'Image')),
+]
+D2D_VIDEO_DOME_FORMATS = ['dome_8kmaster', 'dome_4kmaster', 'dome_2kmaster', 'dome_mov']
+D2D_VIDEO_ORIGINAL_FORMATS = ['ultra_hd', 'hd_1080p25_screen', 'hd_1080_screen', 'ext_highres']
+D2D_VIDEO_PREVIEW_FORMATS = ['hd_and_apple', 'ext_playback', 'medium_podcast', 'old_video']
+D2D_VIDEO_IMAGE_FORMATS = [
+    ('Thumbnail', ('potwmedium', 'Image')),
+    ('Icon', ('newsmini', 'Image')),
+]
+D2D_MUSIC_FORMATS = [
+    ('Original', ('wav', 'Audio')),
+    ('Preview', ('aac', 'Audio')),
+]
+D2D_MODEL3D_FORMATS = [
+    ('Original', ('model_3d_c4d', 'Model')),
+    ('Obj', ('model_3d_obj', 'Model')),
+    ('Thumbnail', ('thumb', 'Image')),
+]
+
+D2D_RESOURCES_TIMEOUT = 60 * 10
+
+
+def _d2d_resources_key(instance):
+    return 'instance-resource-cache-{}-{}-{}'.format(instance._meta.app_label,
+        instance._meta.model_name, instance.pk)
+
+
+def _d2d_candidate_formats(instance):
     '''
-    Return D2D compatible resources list
+    Return all the formats which might be used in the D2D resources list of
+    the instance (to resolve them beforehand, see get_instances_resources)
     '''
-    key = 'instance-resource-cache-{}-{}-{}'.format(instance._meta.app_label,
-        instance._meta.model_name, instance.pk)
+    name = instance.__class__.__name__
+
+    if name == 'Image':
+        formats = D2D_IMAGE_FORMATS
+    elif name == 'Video':
+        return D2D_VIDEO_DOME_FORMATS + ['dome_preview'] + \
+            D2D_VIDEO_ORIGINAL_FORMATS + D2D_VIDEO_PREVIEW_FORMATS + \
+            [fmt for (_name, (fmt, _media_type)) in D2D_VIDEO_IMAGE_FORMATS]
+    elif name == 'Music':
+        formats = D2D_MUSIC_FORMATS
+    elif name == 'Model3d':
+        formats = D2D_MODEL3D_FORMATS
+    else:
+        formats = []
+
+    return [fmt for (_name, (fmt, _media_type)) in formats]
 
-    result = cache.get(key)
-    if result:
-        return result
 
+def _d2d_resources(instance):
+    '''
+    Compute the D2D resources list of the instance
+    '''
     if instance.__class__.__name__ == 'Image':
-        formats = D2dDict([
-            ('Original', ('original', 'Image')),
-            ('Large', ('large', 'Image')),
-            ('Medium', ('wallpaper5', 'Image')),
-            ('Small', ('screen', 'Image')),
-            ('Thumbnail', ('potwmedium', 'Image')),
-            ('Icon', ('newsmini', 'Image')),
-        ])
+        formats = D2dDict(D2D_IMAGE_FORMATS)
     elif instance.__class__.__name__ == 'Video':
         formats = D2dDict()
 
         # Fulldome videos:
-        for fmt in ['dome_8kmaster', 'dome_4kmaster', 'dome_2kmaster', 'dome_mov']:
+        for fmt in D2D_VIDEO_DOME_FORMATS:
             if getattr(instance, 'resource_%s' % fmt, None):
                 if 'Original' not in formats:
                     formats['Original'] = (fmt, 'Video')
@@ -236,29 +266,21 @@ def get_instance_resources(instance):
             formats['Preview'] = ('dome_preview', 'Video')
 
         # Normal videos
-        for fmt in ['ultra_hd', 'hd_1080p25_screen', 'hd_1080_screen', 'ext_highres']:
+        for fmt in D2D_VIDEO_ORIGINAL_FORMATS:
             if getattr(instance, 'resource_%s' % fmt, None):
                 formats['Original'] = (fmt, 'Video')
                 break
 
-        for fmt in ['hd_and_apple', 'ext_playback', 'medium_podcast', 'old_video']:
+        for fmt in D2D_VIDEO_PREVIEW_FORMATS:
             if getattr(instance, 'resource_%s' % fmt, None):
                 formats['Preview'] = (fmt, 'Video')
                 break
 
-        formats['Thumbnail'] = ('potwmedium', 'Image')
-        formats['Icon'] = ('newsmini', 'Image')
+        formats.update(D2D_VIDEO_IMAGE_FORMATS)
     elif instance.__class__.__name__ == 'Music':
-        formats = D2dDict([
-            ('Original', ('wav', 'Audio')),
-            ('Preview', ('aac', 'Audio')),
-        ])
+        formats = D2dDict(D2D_MUSIC_FORMATS)
     elif instance.__class__.__name__ == 'Model3d':
-        formats = D2dDict([
-            ('Original', ('model_3d_c4d', 'Model')),
-            ('Obj', ('model_3d_obj', 'Model')),
-            ('Thumbnail', ('thumb', 'Image')),
-        ])
+        formats = D2dDict(D2D_MODEL3D_FORMATS)
     else:
         formats = D2dDict()
 
@@ -268,9 +290,55 @@ def get_instance_resources(instance):
     ]
 
     # Remove empty resources if any:
-    result = [r for r in resources if r]
+    return [r for r in resources if r]
+
+
+def get_instance_resources(instance):
+    '''
+    Return D2D compatible resources list
+    '''
+    key = _d2d_resources_key(instance)
 
-    cache.set(key, result, 60 * 10)
+    result = cache.get(key)
+    if result is not None:
+        return result
+
+    result = _d2d_resources(instance)
+    cache.set(key, result, D2D_RESOURCES_TIMEOUT)
+
+    return result
+
+
+def get_instances_resources(instances):
+    '''
+    Return the D2D compatible resources lists of several instances (e.g. a
+    feed page) as a dictionary of primary key to list. The cached lists are
+    fetched at once, and the resources of the other instances are resolved
+    together (see prefetch_resources).
+    '''
+    keys = dict((_d2d_resources_key(instance), instance) for instance in instances)
+    cached = cache.get_many(keys.keys())
+
+    result = {}
+    missing = {}
+    for key, instance in keys.items():
+        if cached.get(key) is not None:
+            result[instance.pk] = cached[key]
+        else:
+            missing[key] = instance
+
+    by_model = {}
+    for instance in missing.values():
+        by_model.setdefault(instance.__class__, []).append(instance)
+    for objects in by_model.values():
+        prefetch_resources(objects, _d2d_candidate_formats(objects[0]))
+
+    computed = {}
+    for key, instance in missing.items():
+        computed[key] = result[instance.pk] = _d2d_resources(instance)
+
+    if computed:
+        cache.set_many(computed, D2D_RESOURCES_TIMEOUT)
 
     return result
 
@@ -338,15 +406,16 @@ def get_resource_dimension(instance, resource_name):
 
 def get_instance_d2d_resource(instance, resource_name, name, media_type):
     resource = getattr(instance, 'resource_%s' % resource_name)
-    if hasattr(instance, 'web_category'):
-        web_categories = [c.name for c in instance.web_category.all()]
-    else:
-        web_categories = []
 
     # Skip non-file resources (e.g. zoomable):
     if not resource or not isfile(resource.path):
         return {}
 
+    if hasattr(instance, 'web_category'):
+        web_categories = [c.name for c in instance.web_category.all()]
+    else:
+        web_categories = []
+
     if instance.__class__.__name__ == 'Image':
         # Figure out ProjectionType
         if hasattr(instance, 'type'):
@@ -437,10 +506,7 @@ def get_instance_checksum(instance, resource_name):
 
     checksums = instance.checksums if hasattr(instance, 'checksums') and instance.checksums else {}
 
-    try:
-        return checksums[resource_name]
-    except KeyError:
-        return None
+    return checksum_value(checksums.get(resource_name))
 
 
 # ==============
@@ -8,10 +8,12 @@
 from os.path import basename
 
 from datetime import datetime
+from uuid import uuid4
 
 from django.conf import settings
 from django.contrib.auth.views import redirect_to_login
 from django.core.cache import cache
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
 from django.core.exceptions import ImproperlyConfigured, ObjectDoesNotExist, \
     FieldDoesNotExist
 from django.urls import NoReverseMatch
@@ -21,13 +23,16 @@ from django.template import loader
 from django.template.loader import render_to_string
 from django.utils.encoding import force_unicode
 from django.utils.http import urlunquote
-from django.utils.translation import ugettext_lazy as _, ugettext
+from django.utils.translation import ugettext_lazy as _, ugettext, get_language
 from django.views.generic import DetailView, ListView
 
 from djangoplicity.archives import CACHE_PREFIX, _gen_cache_key
+from djangoplicity.archives.caching import CACHE_STALE, stale_get, stale_set
 from djangoplicity.archives.queries import ArchiveQuery
 from djangoplicity.archives.utils import is_internal, get_instance_checksum
 from djangoplicity.archives.browsers import lang_templates, default_search_url
+from djangoplicity.utils.cachekeys import digest, make_cache_key
+from djangoplicity.utils.conditional import make_etag, not_modified, set_validators
 
 SEARCH_VAR = 'search'
 
@@ -468,6 +473,94 @@ class SerializationDetailView( GenericDetailView ):
         return response
 
 
+class CachedArchiveItem( object ):
+    """
+    Stand-in for an archive item when its detail page is served from the
+    cache. The actual object is only loaded from the database if any of its
+    attributes is accessed (e.g. by custom permission checks).
+    """
+    def __init__( self, pk, loader ):
+        self.pk = pk
+        self._loader = loader
+        self._obj = None
+
+    def get_object( self ):
+        if self._obj is None:
+            self._obj = self._loader()
+        return self._obj
+
+    def __getattr__( self, name ):
+        if name.startswith( '__' ):
+            raise AttributeError( name )
+        return getattr( self.get_object(), name )
+
+
+def _get_detail_object( model, options, filterkwargs ):
+    """
+    Fetch the object for the detail view from the database
+    """
+    queryset = options.detail_queryset( model )
+
+    if options.select_related:
+        queryset = queryset.select_related(*options.select_related)
+
+    if options.prefetch_related:
+        queryset = queryset.prefetch_related(*options.prefetch_related)
+
+    return queryset.filter( **filterkwargs ).get()
+
+
+def _load_detail_object( model, options, filterkwargs ):
+    """
+    Load the object for a detail page found in the cache, falling back to
+    the object in the default language like archive_detail does.
+    """
+    try:
+        return _get_detail_object( model, options, filterkwargs )
+    except ObjectDoesNotExist:
+        obj = options.detail_notfound( model, **dict( filterkwargs ) )
+        if not obj:
+            raise Http404("No %s found matching the query" % (model._meta.verbose_name))
+        return obj
+
+
+def _get_detail_state_fields( model, obj ):
+    """
+    Returns the values needed to determine if obj is published, embargoed
+    or staging, as well as its last modification date (for the
+    Last-Modified header). These are stored in the detail view cache
+    instead of the whole object.
+    """
+    fields = { 'published': None, 'release_date': None, 'embargo_date': None, 'last_modified': None }
+
+    if getattr( model.Archive.Meta, 'last_modified', False ):
+        fields['last_modified'] = getattr( obj, model.Archive.Meta.last_modified_fieldname, None )
+
+    if model.Archive.Meta.published:
+        fields['published'] = getattr( obj, model.Archive.Meta.published_fieldname, None )
+
+    if model.Archive.Meta.release_date or model.Archive.Meta.embargo_date:
+        fields['release_date'] = getattr( obj, model.Archive.Meta.release_date_fieldname, None )
+        fields['embargo_date'] = getattr( obj, model.Archive.Meta.embargo_date_fieldname, None )
+    elif hasattr(model.Archive.Meta, 'related_release_date') and hasattr(model.Archive.Meta, 'related_embargo_date'):
+        if model.Archive.Meta.related_release_date or model.Archive.Meta.related_embargo_date:
+            rel_field, rel_model_field = model.Archive.Meta.related_release_date[:2]
+            emb_field, emb_model_field = model.Archive.Meta.related_embargo_date[:2]
+            fields['release_date'] = getattr( getattr( obj, rel_field, None ), rel_model_field, None )
+            fields['embargo_date'] = getattr( getattr( obj, emb_field, None ), emb_model_field, None )
+
+    return fields
+
+
+def _detail_variant_key( key, record, htmlkey ):
+    """
+    Key of a rendered variant of a detail page. The key includes the
+    version of the cache record, so variants are invalidated together with
+    their record.
+    """
+    return '%s_%s_%s' % ( key, record['version'], htmlkey )
+
+
 def archive_detail( request, object_id=None, slug=None, model=None, options=None, detail_view=None, **kwargs ):
     """
     Generic detail view for browsing and archive - based on generic object_detail view
@@ -491,32 +584,32 @@ def archive_detail( request, object_id=None, slug=None, model=None, options=None
     #
     if object_id:
         key = _gen_cache_key( detail_view.cache_key_prefix, model.__name__, object_id )
+        filterkwargs = { 'pk': object_id }
     elif slug and options.slug_field:
         key = _gen_cache_key( detail_view.cache_key_prefix, model.__name__, slug )
+        filterkwargs = {options.slug_field: slug}
     else:
         raise AttributeError("Generic archive detail view must be called with either an object_id or a slug/slug_field.")
 
-    try:
-        ca = cache.get(key)
-
-        if ca:
-            obj = ca['obj']
-        else:
-            queryset = options.detail_queryset( model )
+    swr = options.cache_stale_while_revalidate
+    cache_state = None
 
-            if options.select_related:
-                queryset = queryset.select_related(*options.select_related)
-
-            if options.prefetch_related:
-                queryset = queryset.prefetch_related(*options.prefetch_related)
-
-            # Determine queryset by using object_id or pk as ID field.
-            if object_id:
-                filterkwargs = { 'pk': object_id }
-            elif slug and options.slug_field:
-                filterkwargs = {options.slug_field: slug}
+    # The cache record only contains what is needed to check the state of
+    # the object, the rendered pages are stored in separate keys (one per
+    # variant), see _detail_variant_key()
+    if swr:
+        record, cache_state = stale_get( key, lock_timeout=options.cache_lock_timeout,
+            stats_name='%s_detail' % model.get_cache_key_prefix() )
+    else:
+        record = cache.get( key )
 
-            obj = queryset.filter( **filterkwargs ).get()
+    try:
+        if record:
+            obj = CachedArchiveItem( record['pk'], lambda: _load_detail_object( model, options, filterkwargs ) )
+            state_fields = record['fields']
+        else:
+            obj = _get_detail_object( model, options, filterkwargs )
+            state_fields = _get_detail_state_fields( model, obj )
     except ValueError:
         raise Http404("Value error: No %s found matching the query" % (model._meta.verbose_name))
 
@@ -533,6 +626,7 @@ def archive_detail( request, object_id=None, slug=None, model=None, options=None
             # We set a variable to be used in the template to indicate
             # that the object is not in the current language
             request.NO_TRANSLATION = True
+        state_fields = _get_detail_state_fields( model, obj )
     #
     # Embargo staging functionality
     #
@@ -541,7 +635,7 @@ def archive_detail( request, object_id=None, slug=None, model=None, options=None
 
     # Test if item is published or not.
     if model.Archive.Meta.published:
-        state['is_published'] = getattr( obj, model.Archive.Meta.published_fieldname, None )
+        state['is_published'] = state_fields['published']
 
         # Only authorize request if actually needed.
         if not state['is_published']:
@@ -552,8 +646,8 @@ def archive_detail( request, object_id=None, slug=None, model=None, options=None
     # Test if item is release, embargoed or staging
     if model.Archive.Meta.release_date or model.Archive.Meta.embargo_date:
         # For release dates in the model itself.
-        release_date = getattr( obj, model.Archive.Meta.release_date_fieldname, None )
-        embargo_date = getattr( obj, model.Archive.Meta.embargo_date_fieldname, None )
+        release_date = state_fields['release_date']
+        embargo_date = state_fields['embargo_date']
         view = _authorize_request_releasedate( request, options, obj, release_date, embargo_date )
         if view:
             return view
@@ -564,12 +658,8 @@ def archive_detail( request, object_id=None, slug=None, model=None, options=None
     elif hasattr(model.Archive.Meta, 'related_release_date') and hasattr(model.Archive.Meta, 'related_embargo_date'):
         if model.Archive.Meta.related_release_date or model.Archive.Meta.related_embargo_date:
             # For release dates in related models.
-            rel_field = model.Archive.Meta.related_release_date[0]
-            rel_model_field = model.Archive.Meta.related_release_date[1]
-            emb_field = model.Archive.Meta.related_embargo_date[0]
-            emb_model_field = model.Archive.Meta.related_embargo_date[1]
-            release_date = getattr( getattr( obj, rel_field, None ), rel_model_field, None )
-            embargo_date = getattr( getattr( obj, emb_field, None ), emb_model_field, None )
+            release_date = state_fields['release_date']
+            embargo_date = state_fields['embargo_date']
             view = _authorize_request_releasedate( request, options, obj, release_date, embargo_date )
             if view:
                 return view
@@ -599,16 +689,32 @@ def archive_detail( request, object_id=None, slug=None, model=None, options=None
 
     # Cache validation - is stored cache dirty (e.g. it's displaying embargo
     # even though it's no longer embargoed)
-    is_dirty = (ca is not None and ca['state'] != state)
+    is_dirty = (record is not None and record['state'] != state)
+
+    # Conditional GET - the version of the cache record changes whenever the
+    # object is saved, so together with the variant it identifies the page
+    # without having to fetch or render it. Stale records are not used as
+    # the page might be re-rendered from the current object.
+    etag = None
+    last_modified = state_fields.get( 'last_modified' )
+    if record is not None and not is_dirty and cache_state != CACHE_STALE:
+        etag = make_etag( key, record['version'], htmlkey )
+        response = not_modified( request, etag, last_modified )
+        if response is not None:
+            return response
 
     # ====================================
     #
     # Rendering
     #
-    if ca is not None and (not is_dirty) and htmlkey in ca:
-        # Cached page exists
-        html = ca[htmlkey]
-    else:
+    html = None
+    if record is not None and not is_dirty:
+        html = cache.get( _detail_variant_key( key, record, htmlkey ) )
+
+    if html is None:
+        if isinstance( obj, CachedArchiveItem ):
+            obj = obj.get_object()
+
         #
         # Render template
         #
@@ -617,20 +723,80 @@ def archive_detail( request, object_id=None, slug=None, model=None, options=None
         #
         # Save in cache
         #
-        if options.allow_detail_cache:
-            if ca is None:
-                # No previous cache exists, so create new.
-                cache.set( key, {'obj': obj, htmlkey: html, 'state': state} )
-            else:
-                # Previous cache exists, so only set the missing html key.
-                ca[htmlkey] = html
-                cache.set( key, ca )
+        # Stale records are being re-rendered by another request which will
+        # update the cache.
+        if options.allow_detail_cache and not (is_dirty and cache_state == CACHE_STALE):
+            timeout = options.cache_soft_ttl + options.cache_stale_ttl if swr else DEFAULT_TIMEOUT
+            if record is None or is_dirty:
+                # No (valid) previous cache exists, so create new.
+                record = {
+                    'pk': obj.pk,
+                    'version': uuid4().hex,
+                    'fields': state_fields,
+                    'state': state,
+                }
+                if swr:
+                    stale_set( key, record, options.cache_soft_ttl, options.cache_stale_ttl )
+                else:
+                    cache.set( key, record, timeout )
+                etag = make_etag( key, record['version'], htmlkey )
+
+            # Set the missing html variant
+            cache.set( _detail_variant_key( key, record, htmlkey ), html, timeout )
 
     # Return response (either cached or just rendered)
     response = detail_view.response( html, **kwargs )
+    if etag:
+        set_validators( response, etag, last_modified )
     return response
 
 
+def _list_cache_params( request, model, options, query, browser ):
+    """
+    Returns the list of GET parameters (as (name, value) pairs) to include
+    in the cache key of a list page, or None if the page must not be cached.
+
+    Only GET parameters declared by the query and browser (e.g. sort and
+    viewmode parameter) are allowed; search queries are only allowed if
+    options.search_cache_timeout is set.
+    """
+    allowed = query.cache_params( model, request )
+    if allowed is None:
+        return None
+
+    allowed = set( allowed ) | set( browser.cache_params )
+    if options.search_cache_timeout:
+        allowed.add( SEARCH_VAR )
+
+    params = []
+    for name, values in request.GET.lists():
+        if name not in allowed:
+            return None
+        params.extend( [( name, v ) for v in values] )
+
+    return params
+
+
+def _pagination_key( request, query, query_name, cache_params, **kwargs ):
+    """
+    Returns a key identifying the list (query, URL arguments and
+    whitelisted GET parameters, but not the page) for the cached counts and
+    page boundaries of the keyset paginator, or None if the page can't be
+    cached. The SQL of the query can't be used as it usually depends on the
+    current time.
+    """
+    if cache_params is None:
+        return None
+
+    return digest(
+        query_name or query.__class__.__name__,
+        get_language() if settings.USE_I18N else '',
+        'internal' if is_internal( request ) else '',
+        *( ['%s=%s' % ( k, v ) for k, v in sorted( kwargs.items() )] +
+            ['%s=%s' % ( k, v ) for k, v in sorted( cache_params ) if k != 'page'] )
+    )
+
+
 def archive_list( request, model=None, options=None, query_name=None, query=None, page=1, viewmode_name=None, **kwargs ):
     """
     List view for archives
@@ -657,12 +823,6 @@ def archive_list( request, model=None, options=None, query_name=None, query=None
     if not ( query is not None and isinstance( query, ArchiveQuery ) ):
         raise Http404
 
-    # Check if request is internal and generate cache key
-    if is_internal(request):
-        key = '%s_archive_list_internal_%s' % (model.get_cache_key_prefix(), str(request.path.__hash__()))
-    else:
-        key = '%s_archive_list_external_%s' % (model.get_cache_key_prefix(), str(request.path.__hash__()))
-
     #
     # Determine archive browser
     #
@@ -680,8 +840,30 @@ def archive_list( request, model=None, options=None, query_name=None, query=None
     except AttributeError:
         raise Http404
 
-    # Check if view in cache:
-    ca = model.cache_get( key )
+    # Generate cache key (depends on whether the request is internal and on
+    # the whitelisted GET parameters). Pages with other GET parameters are
+    # not cached, and keyword searches are only cached if
+    # options.search_cache_timeout is set. Streamed pages are not cached but
+    # still validated with the cache key (see below).
+    cache_params = _list_cache_params( request, model, options, query, browser )
+    is_search = bool( request.GET.get( SEARCH_VAR, '' ).strip() )
+    swr = options.cache_stale_while_revalidate and not is_search
+    use_cache = cache_params is not None and not browser.streaming
+
+    if cache_params is not None:
+        key = make_cache_key( '%s_archive_list_' % model.get_cache_key_prefix(), request.path,
+            lang=get_language() if settings.USE_I18N else None, internal=is_internal(request),
+            params=cache_params )
+
+    # Check if view in cache.
+    ca = None
+    cache_state = None
+    if use_cache:
+        if swr:
+            ca, cache_state = model.cache_get_stale( key, lock_timeout=options.cache_lock_timeout,
+                stats_name='%s_list' % model.get_cache_key_prefix() )
+        else:
+            ca = model.cache_get( key )
 
     #
     # Authorize view
@@ -697,10 +879,19 @@ def archive_list( request, model=None, options=None, query_name=None, query=None
     if redirect_url:
         return redirect(redirect_url)
 
-    # We don't used cached view if we have GET data (to prevent
-    # caching search queries)
-    if ca and not request.GET:
-        return browser.response( ca )
+    # Conditional GET - list pages only change when the cache generation
+    # of the archive (or of all archives) is bumped, so the versioned cache
+    # key identifies the page. Stale copies were rendered for an older
+    # generation.
+    etag = None
+    if cache_params is not None and cache_state != CACHE_STALE:
+        etag = make_etag( model.get_versioned_cache_key( key ) )
+        response = not_modified( request, etag )
+        if response is not None:
+            return response
+
+    if ca:
+        return set_validators( browser.response( ca ), etag )
 
     #
     # Get Query Set
@@ -742,13 +933,19 @@ def archive_list( request, model=None, options=None, query_name=None, query=None
     #
     # Render results
     #
-    kwargs.update( { 'page': page, 'viewmode_name': viewmode_name } )  # Temp hack
+    pagination_key = _pagination_key( request, query, query_name, cache_params, **kwargs )
+    kwargs.update( { 'page': page, 'viewmode_name': viewmode_name, 'pagination_key': pagination_key } )  # Temp hack
     content = browser.render( request, model, options, query, query_name, qs, query_data, search_str, **kwargs )
 
-    if not request.GET:
-        model.cache_set( key, content )
+    if use_cache:
+        if swr:
+            model.cache_set_stale( key, content, options.cache_soft_ttl, options.cache_stale_ttl )
+        elif is_search:
+            model.cache_set( key, content, options.search_cache_timeout )
+        else:
+            model.cache_set( key, content )
 
-    return browser.response( content )
+    return set_validators( browser.response( content ), etag )
 
 
 class BaseDetailView(DetailView):
@@ -35,11 +35,18 @@ import os
 import pika
 import pysftp
 import requests
+import socket
 import subprocess
+import threading
 import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from paramiko import SSHException
 from requests.exceptions import ConnectionError
 
 from django.conf import settings
+from django.core.cache import cache
 
 from djangoplicity.contentserver.cdn77_tasks import purge_prefetch
 
@@ -48,6 +55,13 @@ logger = logging.getLogger(__name__)
 
 __all__ = ('ContentServer', 'CDN77ContentServer')
 
+# Errors raised by pysftp/paramiko on failed transfers and dead transports
+SFTP_ERRORS = (IOError, EOFError, socket.error, SSHException)
+
+# Minimum number of seconds before failed purge/prefetch requests are sent
+# to the API again
+PURGE_RETRY_DELAY = 60
+
 
 def chunks(l, n):
     '''
@@ -57,6 +71,71 @@ def chunks(l, n):
         yield l[i:i + n]
 
 
+class SFTPConnectionPool(object):
+    '''
+    Pool of at most 'size' SFTP connections created with 'factory', and
+    cache of the remote directories known to exist. Connections are kept
+    open between uses.
+    '''
+    def __init__(self, factory, size):
+        self.factory = factory
+        self.idle = []
+        self.known_dirs = set()
+        self.lock = threading.Lock()
+        self.semaphore = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def connection(self):
+        '''
+        Context manager to borrow a connection from the pool. The connection
+        is dropped if an exception is raised while using it.
+        '''
+        self.semaphore.acquire()
+        try:
+            with self.lock:
+                conn = self.idle.pop() if self.idle else None
+            if conn is None:
+                conn = self.factory()
+
+            try:
+                yield conn
+            except Exception:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+                raise
+
+            with self.lock:
+                self.idle.append(conn)
+        finally:
+            self.semaphore.release()
+
+    def makedirs(self, conn, remote_dir):
+        '''
+        Create remote_dir if it doesn't exist
+        '''
+        if remote_dir in self.known_dirs:
+            return
+
+        if not conn.exists(remote_dir):
+            logger.info('Creating missing directory: %s', remote_dir)
+            conn.makedirs(remote_dir)
+
+        with self.lock:
+            self.known_dirs.add(remote_dir)
+
+    def forget_dir(self, remote_dir):
+        with self.lock:
+            self.known_dirs.discard(remote_dir)
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+
 class ContentServer(object):
     def __init__(self, name, formats=None, url='', remote_dir=''):
         '''
@@ -118,7 +197,21 @@ class CDN77ContentServer(ContentServer):
     '''
     def __init__(self, name, formats=None, url='', url_bigfiles='',
             remote_dir='', host='', username='', password='', api_login='',
-            api_password='', cdn_id='', cdn_id_bigfiles=''):
+            api_password='', cdn_id='', cdn_id_bigfiles='', workers=4,
+            connection_factory=None, purge_window=60, api_workers=4,
+            broker_factory=None, api_client=None):
+        '''
+        * workers: Number of files uploaded concurrently
+        * connection_factory: Callable returning a new SFTP connection, by
+          default a pysftp.Connection to host
+        * purge_window: Number of seconds during which purge/prefetch
+          requests are collected before being sent to the API
+        * api_workers: Number of concurrent purge/prefetch API calls
+        * broker_factory: Callable returning a (connection, channel) tuple
+          for the purge/prefetch queues, by default to RabbitMQ
+        * api_client: Callable used to make API calls instead of _api(), with
+          the same arguments
+        '''
         super(CDN77ContentServer, self).__init__(name, formats, url, remote_dir)
         self.url_bigfiles = url_bigfiles
         self.api_url = 'https://api.cdn77.com/v2.0/'
@@ -134,6 +227,13 @@ class CDN77ContentServer(ContentServer):
         self.remote_archive = True
         self.purge_queue = 'cdn77-purge'
         self.prefetch_queue = 'cdn77-prefetch'
+        self.workers = workers
+        self.connection_factory = connection_factory
+        self._pool = None
+        self.purge_window = purge_window
+        self.api_workers = api_workers
+        self.broker_factory = broker_factory or self._get_rabbitmq_connection
+        self.api_client = api_client or self._api
 
     def _api(self, method, params):
         '''
@@ -160,7 +260,7 @@ class CDN77ContentServer(ContentServer):
 
         if result['status'] == 'error':
             raise Exception('Failed API call "%s" "%s" "%s"' %
-                method, params, result)
+                (method, params, result))
 
         logger.info('Started %s for %s on %s, "%s", request: %s',
             method, self.name, self.cdn_id, result['description'],
@@ -269,7 +369,7 @@ class CDN77ContentServer(ContentServer):
         logger.debug('Will queue message: %s', message)
 
         # Queue the requests
-        connection, channel = self._get_rabbitmq_connection()
+        connection, channel = self.broker_factory()
         properties = pika.BasicProperties(
             content_type='application/json',
             delivery_mode=2,  # delivery_mode 2 is persistent
@@ -299,25 +399,73 @@ class CDN77ContentServer(ContentServer):
 
         connection.close()
 
-        # If called with delay=False we start the task to actually purge/prefetch
+        # If called with delay=False we schedule the task to actually purge/prefetch
         if delay is False:
+            self._schedule_purge_prefetch()
+
+    @property
+    def _schedule_key(self):
+        return 'djangoplicity.contentserver_purge_prefetch_%s' % self.name
+
+    def _schedule_purge_prefetch(self, countdown=None):
+        '''
+        Schedule the purge_prefetch task to run at the end of the current
+        window (or after countdown seconds), unless it's already scheduled:
+        the requests queued by all the syncs in the meantime are then sent
+        together.
+        '''
+        if countdown is None:
+            countdown = self.purge_window
+
+        if not countdown:
             purge_prefetch.delay()
+        elif cache.add(self._schedule_key, 1, countdown * 2):
+            purge_prefetch.apply_async(countdown=countdown)
 
-    def purge_prefetch(self, action):
+    def process_queues(self):
         '''
-        Purge/prefetch
+        Purge then prefetch all the queued URLs. The URLs of failed batches
+        are queued again and a new run is scheduled.
         '''
-        urls = []
-        urls_bigfiles = []
+        # Requests queued from now on will schedule a new run
+        cache.delete(self._schedule_key)
 
-        connection, channel = self._get_rabbitmq_connection()
+        batches = self.purge_prefetch('purge') + self.purge_prefetch('prefetch')
 
-        if action == 'purge':
-            queue = self.purge_queue
-        else:
-            queue = self.prefetch_queue
+        if [b for b in batches if b['error']]:
+            self._schedule_purge_prefetch(max(self.purge_window, PURGE_RETRY_DELAY))
+
+        return batches
+
+    def _requeue(self, queue, urls, urls_bigfiles):
+        '''
+        Queue again URLs whose purge/prefetch failed
+        '''
+        connection, channel = self.broker_factory()
+        channel.basic_publish(
+            exchange='',
+            routing_key=queue,
+            body=json.dumps({
+                'urls': urls,
+                'urls_bigfiles': urls_bigfiles,
+            }),
+            properties=pika.BasicProperties(
+                content_type='application/json',
+                delivery_mode=2,  # delivery_mode 2 is persistent
+            ),
+        )
+        connection.close()
+
+    def _drain_queue(self, queue):
+        '''
+        Get all the messages from the queue, returns the lists of URLs and
+        big files URLs without duplicates
+        '''
+        urls = OrderedDict()
+        urls_bigfiles = OrderedDict()
+
+        connection, channel = self.broker_factory()
 
-        # Get all the messages from the queue
         while True:
             method_frame, _header_frame, message = channel.basic_get(queue)
 
@@ -330,37 +478,202 @@ class CDN77ContentServer(ContentServer):
 
             channel.basic_ack(method_frame.delivery_tag)
             message = json.loads(message)
-            urls += message['urls']
-            urls_bigfiles += message['urls_bigfiles']
+            for url in message['urls']:
+                urls[url] = True
+            for url in message['urls_bigfiles']:
+                urls_bigfiles[url] = True
 
         connection.close()
 
-        # Build POST parameters
+        return urls.keys(), urls_bigfiles.keys()
+
+    def _api_batch(self, action, cdn_id, urls):
+        '''
+        Purge/prefetch a batch of URLs, returns a dictionary describing the
+        batch (cdn_id, number of URLs, latency and error if any)
+        '''
         params = {
             'login': self.api_login,
             'passwd': self.api_password,
-            'cdn_id': self.cdn_id,
+            'cdn_id': cdn_id,
+            'url[]': urls,
+        }
+
+        error = None
+        start = time.time()
+        try:
+            if self.api_client('data/%s' % action, params) is None:
+                error = 'Failed API call'
+        except Exception as e:
+            error = unicode(e)
+        latency = time.time() - start
+
+        if error:
+            logger.error('Failed %s of %d URLs on %s after %.2fs: %s',
+                action, len(urls), cdn_id, latency, error)
+        else:
+            logger.info('%s %d URLs on %s in %.2fs', action, len(urls), cdn_id, latency)
+
+        return {
+            'action': action,
+            'cdn_id': cdn_id,
+            'urls': len(urls),
+            'latency': latency,
+            'error': error,
         }
 
+    def purge_prefetch(self, action):
+        '''
+        Purge/prefetch the queued URLs. Returns the list of batches sent to
+        the API (see _api_batch), the URLs of the failed ones are queued
+        again.
+        '''
+        if action == 'purge':
+            queue = self.purge_queue
+        else:
+            queue = self.prefetch_queue
+
+        urls, urls_bigfiles = self._drain_queue(queue)
+
         # There is a limit of 2000 URLs per requests so we split the URLs
         # in smaller batches if necessary
-
-        if urls:
-            logger.debug('Will %s urls: %s', action, ', '.join(urls))
-            for urls_chunk in chunks(urls, 1800):
-                logger.info('%s %d URLs', action, len(urls_chunk))
-                params['url[]'] = urls_chunk
-                self._api('data/%s' % action, params)
+        batches = [(self.cdn_id, urls_chunk) for urls_chunk in chunks(urls, 1800)]
 
         # If necessary also purge/prefetch the large files onto the secondary CDN
         if self.url_bigfiles and urls_bigfiles:
-            logger.debug('Will %s urls_bigfiles: %s', action, ', '.join(urls_bigfiles))
-            params['cdn_id'] = self.cdn_id_bigfiles
+            batches += [(self.cdn_id_bigfiles, urls_chunk) for urls_chunk in chunks(urls_bigfiles, 1800)]
+
+        if not batches:
+            return []
+
+        logger.debug('Will %s urls: %s, urls_bigfiles: %s', action,
+            ', '.join(urls), ', '.join(urls_bigfiles))
+
+        workers = ThreadPool(min(self.api_workers, len(batches)))
+        try:
+            results = workers.map(lambda batch: self._api_batch(action, *batch), batches, chunksize=1)
+        finally:
+            workers.close()
+            workers.join()
+
+        logger.info('%s of %d URLs done in %d batches, %d errors', action,
+            len(urls) + len(urls_bigfiles), len(results),
+            len([r for r in results if r['error']]))
+
+        # The messages were acknowledged when the queue was drained
+        failed = [batch for batch, result in zip(batches, results) if result['error']]
+        if failed:
+            self._requeue(
+                queue,
+                [url for cdn_id, chunk in failed if cdn_id == self.cdn_id for url in chunk],
+                [url for cdn_id, chunk in failed if cdn_id != self.cdn_id for url in chunk],
+            )
+
+        return results
+
+    def _connect(self):
+        return pysftp.Connection(self.host, username=self.username, password=self.password)
 
-            for urls_chunk in chunks(urls_bigfiles, 1800):
-                logger.info('%s %d URLs', action, len(urls_chunk))
-                params['url[]'] = urls_chunk
-                self._api('data/%s' % action, params)
+    @property
+    def pool(self):
+        # The pool is created lazily so that connections are not shared
+        # between forked worker processes
+        if self._pool is None:
+            self._pool = SFTPConnectionPool(self.connection_factory or self._connect, self.workers)
+        return self._pool
+
+    def _rsync_target(self, remote_path):
+        if not self.host:
+            # Local stand-in (e.g. for tests)
+            return '%s/' % remote_path
+        return '%s@%s:%s/' % (self.username, self.host, remote_path)
+
+    def _upload(self, path, remote_path):
+        '''
+        Upload a local file or directory to remote_path. Returns False if
+        the file was skipped because it is already up to date.
+        '''
+        remote_dir = os.path.dirname(remote_path)
+
+        if os.path.isdir(path):
+            logger.info('Uploading directory %s to %s:%s', path, self.host, remote_path)
+            # We don't use sftp.put_r to upload directories as even though pysftps' doc
+            # says that it will not complain if the target dir already exists, in practice it
+            # raises an IOError
+
+            # Make sure that we won't rsync to the root:
+            if remote_path == self.remote_dir:
+                raise Exception('remote_path is equal to root dir: %s', remote_path)
+
+            self._sftp_retry(remote_dir, lambda sftp: None)
+
+            # rsync only transfers files whose size or mtime changed
+            cmd = [
+                'rsync',
+                '-a',
+                '--delete',
+                '%s/' % path,
+                self._rsync_target(remote_path),
+            ]
+
+            # In case there is an error with rsync we retry up to
+            # 50 times
+            i = 0
+            while True:
+                retcode = subprocess.call(cmd)
+                if retcode == 0:
+                    break
+
+                if i < 50:
+                    logger.info('Rsync exited with code %d, trying again.', retcode)
+                    time.sleep(2)
+                else:
+                    raise Exception('Rsync exited with code %d, check logs', retcode)
+
+                i += 1
+
+            return True
+
+        st = os.stat(path)
+
+        def upload(sftp):
+            try:
+                remote = sftp.stat(remote_path)
+            except IOError:
+                remote = None
+
+            # Files are uploaded with their mtime, so if the size
+            # and mtime match the file is up to date
+            if remote is not None and remote.st_size == st.st_size and \
+                    int(remote.st_mtime) == int(st.st_mtime):
+                logger.info('Skipping %s, already on %s:%s', path, self.host, remote_path)
+                return False
+
+            logger.info('Uploading %s to %s:%s', path, self.host, remote_path)
+            sftp.put(path, remote_path, preserve_mtime=True)
+            return True
+
+        return self._sftp_retry(remote_dir, upload)
+
+    def _sftp_retry(self, remote_dir, func):
+        '''
+        Call func with a pooled SFTP connection once remote_dir exists. In
+        case the sftp fails (e.g. an idle connection was dropped by the
+        server) we try again up to 10x, with a new connection.
+        '''
+        attempts = 0
+        while True:
+            try:
+                with self.pool.connection() as sftp:
+                    self.pool.makedirs(sftp, remote_dir)
+                    return func(sftp)
+            except SFTP_ERRORS as e:
+                logger.info('%s on %d attempt, retrying sftp', e.__class__.__name__, attempts)
+                # The directory might have been removed in the meantime
+                self.pool.forget_dir(remote_dir)
+                attempts += 1
+                if attempts > 10:
+                    raise e
 
     def sync_resources(self, instance, formats=None, delay=False, prefetch=True, purge=True):
         '''
@@ -379,92 +692,57 @@ class CDN77ContentServer(ContentServer):
 
         # TODO: should set content_server_ready to false while we sync.
 
-        with pysftp.Connection(self.host, username=self.username, password=self.password) as sftp:
-            for fmt in formats:
-                if fmt == 'zoomify':
-                    # The photoshop server calls 'zoomable' 'zoomify'
-                    fmt = 'zoomable'
+        # Build the list of files and directories to upload
+        uploads = []
+        for fmt in formats:
+            if fmt == 'zoomify':
+                # The photoshop server calls 'zoomable' 'zoomify'
+                fmt = 'zoomable'
 
-                # We only upload formats supported by the content Server
-                # (in case specific formats are specified in the method call)
-                if fmt not in archive_formats:
-                    continue
+            # We only upload formats supported by the content Server
+            # (in case specific formats are specified in the method call)
+            if fmt not in archive_formats:
+                continue
+
+            # Get the local resource (if any)
+            resource = getattr(instance, '%s%s' % (instance.Archive.Meta.resource_fields_prefix, fmt), None)
 
-                # Get the local resource (if any)
-                resource = getattr(instance, '%s%s' % (instance.Archive.Meta.resource_fields_prefix, fmt), None)
+            if not resource:
+                continue
 
-                if not resource:
-                    continue
+            # Skip the resource if it's a filewith size 0
+            if os.path.isfile(resource.path) and resource.size == 0:
+                logger.warning('Skipping empty file: %s', resource.path)
+                continue
 
-                # Skip the resource if it's a filewith size 0
-                if os.path.isfile(resource.path) and resource.size == 0:
-                    logger.warning('Skipping empty file: %s', resource.path)
-                    continue
+            # Build the remote path on the server
 
-                # Build the remote path on the server
+            # Resource name can include Archive.Meta.root depending on whether
+            # it's already been uploaded to the CDN, so we add it conditionally:
+            if resource.name.startswith(instance.Archive.Meta.root):
+                remote_path = os.path.join(self.remote_dir, resource.name)
+            else:
+                remote_path = os.path.join(self.remote_dir, instance.Archive.Meta.root, resource.name)
+
+            uploads.append((resource.path, remote_path))
+
+        # Upload the formats concurrently, each worker uses its own
+        # connection from the pool
+        start = time.time()
+        if len(uploads) > 1:
+            workers = ThreadPool(min(self.workers, len(uploads)))
+            try:
+                # Raises the first error (if any) once all uploads are done
+                results = workers.map(lambda upload: self._upload(*upload), uploads, chunksize=1)
+            finally:
+                workers.close()
+                workers.join()
+        else:
+            results = [self._upload(*upload) for upload in uploads]
 
-                # Resource name can include Archive.Meta.root depending on whether
-                # it's already been uploaded to the CDN, so we add it conditionally:
-                if resource.name.startswith(instance.Archive.Meta.root):
-                    remote_path = os.path.join(self.remote_dir, resource.name)
-                else:
-                    remote_path = os.path.join(self.remote_dir, instance.Archive.Meta.root, resource.name)
-
-                # Check that the remote directory exists, and create it if necessary
-                remote_dir = os.path.dirname(remote_path)
-                if not sftp.exists(remote_dir):
-                    logger.info('Creating missing directory: %s:%s', self.host, remote_dir)
-                    sftp.makedirs(remote_dir)
-
-                # CD to the correct directory and upload the file
-                with sftp.cd():
-                    sftp.cwd(remote_dir)
-                    if os.path.isdir(resource.path):
-                        logger.info('Uploading directory %s to %s:%s', resource.name, self.host, remote_path)
-                        # We don't use sftp.put_r to upload directories as even though pysftps' doc
-                        # says that it will not complain if the target dir already exists, in practice it
-                        # raises an IOError
-
-                        # Make sure that we won't rsync to the root:
-                        if remote_path == self.remote_dir:
-                            raise Exception('remote_path is equal to root dir: %s', remote_path)
-
-                        cmd = [
-                            'rsync',
-                            '-a',
-                            '--delete',
-                            '%s/' % resource.path,
-                            '%s@%s:%s/' % (self.username, self.host, remote_path),
-                        ]
-
-                        # In case there is an error with rsync we retry up to
-                        # 50 times
-                        i = 0
-                        while True:
-                            retcode = subprocess.call(cmd)
-                            if retcode == 0:
-                                break
-
-                            if i < 50:
-                                logger.info('Rsync exited with code %d, trying again.', retcode)
-                                time.sleep(2)
-                            else:
-                                raise Exception('Rsync exited with code %d, check logs', retcode)
-
-                            i += 1
-                    else:
-                        logger.info('Uploading %s to %s:%s', resource.name, self.host, remote_dir)
-                        attempts = 0
-                        while True:
-                            # In case the sftp fails we try again up to 10x
-                            try:
-                                sftp.put(resource.path)
-                                break
-                            except IOError as e:
-                                logger.info('IOError on %d attempt, retrying sftp.put()', attempts)
-                                attempts += 1
-                                if attempts > 10:
-                                    raise e
+        logger.info('Synchronised %d formats of %s %s in %.1fs (%d skipped)',
+            len(uploads), instance.__class__.__name__, instance.pk,
+            time.time() - start, results.count(False))
 
         # We set the content server to ready as soon as the files are
         # synchronised, we don't have to wait until it's purged/prefetched
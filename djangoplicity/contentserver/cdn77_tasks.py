@@ -40,5 +40,9 @@ def purge_prefetch():
     from djangoplicity.media.consts import MEDIA_CONTENT_SERVERS
 
     content_server = MEDIA_CONTENT_SERVERS['CDN77']
-    content_server.purge_prefetch('purge')
-    content_server.purge_prefetch('prefetch')
+    batches = content_server.process_queues()
+
+    # The URLs of the failed batches were queued again for the next run
+    errors = [b for b in batches if b['error']]
+    if errors:
+        raise Exception('%d of %d purge/prefetch batches failed' % (len(errors), len(batches)))
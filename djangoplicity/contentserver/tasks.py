@@ -40,6 +40,7 @@ from django.core.mail import send_mail
 from django.core.urlresolvers import reverse
 
 from djangoplicity.archives.loading import get_archives
+from djangoplicity.archives.resources import wait_for_resources_ready
 from djangoplicity.celery.serialtaskset import str_keys
 from djangoplicity.media.consts import MEDIA_CONTENT_SERVERS
 
@@ -72,6 +73,9 @@ def sync_content_server(module_path, cls_name, instance_id, formats=None,
         return
 
     if hasattr(instance, 'content_server') and instance.content_server:
+        # Wait until NFS shows the files written by the previous task
+        wait_for_resources_ready(instance, formats)
+
         try:
             content_server = MEDIA_CONTENT_SERVERS[instance.content_server]
             content_server.sync_resources(instance, formats, delay, prefetch, purge)
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+#
+# djangoplicity
+# Copyright (c) 2007-2015, European Southern Observatory (ESO)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#
+#    * Neither the name of the European Southern Observatory nor the names
+#      of its contributors may be used to endorse or promote products derived
+#      from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY ESO ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL ESO BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE
+
+import os
+import shutil
+import tempfile
+
+from django.core.cache import cache
+from django.test import override_settings
+
+from djangoplicity.contentserver.base import CDN77ContentServer
+from djangoplicity.media.models.images import Image
+from djangoplicity.test.base_tests import BasicTestCase
+
+try:
+    from mock import MagicMock, patch
+except ImportError:
+    from unittest.mock import MagicMock, patch
+
+
+class LocalConnection(object):
+    '''
+    Stand-in for pysftp.Connection working on the local file system
+    '''
+    def exists(self, path):
+        return os.path.exists(path)
+
+    def makedirs(self, path):
+        os.makedirs(path)
+
+    def stat(self, path):
+        # paramiko raises IOError for missing files
+        try:
+            return os.stat(path)
+        except OSError as e:
+            raise IOError(e.errno, e.strerror)
+
+    def put(self, localpath, remotepath, preserve_mtime=False):
+        if preserve_mtime:
+            shutil.copy2(localpath, remotepath)
+        else:
+            shutil.copy(localpath, remotepath)
+
+    def close(self):
+        pass
+
+
+class FakeFrame(object):
+    def __init__(self, delivery_tag, message_count):
+        self.delivery_tag = delivery_tag
+        self.message_count = message_count
+
+
+class FakeBroker(object):
+    '''
+    In-memory stand-in for the RabbitMQ connection and channel
+    '''
+    def __init__(self):
+        self.queues = {}
+
+    def __call__(self):
+        return self, self
+
+    def queue_declare(self, queue, durable=False):
+        self.queues.setdefault(queue, [])
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.queues.setdefault(routing_key, []).append(body)
+
+    def basic_get(self, queue):
+        if not self.queues.get(queue):
+            return None, None, None
+        body = self.queues[queue].pop(0)
+        return FakeFrame(1, len(self.queues[queue])), None, body
+
+    def basic_ack(self, delivery_tag):
+        pass
+
+    def close(self):
+        pass
+
+
+class CDN77ContentServerTestCase(BasicTestCase):
+    fixtures = ['media']
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.remote_dir = tempfile.mkdtemp()
+        for fmt in ('screen', 'large'):
+            os.makedirs(os.path.join(self.media_root, Image.Archive.Meta.root, fmt))
+            with open(os.path.join(self.media_root, Image.Archive.Meta.root, fmt, 'image-1.jpg'), 'w') as f:
+                f.write(fmt)
+
+        self.connections = []
+
+        def factory():
+            self.connections.append(LocalConnection())
+            return self.connections[-1]
+
+        self.broker = FakeBroker()
+        self.api_calls = []
+
+        def api_client(method, params):
+            self.api_calls.append((method, params['cdn_id'], params['url[]']))
+            return {}
+
+        self.server = CDN77ContentServer('CDN77', {
+            'djangoplicity.media.models.images.Image': ['screen', 'large', 'thumb'],
+        }, remote_dir=self.remote_dir, workers=2, connection_factory=factory,
+            cdn_id='1', broker_factory=self.broker, api_client=api_client)
+
+    def tearDown(self):
+        shutil.rmtree(self.media_root)
+        shutil.rmtree(self.remote_dir)
+
+    def test_sync_resources(self):
+        with override_settings(MEDIA_ROOT=self.media_root):
+            instance = Image.objects.get(id='image-1')
+
+            self.server.sync_resources(instance, prefetch=False, purge=False)
+            for fmt in ('screen', 'large'):
+                with open(os.path.join(self.remote_dir, Image.Archive.Meta.root, fmt, 'image-1.jpg')) as f:
+                    self.assertEqual(f.read(), fmt)
+            self.assertTrue(Image.objects.get(id='image-1').content_server_ready)
+
+            # Connections are reused and up to date files are skipped
+            with patch.object(LocalConnection, 'put') as put_mock, \
+                    patch.object(LocalConnection, 'exists') as exists_mock:
+                self.server.sync_resources(instance, prefetch=False, purge=False)
+                self.assertFalse(put_mock.called)
+                self.assertFalse(exists_mock.called)
+            self.assertLessEqual(len(self.connections), 2)
+
+    @patch('djangoplicity.contentserver.base.subprocess.call', return_value=0)
+    def test_upload_retry(self, call_mock):
+        """ uploads are retried with a new connection if the first one is dead """
+        dead = MagicMock()
+        dead.exists.side_effect = EOFError()
+        connections = [dead]
+
+        def factory():
+            return connections.pop(0) if connections else LocalConnection()
+
+        self.server.connection_factory = factory
+
+        path = os.path.join(self.media_root, Image.Archive.Meta.root, 'screen')
+        remote_path = os.path.join(self.remote_dir, 'zoomable', 'image-1')
+        self.assertTrue(self.server._upload(path, remote_path))
+        self.assertTrue(dead.close.called)
+        self.assertTrue(os.path.isdir(os.path.dirname(remote_path)))
+        self.assertTrue(call_mock.called)
+
+        # Same for files, the pooled connection is dropped by the server
+        path = os.path.join(path, 'image-1.jpg')
+        with patch.object(LocalConnection, 'stat', side_effect=[EOFError(), IOError()]):
+            self.assertTrue(self.server._upload(path, os.path.join(self.remote_dir, 'image-1.jpg')))
+
+    @patch('djangoplicity.contentserver.base.purge_prefetch')
+    def test_purge_prefetch(self, purge_prefetch_mock):
+        with override_settings(MEDIA_ROOT=self.media_root):
+            instance = Image.objects.get(id='image-1')
+
+            # Requests are coalesced in a single run
+            self.server._queue_purge_prefetch(instance, ['screen', 'large'], False, True, True)
+            self.server._queue_purge_prefetch(instance, ['screen'], False, True, True)
+            self.assertEqual(purge_prefetch_mock.apply_async.call_count, 1)
+
+            batches = self.server.process_queues()
+            self.assertEqual(len(batches), 2)
+            self.assertFalse([b for b in batches if b['error']])
+
+            # URLs are deduplicated
+            urls = sorted([os.path.join('/', Image.Archive.Meta.root, fmt, 'image-1.jpg') for fmt in ('screen', 'large')])
+            self.assertEqual(sorted(self.api_calls[0][2]), urls)
+            self.assertEqual(self.api_calls[0][0], 'data/purge')
+            self.assertEqual(sorted(self.api_calls[1][2]), urls)
+            self.assertEqual(self.api_calls[1][0], 'data/prefetch')
+
+            # A new run is scheduled for the next requests
+            self.server._queue_purge_prefetch(instance, ['screen'], False, True, True)
+            self.assertEqual(purge_prefetch_mock.apply_async.call_count, 2)
+
+    @patch('djangoplicity.contentserver.base.purge_prefetch')
+    def test_purge_prefetch_failed(self, purge_prefetch_mock):
+        with override_settings(MEDIA_ROOT=self.media_root):
+            instance = Image.objects.get(id='image-1')
+            self.server._queue_purge_prefetch(instance, ['screen'], False, False, True)
+            cache.delete(self.server._schedule_key)
+
+            # The URLs of failed batches are queued again for a new run
+            with patch.object(self.server, 'api_client', return_value=None):
+                batches = self.server.process_queues()
+            self.assertEqual([b['error'] for b in batches], ['Failed API call'] * 2)
+            for queue in (self.server.purge_queue, self.server.prefetch_queue):
+                self.assertEqual(len(self.broker.queues[queue]), 1)
+            self.assertEqual(purge_prefetch_mock.apply_async.call_args[1], {'countdown': 60})
+
+            batches = self.server.process_queues()
+            self.assertEqual([b['error'] for b in batches], [None] * 2)
+            urls = [os.path.join('/', Image.Archive.Meta.root, 'screen', 'image-1.jpg')]
+            self.assertEqual(self.api_calls, [('data/purge', '1', urls), ('data/prefetch', '1', urls)])
+            for queue in (self.server.purge_queue, self.server.prefetch_queue):
+                self.assertFalse(self.broker.queues[queue])
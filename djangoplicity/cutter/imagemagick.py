@@ -38,7 +38,11 @@ import math
 import os
 import shutil
 import stat
+import time
 from collections import OrderedDict
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from Queue import Queue
 from subprocess import PIPE, Popen
 
 from django.apps import apps
@@ -47,9 +51,11 @@ from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
 from django.core.mail import send_mail, mail_admins
 from django.template.loader import get_template
+from PIL import Image as PILImage
 
 from djangoplicity.archives.base import cache_handler
-from djangoplicity.archives.resources import ImageResourceManager
+from djangoplicity.archives.resources import ImageResourceManager, \
+    update_resource_manifest, mark_resources_ready
 from djangoplicity.archives.utils import wait_for_resource
 
 
@@ -68,6 +74,10 @@ if os.path.isdir(IM_TMP_DIR):
 CONVERT = '%s %s %s' % (os.path.join(IM_PATH, 'convert'), IM_LIMITS, CONVERT_DEFAULTS)
 IDENTIFY = '%s %s' % (os.path.join(IM_PATH, 'identify'), IM_LIMITS)
 
+# Maximum number of convert processes run in parallel for one image. Each
+# process is also bound by IM_LIMITS.
+IM_PROCESSES = getattr(settings, 'DJANGOPLICITY_CUTTER_PROCESSES', min(4, cpu_count()))
+
 SRGB_PROFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
                            'icc', 'sRGB-IEC61966-2.1.icc')
 
@@ -237,136 +247,329 @@ def _order_formats(model, formats):
     return OrderedDict(res)
 
 
+ZOOMIFY_TILE_SIZE = 256
+
+# Number of threads encoding Zoomify tiles
+ZOOMIFY_PROCESSES = getattr(settings, 'DJANGOPLICITY_ZOOMIFY_PROCESSES', 1)
+
+
+def _zoomify_tiers(width, height):
+    '''
+    Return the list of (width, height) of each Zoomify tier, starting with the
+    smallest one (tier 0, which fits in a single tile). Each tier is half the
+    size of the next one.
+    '''
+    tiers = [(width, height)]
+    while width > ZOOMIFY_TILE_SIZE or height > ZOOMIFY_TILE_SIZE:
+        width, height = width // 2, height // 2
+        tiers.insert(0, (width, height))
+    return tiers
+
+
+class _ZoomifyTier(object):
+    '''
+    Receives the rows of one tier in strips, writes the tiles of each complete
+    row of tiles and passes the strip, downsampled by 2, to the lower tier.
+    '''
+    def __init__(self, number, width, height, offset, writer, lower):
+        self.number = number
+        self.width = width
+        self.height = height
+        self.offset = offset  # Index of the first tile of this tier
+        self.columns = int(math.ceil(width / ZOOMIFY_TILE_SIZE))
+        self.writer = writer
+        self.lower = lower
+        self.row = 0
+        self.strips = []
+        self.buffered = 0
+        self.received = 0
+
+    def add(self, strip):
+        # Rows beyond the tier height come from rounding in the upper tier
+        rows = min(strip.size[1], self.height - self.received)
+        if rows <= 0:
+            return
+        if rows < strip.size[1]:
+            strip = strip.crop((0, 0, strip.size[0], rows))
+
+        self.received += rows
+        self.strips.append(strip)
+        self.buffered += rows
+
+        if self.buffered >= ZOOMIFY_TILE_SIZE or self.received == self.height:
+            self.flush()
+
+    def flush(self):
+        if not self.strips:
+            return
+
+        if len(self.strips) == 1:
+            strip = self.strips[0]
+        else:
+            strip = PILImage.new('RGB', (self.strips[0].size[0], self.buffered))
+            y = 0
+            for s in self.strips:
+                strip.paste(s, (0, y))
+                y += s.size[1]
+        self.strips = []
+        self.buffered = 0
+
+        tiles = []
+        for column in range(self.columns):
+            x = column * ZOOMIFY_TILE_SIZE
+            box = (x, 0, min(x + ZOOMIFY_TILE_SIZE, self.width), strip.size[1])
+            index = self.offset + self.row * self.columns + column
+            tiles.append((index, '%d-%d-%d.jpg' % (self.number, column, self.row), strip.crop(box)))
+        self.writer(tiles)
+        self.row += 1
+
+        if self.lower is not None:
+            size = (self.lower.width, strip.size[1] // 2)
+            if size[1] > 0:
+                self.lower.add(strip.resize(size, PILImage.BOX))
+
+
 def _generate_zoomify(archive, width, height, tmp_dir, dest_dir):
     '''
     Generate a zoomify image for the given archive
-    Starting from the original image we create tiles of 256x256 pixels
-    We then shrink the image by 50% and create a new tier of tiles, until
-    we only have one tile of <=256px
+    The original image is read in strips of 256 rows from a single convert
+    process. Each strip is cut in tiles of 256x256 pixels and passed on to
+    the next tier, which is half the size, until we only have one tile of
+    <=256px. Tiles are written directly in their TileGroup: tiles are
+    numbered by increasing tier number, and then left to right, top to
+    bottom, with 256 tiles per TileGroup.
     '''
     # Check that the image is larger than 256px in at least one dimension:
-    if width <= 256 and height <= 256:
+    if width <= ZOOMIFY_TILE_SIZE and height <= ZOOMIFY_TILE_SIZE:
         logger.info('Image too small to zoomify: %dx%d', width, height)
         return
 
-    # Calculate the number of tiers needed
-    if width > height:
-        size = width
-    else:
-        size = height
-    tiers = math.ceil(math.log((size / 256), 2))
-
-    source = archive.resource_original.path
-
-    tiles_dir = os.path.join(tmp_dir, 'tiles')
-    if not os.path.exists(tiles_dir):
-        os.makedirs(tiles_dir)
-
-    while True:
-        # Generate tiles for given tier
-        logger.debug('Generating tiles for Zoomify tier %d', tiers)
-        args = CONVERT.split() + [
-            source, '-flatten', '-crop', '256x256', '-strip', '-set',
-            'filename:tile', '%[fx:page.x/256]-%[fx:page.y/256]', '+repage',
-            '+adjoin', '-quality', '85',
-            '%s/%d-%%[filename:tile].jpg' % (tiles_dir, tiers)
-        ]
-        logger.debug(' '.join(args))
+    zoomable_dir = os.path.join(tmp_dir, archive.pk, '')  # '' is to add trailing /
+    if not os.path.exists(zoomable_dir):
+        os.makedirs(zoomable_dir)
 
-        convert = Popen(args)
-        convert.communicate()
+    tile_groups = set()
 
-        tiers -= 1
+    def write_tile(tile):
+        index, filename, image = tile
+        image.save(os.path.join(zoomable_dir, 'TileGroup%d' % (index // 256), filename), 'JPEG', quality=85)
 
-        if tiers < 0:
-            break
+    pool = ThreadPool(ZOOMIFY_PROCESSES) if ZOOMIFY_PROCESSES > 1 else None
 
-        # Generate source for next tier
-        next_tier_source = os.path.join(tmp_dir, 'tier_%d_source.mpc' % tiers)
-        args = CONVERT.split() + [
-            source, '-resize', '50%', next_tier_source
-        ]
+    def writer(tiles):
+        for index, _filename, _image in tiles:
+            group = index // 256
+            if group not in tile_groups:
+                os.makedirs(os.path.join(zoomable_dir, 'TileGroup%d' % group))
+                tile_groups.add(group)
+        if pool is not None:
+            pool.map(write_tile, tiles)
+        else:
+            for tile in tiles:
+                write_tile(tile)
+
+    # Build the tiers, from the largest to the smallest
+    sizes = _zoomify_tiers(width, height)
+    counts = [int(math.ceil(w / ZOOMIFY_TILE_SIZE)) * int(math.ceil(h / ZOOMIFY_TILE_SIZE)) for (w, h) in sizes]
+    count = sum(counts)
+    tier = None
+    for number in range(len(sizes)):
+        w, h = sizes[number]
+        tier = _ZoomifyTier(number, w, h, sum(counts[:number]), writer, tier)
+    # The lowest tier was created first, 'tier' is now the full size one
+
+    args = CONVERT.split() + [archive.resource_original.path, '-flatten',
+        '-depth', '8', 'rgb:-']
+    logger.debug(' '.join(args))
+
+    convert = Popen(args, stdout=PIPE)
+    try:
+        strip_size = width * 3 * ZOOMIFY_TILE_SIZE
+        rows = 0
+        while rows < height:
+            data = convert.stdout.read(min(strip_size, width * 3 * (height - rows)))
+            if not data or len(data) % (width * 3):
+                break
+            strip = PILImage.frombytes('RGB', (width, len(data) // (width * 3)), data)
+            rows += strip.size[1]
+            tier.add(strip)
+    finally:
+        convert.stdout.close()
+        convert.wait()
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if rows < height:
+        raise Exception('Could not generate zoomify for "%s": read %d of %d rows' % (archive.pk, rows, height))
 
-        logger.debug('Generating source for tier %d', tiers)
+    # Generate XML configuration file
+    template = get_template('cutter/zoomify.xml')
+    with open(os.path.join(zoomable_dir, 'ImageProperties.xml'), 'w') as f:
+        f.write(template.render({'width': width, 'height': height, 'numtiles': count}))
+
+    # Remove old files and put the new files in place
+    target = os.path.join(dest_dir, 'zoomable/')
+    if not os.path.exists(target):
+        logger.debug('Creating missing targer directory: %s', target)
+        os.makedirs(target)
+    old_zoomify = os.path.join(dest_dir, 'zoomable', archive.pk)
+    if os.path.exists(old_zoomify):
+        logger.info('Deleting old zoomify "%s"', old_zoomify)
+        shutil.rmtree(old_zoomify)
+
+    logger.debug('Moving "%s" to "%s"', zoomable_dir, target)
+    shutil.move(zoomable_dir, target)
+
+
+def _create_mpc(archive, name, source_path, tmp_dir):
+    '''
+    Decode source_path into a MPC file (ImageMagick's memory mappable
+    format) which is used as input by all formats derived from it.
+    '''
+    tmp_path = os.path.join(tmp_dir, '%s-%s.mpc' % (archive.pk, name))
+    if not os.path.exists(tmp_path):
+        logger.debug('Creating MPC file: %s', tmp_path)
+        # -background none is to keep the transparency untouched (if any)
+        args = CONVERT.split() + [source_path, '-alpha', 'Deactivate',
+            '-flatten', tmp_path]
         logger.debug(' '.join(args))
+
         convert = Popen(args)
         convert.communicate()
 
-        source = next_tier_source
+    return tmp_path
 
-    zoomable_dir = os.path.join(tmp_dir, archive.pk, '')  # '' is to add trailing /
-    if not os.path.exists(zoomable_dir):
-        os.makedirs(zoomable_dir)
 
-    # Get numerically sorted list of files
-    def filename_to_int_list(filename):
-        filename = filename.rstrip('.jpg')
-        return [int(x) for x in filename.split('-')]
+def _generate_format(archive, width, height, fmt, derived, tmp_dir, dest_dir):
+    '''
+    Generate the format fmt from the MPC file of the format derived, and
+    move it in place. Returns the path of the generated file.
+    '''
+    pk = archive.pk
+    fmt_name = fmt.name
+    tmp_path = os.path.join(tmp_dir, '%s-%s.mpc' % (pk, derived))
 
-    def tile_cmp(x, y):
-        '''
-        Compare two tiles filenames, filenames are of the form:
-        <tier number>-<column-number>-<row number>.jpg
-        Tiles are sorted by increasing Tier number, and then by left to right,
-        top top bottom
-        '''
-        x = filename_to_int_list(x)
-        y = filename_to_int_list(y)
+    # Create output directory
+    output_dir = os.path.join(tmp_dir, fmt.name)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
 
-        if x[0] < y[0]:
-            return -1
+    convert_args = _get_convert_args(archive, width, height, fmt,
+                        tmp_path, output_dir)
 
-        if x[0] > y[0]:
-            return 1
+    env = {}
+    if os.path.isdir(IM_TMP_DIR):
+        env['MAGICK_TMPDIR'] = IM_TMP_DIR
 
-        if x[2] < y[2]:
-            return -1
+    logger.debug('Generating "%s" from "%s": %s', fmt_name, derived,
+                    ' '.join(convert_args))
 
-        if x[2] > y[2]:
-            return 1
+    convert = Popen(convert_args, env=env)
+    convert.communicate()
 
-        if x[1] < y[1]:
-            return -1
+    # Copy the output files to the archive
+    path = glob.glob(os.path.join(tmp_dir, fmt_name, '%s.*' % pk))
+    if not path:
+        raise Exception('Could not generate %s for "%s"' % (fmt_name, pk))
 
-        if x[1] > y[1]:
-            return 1
+    fmt_dir = os.path.join(dest_dir, fmt_name)
+    if not os.path.exists(fmt_dir):
+        try:
+            os.makedirs(fmt_dir)
+        except OSError as e:
+            # Created by another job meanwhile
+            if e.errno != errno.EEXIST:
+                raise
 
-        return 0  # Should never happen
+    dest_path = os.path.join(fmt_dir, os.path.basename(path[0]))
+    shutil.move(path[0], dest_path)
 
-    fileslist = sorted(os.listdir(tiles_dir), cmp=tile_cmp)
+    # Make sure permissions are correct
+    os.chmod(dest_path, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH)
 
-    i = 0  # Current TileGroup index
-    count = 0
-    tile_group_path = ''
+    return dest_path
 
-    for filename in fileslist:
-        if count % 256 == 0:
-            tile_group_path = os.path.join(zoomable_dir, 'TileGroup%d' % i)
-            i += 1
-            os.makedirs(tile_group_path)
 
-        # Move the current tile in the TileGroup directory
-        shutil.move(os.path.join(tiles_dir, filename), tile_group_path)
+def _run_jobs(archive, jobs, width, height, tmp_dir, dest_dir):
+    '''
+    Run the jobs (an ordered dict of format name and (format, name of the
+    format it's derived from, source resource)) in a pool of IM_PROCESSES
+    threads, each of them waiting for a convert process.
+
+    A job is started as soon as the MPC file of its source exists: MPC files
+    of the original and of existing resources are created first, MPC files
+    of generated formats are created by the job generating the format if
+    other formats are derived from it. Each source is thus decoded only
+    once.
+    '''
+    if not jobs:
+        return
 
-        count += 1
+    # Jobs waiting for a given source
+    waiting = {}
+    for fmt_name, (fmt, derived, source) in jobs.items():
+        waiting.setdefault(derived, []).append(fmt_name)
 
-    # Generate XML configuration file
-    template = get_template('cutter/zoomify.xml')
-    with open(os.path.join(zoomable_dir, 'ImageProperties.xml'), 'w') as f:
-        f.write(template.render({'width': width, 'height': height, 'numtiles': count}))
-
-    # Remove old files and put the new files in place
-    target = os.path.join(dest_dir, 'zoomable/')
-    if not os.path.exists(target):
-        logger.debug('Creating missing targer directory: %s', target)
-        os.makedirs(target)
-    old_zoomify = os.path.join(dest_dir, 'zoomable', archive.pk)
-    if os.path.exists(old_zoomify):
-        logger.info('Deleting old zoomify "%s"', old_zoomify)
-        shutil.rmtree(old_zoomify)
+    def run(name, label, func, *args):
+        start = time.time()
+        try:
+            func(*args)
+        except Exception as e:
+            logger.exception('Error while generating "%s" for %s', label, archive.pk)
+            return (name, e)
+        logger.info('Generated "%s" for %s in %.1fs', label, archive.pk, time.time() - start)
+        return (name, None)
+
+    def run_format(fmt, derived):
+        if derived is None:
+            _generate_zoomify(archive, width, height, tmp_dir, dest_dir)
+        else:
+            dest_path = _generate_format(archive, width, height, fmt, derived, tmp_dir, dest_dir)
+            if fmt.name in waiting:
+                _create_mpc(archive, fmt.name, dest_path, tmp_dir)
+
+    done = Queue()
+    pool = ThreadPool(IM_PROCESSES)
+    pending = 0
+    errors = []
+
+    def submit(name):
+        if name in jobs:
+            fmt, derived, _source = jobs[name]
+            logger.info('Generating "%s" for %s', name, archive.pk)
+            args = (name, name, run_format, fmt, derived)
+        else:
+            # Original or existing resource used as source
+            source = jobs[waiting[name][0]][2]
+            args = (name, '%s MPC' % name, _create_mpc, archive, name, source.path, tmp_dir)
+        pool.apply_async(run, args, callback=done.put)
 
-    logger.debug('Moving "%s" to "%s"', zoomable_dir, target)
-    shutil.move(zoomable_dir, target)
+    try:
+        for name in waiting.get(None, []):
+            submit(name)
+            pending += 1
+        for name in waiting:
+            if name is not None and name not in jobs:
+                submit(name)
+                pending += 1
+
+        while pending:
+            name, error = done.get()
+            pending -= 1
+
+            if error is not None:
+                errors.append(error)
+            elif not errors:
+                for child in waiting.get(name, []):
+                    submit(child)
+                    pending += 1
+    finally:
+        pool.close()
+        pool.join()
+
+    if errors:
+        raise errors[0]
 
 
 def identify_image(path):
@@ -434,6 +637,9 @@ def process_image_derivatives(app_label, module_name, pk, formats,
 
     dest_dir = os.path.join(settings.MEDIA_ROOT, archive.Archive.Meta.root)
 
+    # Resources have just been imported or renamed
+    update_resource_manifest(archive)
+
     original = wait_for_resource(archive)
 
     if not original:
@@ -449,6 +655,10 @@ def process_image_derivatives(app_label, module_name, pk, formats,
     missing_required = []
     upscaled_formats = []
 
+    # Formats to generate, with the name of the format they are generated
+    # from, in dependency order
+    jobs = OrderedDict()
+
     for fmt_name in ordered_formats.keys():
         fmt = ordered_formats[fmt_name]
         derived = fmt.derived
@@ -466,16 +676,14 @@ def process_image_derivatives(app_label, module_name, pk, formats,
             continue
 
         if fmt.type.verbose_name == 'Zoomable':
-            logger.info('Generating "%s" for %s', fmt.name, archive.pk)
-            _generate_zoomify(archive, width, height, tmp_dir, dest_dir)
+            # Zoomify reads the original itself
+            jobs[fmt_name] = (fmt, None, None)
             continue
 
         if not fmt.type.exts:
             # This format isn't generated by Imagemagick
             continue
 
-        logger.info('Generating "%s" for %s', fmt.name, archive.pk)
-
         if derived == 'original':
             source = original
         else:
@@ -488,8 +696,11 @@ def process_image_derivatives(app_label, module_name, pk, formats,
             if _format_is_gte_width_height(source_fmt, width, height):
                 source = original
                 derived = 'original'
+            elif derived in jobs:
+                # The source is generated by a previous job
+                source = None
 
-        if not source:
+        if not source and derived not in jobs:
             logger.debug('No source for %s (%s)', fmt_name, derived)
             continue
 
@@ -517,50 +728,9 @@ def process_image_derivatives(app_label, module_name, pk, formats,
                 upscaled_formats.append(fmt)
                 logger.info('Upscaling "%s" for format %s', archive.pk, fmt_name)
 
-        # Create temporary MPC file
-        tmp_path = os.path.join(tmp_dir, '%s-%s.mpc' % (archive.pk, derived))
-        if not os.path.exists(tmp_path):
-            logger.debug('Creating MPC file: %s', tmp_path)
-            # -background none is to keep the transparency untouched (if any)
-            args = CONVERT.split() + [source.path, '-alpha', 'Deactivate',
-                '-flatten', tmp_path]
-            logger.debug(' '.join(args))
-
-            convert = Popen(args)
-            convert.communicate()
+        jobs[fmt_name] = (fmt, derived, source)
 
-        # Create output directory
-        output_dir = os.path.join(tmp_dir, fmt.name)
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-
-        convert_args = _get_convert_args(archive, width, height, fmt,
-                            tmp_path, output_dir)
-
-        env = {}
-        if os.path.isdir(IM_TMP_DIR):
-            env['MAGICK_TMPDIR'] = IM_TMP_DIR
-
-        logger.debug('Generating "%s" from "%s": %s', fmt_name, derived,
-                        ' '.join(convert_args))
-
-        convert = Popen(convert_args, env=env)
-        convert.communicate()
-
-        # Copy the output files to the archive
-        path = glob.glob(os.path.join(tmp_dir, fmt_name, '%s.*' % pk))
-        if not path:
-            raise Exception('Could not generate %s for "%s"' % (fmt_name, pk))
-
-        fmt_dir = os.path.join(dest_dir, fmt_name)
-        if not os.path.exists(fmt_dir):
-            os.makedirs(fmt_dir)
-
-        dest_path = os.path.join(fmt_dir, os.path.basename(path[0]))
-        shutil.move(path[0], dest_path)
-
-        # Make sure permissions are correct
-        os.chmod(dest_path, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH)
+    _run_jobs(archive, jobs, width, height, tmp_dir, dest_dir)
 
     subject = None
     message = None
@@ -613,5 +783,8 @@ Please verify that the following images have been upscaled correctly:
                 fail_silently=True,
             )
 
+    update_resource_manifest(archive)
+    mark_resources_ready(archive)
+
     # Clear the cache for the archive
     cache_handler(model, created=False, instance=archive)
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+#
+# djangoplicity-cutter
+# Copyright (c) 2007-2016, European Southern Observatory (ESO)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#
+#    * Neither the name of the European Southern Observatory nor the names
+#      of its contributors may be used to endorse or promote products derived
+#      from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY ESO ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL ESO BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE
+
+
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from django.test import SimpleTestCase
+from PIL import Image as PILImage
+
+try:
+    from mock import patch
+except ImportError:
+    from unittest.mock import patch
+
+from djangoplicity.cutter import imagemagick
+
+
+class FakeType(object):
+    def __init__(self, size):
+        self.size = size
+        self.width = None
+        self.height = None
+        self.exts = ['jpg']
+        self.unsharp = 0
+
+
+class FakeFormat(object):
+    def __init__(self, name, size):
+        self.name = name
+        self.type = FakeType(size)
+
+
+class FakeResource(object):
+    def __init__(self, path):
+        self.path = path
+
+
+class FakeArchive(object):
+    pk = 'test-image'
+    resource_original = FakeResource('/tmp/test-image.tif')
+
+
+class FakePopen(object):
+    '''
+    Stand-in for a convert process: records the calls, the number of
+    processes running at once, and writes the output file unless the output
+    is one of the failing ones.
+    '''
+    lock = threading.Lock()
+
+    def __init__(self, args, **kwargs):
+        self.args = args
+
+    def communicate(self):
+        cls = self.__class__
+        output = self.args[-1].split(':')[-1]
+        with cls.lock:
+            cls.running += 1
+            cls.max_running = max(cls.max_running, cls.running)
+            # All the inputs of a format must have been decoded already
+            for arg in self.args[:-1]:
+                if arg.endswith('.mpc') and not os.path.exists(arg):
+                    cls.missing.append(arg)
+            cls.calls.append(output)
+        time.sleep(0.05)
+        with cls.lock:
+            cls.running -= 1
+        if os.path.basename(os.path.dirname(output)) not in cls.failing:
+            with open(output, 'w') as f:
+                f.write('data')
+        return ('', '')
+
+    @classmethod
+    def reset(cls, failing=()):
+        cls.calls = []
+        cls.missing = []
+        cls.running = 0
+        cls.max_running = 0
+        cls.failing = failing
+
+
+class RunJobsTestCase(SimpleTestCase):
+    '''
+    Test the scheduling of the derived formats in _run_jobs, with a fake
+    convert.
+    '''
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.dest_dir = tempfile.mkdtemp()
+        self.archive = FakeArchive()
+        self.original = FakeResource(os.path.join(self.dest_dir, 'original', 'test-image.tif'))
+        FakePopen.reset()
+        self.patcher = patch('djangoplicity.cutter.imagemagick.Popen', FakePopen)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        shutil.rmtree(self.tmp_dir)
+        shutil.rmtree(self.dest_dir)
+
+    def mpc(self, name):
+        return os.path.join(self.tmp_dir, 'test-image-%s.mpc' % name)
+
+    def jobs(self):
+        # large <- original, medium <- large, thumb <- medium, screen <- original
+        jobs = OrderedDict()
+        jobs['large'] = (FakeFormat('large', 2000), 'original', self.original)
+        jobs['screen'] = (FakeFormat('screen', 1280), 'original', self.original)
+        jobs['medium'] = (FakeFormat('medium', 800), 'large', None)
+        jobs['thumb'] = (FakeFormat('thumb', 300), 'medium', None)
+        return jobs
+
+    def run_jobs(self, jobs):
+        '''
+        Run the jobs in a thread so that a stuck scheduler fails the test
+        instead of hanging it.
+        '''
+        result = {}
+
+        def target():
+            try:
+                imagemagick._run_jobs(self.archive, jobs, 4000, 3000, self.tmp_dir, self.dest_dir)
+            except Exception as e:
+                result['error'] = e
+
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        thread.join(10)
+        self.assertFalse(thread.is_alive(), '_run_jobs did not return')
+        return result.get('error')
+
+    def test_dependency_order(self):
+        self.assertIsNone(self.run_jobs(self.jobs()))
+
+        calls = FakePopen.calls
+        self.assertEqual(FakePopen.missing, [])
+
+        # Each source is decoded once, before the formats derived from it
+        self.assertEqual(calls.count(self.mpc('original')), 1)
+        self.assertEqual(calls[0], self.mpc('original'))
+        self.assertLess(calls.index(self.mpc('large')), calls.index(os.path.join(self.tmp_dir, 'medium', 'test-image.jpg')))
+        self.assertLess(calls.index(self.mpc('medium')), calls.index(os.path.join(self.tmp_dir, 'thumb', 'test-image.jpg')))
+
+        # Formats nothing is derived from don't need a MPC file
+        self.assertNotIn(self.mpc('screen'), calls)
+        self.assertNotIn(self.mpc('thumb'), calls)
+
+        for name in ('large', 'screen', 'medium', 'thumb'):
+            self.assertTrue(os.path.exists(os.path.join(self.dest_dir, name, 'test-image.jpg')))
+
+    def test_failure(self):
+        FakePopen.reset(failing=('large', ))
+
+        error = self.run_jobs(self.jobs())
+        self.assertIsNotNone(error)
+        self.assertIn('Could not generate large', str(error))
+
+        # Formats derived from the failed one are not started, the others are
+        calls = FakePopen.calls
+        self.assertNotIn(self.mpc('large'), calls)
+        self.assertNotIn(os.path.join(self.tmp_dir, 'medium', 'test-image.jpg'), calls)
+        self.assertNotIn(os.path.join(self.tmp_dir, 'thumb', 'test-image.jpg'), calls)
+        self.assertTrue(os.path.exists(os.path.join(self.dest_dir, 'screen', 'test-image.jpg')))
+
+    def test_processes(self):
+        jobs = OrderedDict()
+        for i in range(8):
+            name = 'format%d' % i
+            jobs[name] = (FakeFormat(name, 100 + i), 'original', self.original)
+
+        with patch('djangoplicity.cutter.imagemagick.IM_PROCESSES', 2):
+            self.assertIsNone(self.run_jobs(jobs))
+
+        self.assertEqual(len(FakePopen.calls), 9)
+        self.assertLessEqual(FakePopen.max_running, 2)
+
+
+class FakeConvertStream(object):
+    '''
+    Stand-in for a convert process writing the raw RGB pixels of an image
+    on its standard output.
+    '''
+    image = None
+
+    def __init__(self, args, **kwargs):
+        self.args = args
+        self.stdout = io.BytesIO(self.image.tobytes())
+
+    def wait(self):
+        return 0
+
+
+class ZoomifyTestCase(SimpleTestCase):
+    '''
+    Test the tiers and tiles of the streaming Zoomify generation.
+    '''
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.dest_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        shutil.rmtree(self.dest_dir)
+
+    def test_tiers(self):
+        self.assertEqual(imagemagick._zoomify_tiers(256, 100), [(256, 100)])
+        self.assertEqual(imagemagick._zoomify_tiers(513, 257), [(256, 128), (513, 257)])
+        self.assertEqual(imagemagick._zoomify_tiers(1025, 300), [(256, 75), (512, 150), (1025, 300)])
+        self.assertEqual(imagemagick._zoomify_tiers(300, 1025), [(75, 256), (150, 512), (300, 1025)])
+
+    def test_tier_tiles(self):
+        tiles = []
+        lower = imagemagick._ZoomifyTier(0, 256, 128, 0, tiles.extend, None)
+        tier = imagemagick._ZoomifyTier(1, 513, 257, 1, tiles.extend, lower)
+
+        image = PILImage.new('RGB', (513, 257), (255, 0, 0))
+        tier.add(image.crop((0, 0, 513, 256)))
+        tier.add(image.crop((0, 256, 513, 257)))
+
+        sizes = dict((filename, (index, tile.size)) for (index, filename, tile) in tiles)
+        self.assertEqual(sizes, {
+            '0-0-0.jpg': (0, (256, 128)),
+            '1-0-0.jpg': (1, (256, 256)),
+            '1-1-0.jpg': (2, (256, 256)),
+            '1-2-0.jpg': (3, (1, 256)),
+            '1-0-1.jpg': (4, (256, 1)),
+            '1-1-1.jpg': (5, (256, 1)),
+            '1-2-1.jpg': (6, (1, 1)),
+        })
+
+    def test_generate_zoomify(self):
+        FakeConvertStream.image = PILImage.new('RGB', (513, 257), (0, 0, 255))
+
+        with patch('djangoplicity.cutter.imagemagick.Popen', FakeConvertStream):
+            imagemagick._generate_zoomify(FakeArchive(), 513, 257, self.tmp_dir, self.dest_dir)
+
+        zoomable_dir = os.path.join(self.dest_dir, 'zoomable', 'test-image')
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, 'test-image')))
+        self.assertEqual(sorted(os.listdir(zoomable_dir)), ['ImageProperties.xml', 'TileGroup0'])
+        self.assertEqual(len(os.listdir(os.path.join(zoomable_dir, 'TileGroup0'))), 7)
+
+        tile = PILImage.open(os.path.join(zoomable_dir, 'TileGroup0', '1-2-1.jpg'))
+        self.assertEqual(tile.size, (1, 1))
+        tile = PILImage.open(os.path.join(zoomable_dir, 'TileGroup0', '0-0-0.jpg'))
+        self.assertEqual(tile.size, (256, 128))
+
+        with open(os.path.join(zoomable_dir, 'ImageProperties.xml')) as f:
+            properties = f.read()
+        self.assertIn('WIDTH="513"', properties)
+        self.assertIn('HEIGHT="257"', properties)
+        self.assertIn('NUMTILES="7"', properties)
+        self.assertIn('TILESIZE="256"', properties)
+
+    def test_generate_zoomify_truncated(self):
+        FakeConvertStream.image = PILImage.new('RGB', (513, 100), (0, 0, 255))
+
+        with patch('djangoplicity.cutter.imagemagick.Popen', FakeConvertStream):
+            with self.assertRaises(Exception):
+                imagemagick._generate_zoomify(FakeArchive(), 513, 257, self.tmp_dir, self.dest_dir)
+
+        self.assertFalse(os.path.exists(os.path.join(self.dest_dir, 'zoomable', 'test-image')))
@@ -42,6 +42,9 @@ from django.template.loader import render_to_string
 from django.utils import translation
 from django.utils.feedgenerator import Rss201rev2Feed
 
+from djangoplicity.utils.conditional import make_etag, not_modified, \
+    set_validators
+
 
 class DjangoplicityFeed( Feed ):
     """
@@ -58,15 +61,30 @@ class DjangoplicityFeed( Feed ):
         '''
         Django doesn't provide an easy way to cache a Feed, so we hijack
         the __call__ method and do it here instead
+
+        For archive models the cache key is versioned with the archive cache
+        generations, so the feed is updated as soon as an item is saved and
+        the key doubles as the feed's ETag: feed readers polling an
+        unchanged feed get a 304 Not Modified.
         '''
         key = self.get_cache_key(*args, **kwargs)
+        etag = None
+
+        model = kwargs['model']
+        if hasattr(model, 'get_versioned_cache_key'):
+            key = model.get_versioned_cache_key(key)
+            etag = make_etag(key)
+            response = not_modified(request, etag)
+            if response is not None:
+                return response
+
         response = cache.get(key)
         if response is None:
             response = super(DjangoplicityFeed, self).__call__(request, *args,
                 **kwargs)
             cache.set(key, response, 60 * 10)  # Cache for 10 minutes
 
-        return response
+        return set_validators(response, etag)
 
     def get_cache_key(self, *args, **kwargs):
         '''
@@ -40,7 +40,8 @@ from subprocess import Popen, PIPE
 from django.apps import apps
 from django.conf import settings
 
-from djangoplicity.archives.resources import AudioResourceManager
+from djangoplicity.archives.resources import AudioResourceManager, \
+    mark_resources_ready, update_resource_manifest
 from djangoplicity.archives.utils import wait_for_resource
 from djangoplicity.utils.history import add_admin_history
 
@@ -93,6 +94,8 @@ def encode_audio_derivatives(app_label, module_name, pk, tmp_dir):
         if isinstance(getattr(model.Archive, x), AudioResourceManager)
     ]
 
+    moved = []
+
     for fmt in formats:
         derived = fmt.derived
 
@@ -129,6 +132,11 @@ def encode_audio_derivatives(app_label, module_name, pk, tmp_dir):
 
         # Make sure permissions are correct
         os.chmod(dest_path, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH)
+        moved.append(fmt.name)
+
+    if moved:
+        update_resource_manifest(archive, moved)
+        mark_resources_ready(archive, moved)
 
 
 def get_audio_duration(app_label, module_name, pk):
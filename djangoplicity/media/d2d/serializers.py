@@ -29,16 +29,28 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE
 
+from django.db.models import Manager, Prefetch
 from rest_framework import serializers
 
-from djangoplicity.archives.utils import get_instance_resources
-from djangoplicity.media.models import Image, Video
+from djangoplicity.archives.utils import get_instance_resources, \
+    get_instances_resources
+from djangoplicity.media.models import Image, ImageExposure, Video
 from djangoplicity.utils.d2d import D2dDict
 from djangoplicity.utils.datetimes import timezone
 from djangoplicity.utils.templatetags.djangoplicity_text_utils import \
     remove_html_tags
 
 
+class AVMListSerializer(serializers.ListSerializer):
+    '''
+    Resolves the resources of all the items of a page at once
+    '''
+    def to_representation(self, data):
+        iterable = list(data.all() if isinstance(data, Manager) else data)
+        self.child.resources = get_instances_resources(iterable)
+        return super(AVMListSerializer, self).to_representation(iterable)
+
+
 class AVMSerializer(serializers.ModelSerializer):
     assets = serializers.SerializerMethodField()
     contact = serializers.SerializerMethodField()
@@ -52,6 +64,31 @@ class AVMSerializer(serializers.ModelSerializer):
     subject = serializers.SerializerMethodField()
     web_category = serializers.StringRelatedField(many=True)
 
+    # Relations used by the serializer, fetched with the queryset (see
+    # setup_queryset)
+    select_related = ()
+    prefetch_related = ('subject_category', 'subject_name', 'web_category')
+
+    # Resources lists of the items of a page (see AVMListSerializer)
+    resources = None
+
+    @classmethod
+    def setup_queryset(cls, queryset):
+        '''
+        Add the relations used by the serializer to the queryset, so that a
+        page is serialized with a fixed number of queries.
+        '''
+        if cls.select_related:
+            queryset = queryset.select_related(*cls.select_related)
+        if cls.prefetch_related:
+            queryset = queryset.prefetch_related(*cls.prefetch_related)
+        return queryset
+
+    def get_resources(self, obj):
+        if self.resources is not None and obj.pk in self.resources:
+            return self.resources[obj.pk]
+        return get_instance_resources(obj)
+
     def get_contact(self, obj):
         return D2dDict([
             ('Address', obj.contact_address),
@@ -93,7 +130,12 @@ class AVMSerializer(serializers.ModelSerializer):
 
 
 class ImageSerializer(AVMSerializer):
+    prefetch_related = AVMSerializer.prefetch_related + (
+        Prefetch('imageexposure_set', queryset=ImageExposure.objects.select_related('facility', 'instrument')),
+    )
+
     class Meta:
+        list_serializer_class = AVMListSerializer
         model = Image
         fields = (
             'creator', 'creator_url', 'contact', 'id', 'title', 'description',
@@ -168,7 +210,7 @@ class ImageSerializer(AVMSerializer):
 
         asset = D2dDict([
             ('MediaType', 'Image'),
-            ('Resources', get_instance_resources(obj)),
+            ('Resources', self.get_resources(obj)),
             ('ObservationData', observation),
         ])
 
@@ -177,6 +219,7 @@ class ImageSerializer(AVMSerializer):
 
 class VideoSerializer(AVMSerializer):
     class Meta:
+        list_serializer_class = AVMListSerializer
         model = Video
         fields = (
             'creator', 'creator_url', 'contact', 'id', 'title', 'description',
@@ -199,7 +242,7 @@ class VideoSerializer(AVMSerializer):
     def get_assets(self, obj):
         asset = D2dDict([
             ('MediaType', 'Video'),
-            ('Resources', get_instance_resources(obj)),
+            ('Resources', self.get_resources(obj)),
         ])
 
         return [asset]
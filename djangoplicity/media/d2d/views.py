@@ -28,16 +28,28 @@
 # IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE
-from rest_framework.exceptions import ValidationError
+from datetime import date, time
+import json
+
+from django.core.exceptions import ImproperlyConfigured
+from rest_framework.exceptions import NotFound, ValidationError
 from rest_framework.generics import ListAPIView
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.pagination import Cursor, CursorPagination, \
+    PageNumberPagination
 from rest_framework.response import Response
 
 from djangoplicity.media.d2d.renderers import AVMJSONRenderer
 from djangoplicity.media.d2d.serializers import ImageSerializer, VideoSerializer
 from djangoplicity.media.models import Image, Video
 from djangoplicity.media.options import ImageOptions, VideoOptions
+from djangoplicity.utils.cachekeys import digest
 from djangoplicity.utils.d2d import D2dDict, string_to_date
+from djangoplicity.utils.pagination import cached_count, \
+    get_keyset_ordering, keyset_q
+
+
+def _order_by(ordering):
+    return ['%s%s' % ('-' if desc else '', name) for (name, desc, _null) in ordering]
 
 
 class BasePagination(PageNumberPagination):
@@ -56,6 +68,131 @@ class BasePagination(PageNumberPagination):
         ]))
 
 
+class BaseCursorPagination(CursorPagination):
+    '''
+    Keyset pagination based on the queryset ordering: pages are fetched
+    with a "WHERE (<ordering field>, <pk>) < <cursor position>" instead of
+    an OFFSET, so deep pages cost the same as the first one. The total
+    count is cached.
+
+    The cursor position holds the values of all the ordering fields, with
+    the primary key to make it unique (see keyset_q). Items with a NULL in
+    an ordering field (e.g. no release date) are included, NULLs are sorted
+    as in PostgreSQL.
+    '''
+    page_size_query_param = 'count'
+    page_size = 100
+    count_cache_timeout = 60 * 5
+
+    # Request parameters the queryset depends on, the cached count is keyed
+    # on them rather than on the SQL of the query which contains the
+    # current time
+    count_cache_params = ('order_by', 'before', 'after')
+
+    def get_ordering(self, request, queryset, view):
+        '''
+        Use the ordering of the queryset, with the primary key to make it
+        unique, as a list of (attname, descending, nullable)
+        '''
+        ordering = get_keyset_ordering(queryset)
+        if ordering is None:
+            raise ImproperlyConfigured('%s can\'t be used with the ordering %s' % (
+                type(self).__name__, queryset.query.order_by))
+        return ordering
+
+    def get_count_cache_key(self, request, view, ordering):
+        params = ['%s=%s' % (p, request.query_params.get(p, '')) for p in self.count_cache_params]
+        return digest(type(view).__name__, *(params + _order_by(ordering)))
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+
+        model = queryset.model
+        self.count = cached_count(
+            queryset,
+            model.get_versioned_cache_key('%s_d2d' % model.get_cache_key_prefix()),
+            self.count_cache_timeout,
+            self.get_count_cache_key(request, view, self.ordering)
+        )
+
+        self.cursor = self.decode_cursor(request)
+        reverse = self.cursor is not None and self.cursor.reverse
+        position = self._decode_position(self.cursor)
+
+        # Previous pages are fetched in the reverse order from the first
+        # item of the current page
+        ordering = self.ordering
+        if reverse:
+            ordering = [(name, not desc, null) for (name, desc, null) in ordering]
+
+        queryset = queryset.order_by(*_order_by(ordering))
+        if position is not None:
+            # Added with add_q() so that querysets rewriting filter()
+            # arguments (e.g. TranslationQuerySet) leave it untouched
+            queryset.query.add_q(keyset_q(ordering, position))
+
+        # Fetch an extra item to know if there are more items
+        results = list(queryset[:self.page_size + 1])
+        self.page = results[:self.page_size]
+        has_more = len(results) > self.page_size
+
+        if reverse:
+            self.page.reverse()
+            self.has_previous, self.has_next = has_more, True
+        else:
+            self.has_previous, self.has_next = position is not None, has_more
+
+        return self.page
+
+    def _encode_position(self, instance):
+        values = []
+        for (name, _desc, _null) in self.ordering:
+            value = getattr(instance, name)
+            if isinstance(value, (date, time)):
+                value = value.isoformat()
+            values.append(value)
+        return json.dumps(values)
+
+    def _decode_position(self, cursor):
+        if cursor is None or cursor.position is None:
+            return None
+
+        try:
+            values = json.loads(cursor.position)
+        except ValueError:
+            raise NotFound(self.invalid_cursor_message)
+
+        if not isinstance(values, list) or len(values) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        return values
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        position = self._encode_position(self.page[-1])
+        return self.encode_cursor(Cursor(offset=0, reverse=False, position=position))
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        position = self._encode_position(self.page[0])
+        return self.encode_cursor(Cursor(offset=0, reverse=True, position=position))
+
+    def get_paginated_response(self, data):
+        return Response(D2dDict([
+            ('Count', self.count),
+            ('Next', self.get_next_link()),
+            ('Previous', self.get_previous_link()),
+            ('Collections', data)
+        ]))
+
+
 class ImagePagination(BasePagination):
     feed_type = 'Images'
 
@@ -64,9 +201,37 @@ class VideoPagination(BasePagination):
     feed_type = 'Videos'
 
 
-class D2dImageList(ListAPIView):
+class ImageCursorPagination(BaseCursorPagination):
+    feed_type = 'Images'
+
+
+class VideoCursorPagination(BaseCursorPagination):
+    feed_type = 'Videos'
+
+
+class CursorPaginationMixin(object):
+    '''
+    Use cursor_pagination_class instead of pagination_class if the request
+    has a 'cursor' parameter or 'pagination=cursor'
+    '''
+    cursor_pagination_class = None
+
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator'):
+            params = self.request.query_params
+            if self.cursor_pagination_class is not None and \
+                    ('cursor' in params or params.get('pagination') == 'cursor'):
+                self._paginator = self.cursor_pagination_class()
+            else:
+                self._paginator = super(CursorPaginationMixin, self).paginator
+        return self._paginator
+
+
+class D2dImageList(CursorPaginationMixin, ListAPIView):
     serializer_class = ImageSerializer
     pagination_class = ImagePagination
+    cursor_pagination_class = ImageCursorPagination
     renderer_classes = (AVMJSONRenderer,)
     ORDER_BY_OPTIONS = ['priority', '-priority', 'release_date', '-release_date']
 
@@ -77,14 +242,7 @@ class D2dImageList(ListAPIView):
         if order_by not in self.ORDER_BY_OPTIONS:
             raise ValidationError('The order_by possible values are: {}'.format(str(self.ORDER_BY_OPTIONS)))
 
-        qs = (
-            qs.order_by(order_by)
-            .prefetch_related(
-                'imagecontact_set', 'imageexposure_set', 'subject_category',
-                'subject_name', 'web_category', 'imageexposure_set__facility',
-                'imageexposure_set__instrument'
-            )
-        )
+        qs = self.get_serializer_class().setup_queryset(qs.order_by(order_by))
 
         # Filter for after/before parameters
         before = string_to_date(self.request.query_params.get('before', None))
@@ -99,13 +257,13 @@ class D2dImageList(ListAPIView):
         return qs
 
 
-class D2dVideoList(ListAPIView):
+class D2dVideoList(CursorPaginationMixin, ListAPIView):
     serializer_class = VideoSerializer
     pagination_class = VideoPagination
+    cursor_pagination_class = VideoCursorPagination
     renderer_classes = (AVMJSONRenderer, )
 
     def get_queryset(self):
         qs = VideoOptions.Queries.default.queryset(Video, VideoOptions, None)
 
-        return qs[0].order_by('-release_date').prefetch_related(
-            'subject_category', 'subject_name', 'web_category', 'facility')
+        return self.get_serializer_class().setup_queryset(qs[0].order_by('-release_date'))
@@ -105,6 +105,7 @@ class VAMPFeed (DjangoplicityArchiveFeed):
         category_query = None
         items_to_display = None  # will show all.
         external_feed_url = None
+        resources = ('original', )  # see item_link
 
         cache = 5 * 60  # 5 minutes
 
@@ -136,7 +137,7 @@ class VAMPFeed (DjangoplicityArchiveFeed):
         qs = qs.filter( published=True, type='Observation' )
         qs = qs.filter( Q( tagging_status__slug='obs' ) | Q( tagging_status__slug='coords' ) )
         qs = qs.order_by( '-last_modified' ).distinct()
-        return list( qs )
+        return self.prefetch( qs )
 
     def item_guid( self, obj ):
         """
@@ -175,7 +176,7 @@ class Top100Feed(ImageFeed):
         Returns the feed's items based on the obj returned by get_object
         """
         qs, dummy = self.Meta.default_query.queryset(self.Meta.model, self.Meta.options, None, stringparam=self.category)
-        return qs[:self.Meta.items_to_display]
+        return self.prefetch(qs[:self.Meta.items_to_display])
 
 
 class PictureOfTheWeekFeed( DjangoplicityArchiveFeed ):
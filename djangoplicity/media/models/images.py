@@ -254,22 +254,61 @@ class Color( models.Model ):
         return stat.mean
 
     @staticmethod
-    def _dominant_colors_3( im ):
+    def _color_histogram( im ):
         """
-        Algorithm for find the dominant *colours* of an image.
+        Count the pixels of an RGB image in each colour (using the hue and v
+        value of the HSV-model). Uses NumPy if it's installed.
+        """
+        try:
+            import numpy
+        except ImportError:
+            return Color._color_histogram_python( im )
 
-        Works by:
-         * Generate a colour histogram (using the hue and v value of the HSV-model).
-           Note, black and white are special cases.
-         * Use histogram to determine dominant colours
+        bins = Color.bins()
+        histogram = Color.init_histogram()
+
+        pixels = numpy.asarray( im, dtype=numpy.float64 ).reshape( -1, 3 ) / 256.0
+        r, g, b = pixels[:, 0], pixels[:, 1], pixels[:, 2]
+
+        # Same computation as colorsys.rgb_to_hsv() so that pixels are
+        # classified identically.
+        maxc = pixels.max( axis=1 )
+        minc = pixels.min( axis=1 )
+        v = maxc
+        delta = maxc - minc
+        grey = delta == 0
+        delta[grey] = 1.0
+        maxc_nz = numpy.where( grey, 1.0, maxc )
+        s = numpy.where( grey, 0.0, delta / maxc_nz )
+        rc = ( maxc - r ) / delta
+        gc = ( maxc - g ) / delta
+        bc = ( maxc - b ) / delta
+        h = numpy.where( r == maxc, bc - gc, numpy.where( g == maxc, 2.0 + rc - bc, 4.0 + gc - rc ) )
+        h = numpy.where( grey, 0.0, numpy.mod( h / 6.0, 1.0 ) )
+
+        black = v < 0.25
+        white = ~black & ( s < 0.2 ) & ( v > 0.6 )
+        histogram['black'] += int( black.sum() )
+        histogram['white'] += int( white.sum() )
+
+        # Index of the first border which is >= h
+        borders = numpy.array( [border for border, name in bins] )
+        idx = numpy.searchsorted( borders, h[~( black | white )], side='left' )
+        counts = numpy.bincount( idx, minlength=len( bins ) + 1 )
+        for i, ( border, name ) in enumerate( bins ):
+            histogram[name] += int( counts[i] )
+
+        return histogram
+
+    @staticmethod
+    def _color_histogram_python( im ):
+        """
+        Same as _color_histogram, without NumPy.
         """
-        # Prepare data
-        imrgb = im.convert('RGB')
-        pixels = imrgb.getdata()
+        pixels = im.getdata()
         bins = Color.bins()
         histogram = Color.init_histogram()
 
-        # Histogram
         for ( r, g, b ) in pixels:
             ( h, s, v ) = colorsys.rgb_to_hsv( r / 256.0, g / 256.0, b / 256.0 )
 
@@ -283,6 +322,20 @@ class Color( models.Model ):
                         histogram[name] += 1
                         break
 
+        return histogram
+
+    @staticmethod
+    def _dominant_colors_3( im ):
+        """
+        Algorithm for find the dominant *colours* of an image.
+
+        Works by:
+         * Generate a colour histogram (using the hue and v value of the HSV-model).
+           Note, black and white are special cases.
+         * Use histogram to determine dominant colours
+        """
+        histogram = Color._color_histogram( im.convert('RGB') )
+
         # Normalise histogram to sum to 1
         total = im.size[0] * im.size[1]
         for col, count in histogram.items():
@@ -135,12 +135,12 @@ class ImageOptions( ArchiveOptions ):
         embargo = ImageEmbargoQuery( browsers=( 'normal', 'viewall', 'json' ), verbose_name=ugettext_noop("Images (embargoed)") )
 
     class Browsers(object):
-        normal = NormalBrowser( paginate_by=50 )
+        normal = NormalBrowser( paginate_by=50, resources=( 'thumbs', ) )
         viewall = ViewAllBrowser( paginate_by=250 )
-        top100 = ViewAllBrowser( index_template='index_top100.html', paginate_by=100 )
+        top100 = ViewAllBrowser( index_template='index_top100.html', paginate_by=100, resources=( 'medium', ) )
         fbtop100 = ViewAllBrowser( index_template='index_top100.html', paginate_by=5 )
         fs = ViewAllBrowser( index_template='top100_fs.html', paginate_by=10 )
-        json = SerializationBrowser( serializer=AVMImageSerializer, emitter=JSONEmitter, paginate_by=100, display=False, verbose_name=ugettext_noop("JSON") )
+        json = SerializationBrowser( serializer=AVMImageSerializer, emitter=JSONEmitter, paginate_by=100, display=False, verbose_name=ugettext_noop("JSON"), stream=True )
         minijson = SerializationBrowser( serializer=MiniImageSerializer, emitter=JSONEmitter, paginate_by=25, display=False, include_pagination_data_in_response=True, verbose_name=ugettext_noop( "JSON" ) )
 
     class ResourceProtection (object):
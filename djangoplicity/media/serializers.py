@@ -30,10 +30,11 @@
 # POSSIBILITY OF SUCH DAMAGE
 
 from djangoplicity.archives.contrib.serialization import SimpleSerializer, \
-    Serializer, Serialization
+    Serializer, Serialization, RelatedCache
 from djangoplicity.archives.utils import get_instance_archives_urls, \
-    get_instance_resources
-from djangoplicity.media.models import Image, ImageContact, ImageExposure
+    get_instance_resources, get_instances_resources
+from djangoplicity.media.models import ImageContact, ImageExposure
+from djangoplicity.metadata.models import TaxonomyHierarchy
 from djangoplicity.media.wcs import prepare_str
 
 
@@ -44,21 +45,22 @@ class AVMImageSerializer( Serializer ):
         query optimisations.
         """
         datalist = []
-        pks = [obj.pk for obj in objects]
-
-        #objects = objects.select_related()
+        objects = list( objects )
 
         related_cache = {}
-        related_cache['imagecontact_set'] = [(obj.image_id, obj) for obj in ImageContact.objects.filter( image__in=pks )]
-        related_cache['imageexposure_set'] = [(obj.image_id, obj) for obj in ImageExposure.objects.filter( image__in=pks ).select_related('instrument', 'facility')]
-        related_cache['subject_name'] = [(obj.image_id, obj.subjectname) for obj in Image.subject_name.through.objects.filter( image__in=pks ).select_related('subjectname')]
-        related_cache['subject_category'] = [(obj.image_id, obj.taxonomyhierarchy) for obj in Image.subject_category.through.objects.exclude( taxonomyhierarchy__top_level='X' ).filter( image__in=pks ).select_related('taxonomyhierarchy')]
+        related_cache['imagecontact_set'] = RelatedCache( objects, 'imagecontact_set', ImageContact.objects.order_by( 'pk' ) )
+        related_cache['imageexposure_set'] = RelatedCache( objects, 'imageexposure_set', ImageExposure.objects.select_related( 'instrument', 'facility' ) )
+        related_cache['subject_name'] = RelatedCache( objects, 'subject_name' )
+        related_cache['subject_category'] = RelatedCache( objects, 'subject_category', TaxonomyHierarchy.objects.exclude( top_level='X' ) )
+        related_cache['proposal'] = RelatedCache( objects, 'proposal' )
+        related_cache['publication'] = RelatedCache( objects, 'publication' )
+        resources = get_instances_resources( objects )
 
         for obj in objects:
-            datalist.append( self.serialize( obj, related_cache=related_cache ).data )
+            datalist.append( self.serialize( obj, related_cache=related_cache, resources=resources.get( obj.pk ) ).data )
         return Serialization( datalist )
 
-    def serialize( self, image, related_cache=None ):
+    def serialize( self, image, related_cache=None, resources=None ):
         """
         Serialise image object
         """
@@ -66,9 +68,10 @@ class AVMImageSerializer( Serializer ):
 
         def cached_objects( qs, key ):
             if related_cache and key in related_cache:
-                return [obj for (pk, obj) in related_cache[key] if pk == image.id]
-            else:
-                return qs
+                objs = related_cache[key].get( image )
+                if objs is not None:
+                    return objs
+            return qs
 
         def field_to_python( obj, attr ):
             return obj.__class__._meta.get_field(attr).from_internal( getattr( obj, attr ) )
@@ -94,14 +97,18 @@ class AVMImageSerializer( Serializer ):
         #
         # Creator Metadata
         #
+        # The main contact is the first one (see Image.get_main_contact)
+        contacts = list( cached_objects( image.imagecontact_set.order_by( 'pk' ), 'imagecontact_set' ) )
+        main_contact = contacts[0] if contacts else None
+
         data.update( { 'Creator': image.creator } )
         data.update( { 'CreatorURL': image.creator_url } )
         data.update(
-            include_related( cached_objects(image.imagecontact_set.all(), 'imagecontact_set'), {
+            include_related( contacts, {
                     'name': 'Contact.Name'
                 }))
-        data.update( { 'Contact.Email': prepare_str(image.main_contact_email) })
-        data.update( { 'Contact.Telephone': prepare_str(image.main_contact_telephone) })
+        data.update( { 'Contact.Email': prepare_str(main_contact.email if main_contact else '') })
+        data.update( { 'Contact.Telephone': prepare_str(main_contact.telephone if main_contact else '') })
 
         data.update( { 'Contact.Address': prepare_str( image.contact_address ) } )
         data.update( { 'Contact.City': prepare_str( image.contact_city ) } )
@@ -182,7 +189,9 @@ class AVMImageSerializer( Serializer ):
 
         # Formats:
         data.update({'formats_url': get_instance_archives_urls(image)})
-        data.update({'Resources': get_instance_resources(image)})
+        if resources is None:
+            resources = get_instance_resources( image )
+        data.update({'Resources': resources})
 
         return Serialization( data )
 
@@ -344,6 +353,8 @@ class MiniImageSerializer( SimpleSerializer ):
     )
 
     related_cache = (
+        'subject_category',
+        'subject_name',
     )
 
     def get_release_date_value( self, obj ):
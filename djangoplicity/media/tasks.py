@@ -36,7 +36,6 @@ import piexif
 import shutil
 import stat
 import tempfile
-import time
 from hashlib import md5
 from subprocess import Popen, PIPE, call
 from zipfile import ZipFile
@@ -51,9 +50,11 @@ from django.contrib.auth.models import User
 from django.core.cache import cache
 from django.core.mail import send_mail, mail_managers
 from django.core.urlresolvers import reverse
+from django.db import transaction
 
 from djangoplicity.archives.contrib.serialization import XMPEmitter
-from djangoplicity.archives.resources import get_instance_resource, ResourceError
+from djangoplicity.archives.resources import get_instance_resource, ResourceError, \
+    mark_resources_ready, update_resource_manifest, wait_for_resources_ready
 from djangoplicity.archives.tasks import compute_checksums
 from djangoplicity.celery.serialtaskset import str_keys
 from djangoplicity.cutter.imagemagick import identify_image
@@ -78,16 +79,16 @@ def image_extras( image_id, sendtask_callback=None, sendtask_tasksetid=None ):
     """
     from djangoplicity.media.models import Image
 
-    # We sleep for 30s to give enough time for NFS to catch in case the
-    # sync task will run on a different server, otherwise we have the risk
-    # of getting the information from the placeholder file
-    time.sleep(30)
-
     try:
         # Load image
         im = Image.objects.get( id=image_id )
         logger.debug( "Found image %s " % ( im.id ) )
 
+        # Wait for NFS to catch up in case the original was written on a
+        # different server, otherwise we have the risk of getting the
+        # information from the placeholder file
+        wait_for_resources_ready( im, ['original'], timeout=30 )
+
         try:
             original_file = im.resource_original.path
             update_fields = []
@@ -292,6 +293,40 @@ def image_color( image_id, sendtask_callback=None, sendtask_tasksetid=None ):
         current_app.send_task( *args, **str_keys( kwargs ) )
 
 
+@task( name="media.image_colors", ignore_result=True )
+def image_colors( image_ids, replace=False ):
+    """
+    Celery task to determine the colours of several images at once, e.g. to
+    re-run the colour detection for the whole archive. Images which already
+    have colours are skipped unless replace is True.
+    """
+    from djangoplicity.media.models import Color, Image, ImageColor
+
+    if replace:
+        done = set()
+    else:
+        done = set( ImageColor.objects.filter( image_id__in=image_ids ).values_list( 'image_id', flat=True ) )
+
+    colors = []
+    computed = []
+    for im in Image.objects.filter( id__in=image_ids ):
+        if im.id in done or not im.is_source():
+            continue
+        im_colors = Color.create_dominant_colors( im, 'resource_medium' )
+        if im_colors:
+            colors.extend( im_colors )
+            computed.append( im.id )
+
+    # Existing colours are only replaced once the new ones are computed, and
+    # kept for images whose colours couldn't be computed
+    with transaction.atomic():
+        if replace:
+            ImageColor.objects.filter( image_id__in=computed ).delete()
+        ImageColor.objects.bulk_create( colors )
+
+    logger.debug( "Computed colours for %d images" % len( computed ) )
+
+
 @task(name="media.image_metadata", ignore_result=True)
 def write_metadata(image_id, formats, cdn_sync=True):
     """
@@ -359,14 +394,17 @@ def write_metadata(image_id, formats, cdn_sync=True):
             piexif.insert(exif, filepath)
             logger.info('Wrote VR EXIF to %s', filepath)
 
+    # The files were modified in place: record their new state, otherwise
+    # the tasks waiting for them (including compute_checksums below) would
+    # wait for the version written by the previous task
+    mark_resources_ready(im, formats)
+
     # Re-compute the checksums
     compute_checksums('media', 'image', im.pk)
 
-    # Synchronise with content server if necessary
+    # Synchronise with content server if necessary, the sync task waits
+    # until it sees the new files in case it runs on a different server
     if cdn_sync:
-        # We sleep for 30s to give enough time for NFS to catch in case the
-        # sync task will run on a different server
-        time.sleep(30)
         im.sync_content_server(delay=True)
 
 
@@ -383,6 +421,8 @@ def fast_start(video_id, fmt, sendtask_callback=None, sendtask_tasksetid=None):
             res = getattr(obj, 'resource_%s' % fmt)
             if res:
                 os.system(MP4BOX_PATH + " -quiet -tmp %s -inter 500 %s" % (settings.TMP_DIR, res.path))
+                update_resource_manifest(obj, [fmt])
+                mark_resources_ready(obj, [fmt])
                 logger.info('Video %s set to fast start' % video_id)
     except Exception, e:
         logger.warning("Exception: %s." % e)
@@ -417,6 +457,8 @@ def fragment_mp4(app_label, model_name, pk, fmt, sendtask_callback=None, sendtas
 
             if os.system(cmd) == 0:
                 shutil.move(f.name, res.path)
+                update_resource_manifest(obj, [fmt])
+                mark_resources_ready(obj, [fmt])
                 logger.info('Video %s fragmented' % pk)
             else:
                 logger.error('mp4fragment error for %s' % res.path)
@@ -503,6 +545,8 @@ def video_embed_subtitles( video_id, resource_name, sendtask_callback=None, send
                     if res:
                         file = res.file
                         os.system( MP4BOX_PATH + " -add %s#video -add %s#audio %s -new %s" % ( file, file, lang, file ) )
+                        update_resource_manifest( v, [resource_name] )
+                        mark_resources_ready( v, [resource_name] )
                         logger.info( 'Subtitles muxed for %s.' % v.id )
                     else:
                         logger.error( "File for resource '%s' does not exist for Video %s." % ( resource_name, v.id ) )
@@ -809,6 +853,8 @@ def generate_thumbnail(app_label, model_name, pk, sendtask_callback=None, sendta
             logger.warning(e)
             raise Exception(error)
 
+        update_resource_manifest(v, ['original'])
+        mark_resources_ready(v, ['original'])
         add_admin_history(v, 'Generated thumbnail from {} at {} seconds'.format(fmt, position))  # pylint: disable=undefined-loop-variable
 
     # Send_task callback
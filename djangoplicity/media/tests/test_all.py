@@ -29,9 +29,33 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE
 
-from django.test import TestCase
+import json
+import os
+import random
+import shutil
+import tempfile
+from unittest import skipUnless
+
+from django.core.cache import cache
+from django.db import connection
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from PIL import Image as PILImage
+
+from djangoplicity.archives.contrib.serialization import RelatedCache
+from djangoplicity.archives.resources import prefetch_resources
+from djangoplicity.media.d2d.views import D2dImageList, D2dVideoList
+from djangoplicity.media.models import Color, Image, ImageColor
 from djangoplicity.media.options import ImageOptions, VideoOptions, \
     PictureOfTheWeekOptions, ImageComparisonOptions
+from djangoplicity.media.serializers import AVMImageSerializer, \
+    MiniImageSerializer
+from djangoplicity.media.tasks import image_colors
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 class CommonViewsTestCase( TestCase ):
@@ -124,3 +148,149 @@ class CommonViewsTestCase( TestCase ):
 
                     response = self.client.get(view_url)
                     self._assert_response( response, code )
+
+
+class ColorTestCase( TestCase ):
+    fixtures = ['media']
+
+    def setUp( self ):
+        # Colours cached by previous tests were rolled back
+        Color._band_cache = Color._black_cache = Color._white_cache = None
+
+    @skipUnless( numpy, 'NumPy is not installed' )
+    def test_color_histogram( self ):
+        rnd = random.Random( 0 )
+        im = PILImage.new( 'RGB', ( 64, 64 ) )
+        im.putdata( [( rnd.randint( 0, 255 ), rnd.randint( 0, 255 ), rnd.randint( 0, 255 ) ) for _i in range( 64 * 64 )] )
+
+        histogram = Color._color_histogram( im )
+        self.assertEqual( histogram, Color._color_histogram_python( im ) )
+        self.assertEqual( sum( histogram.values() ), 64 * 64 )
+
+    def test_image_colors( self ):
+        media_root = tempfile.mkdtemp()
+        try:
+            medium_dir = os.path.join( media_root, Image.Archive.Meta.root, 'medium' )
+            os.makedirs( medium_dir )
+            PILImage.new( 'RGB', ( 16, 16 ), ( 0, 0, 255 ) ).save( os.path.join( medium_dir, 'image-1.jpg' ) )
+
+            for image_id in ( 'image-1', 'image-2' ):
+                ImageColor.objects.create( image_id=image_id, color=Color.white(), ratio=1.0 )
+
+            with override_settings( MEDIA_ROOT=media_root ):
+                image_colors( ['image-1', 'image-2'], replace=True )
+
+            colors = ImageColor.objects.filter( image_id='image-1' ).values_list( 'color_id', flat=True )
+            self.assertIn( 'blue', colors )
+            self.assertNotIn( 'white', colors )
+
+            # image-2 has no medium resource, its colours are kept
+            colors = ImageColor.objects.filter( image_id='image-2' ).values_list( 'color_id', flat=True )
+            self.assertEqual( list( colors ), ['white'] )
+        finally:
+            shutil.rmtree( media_root )
+
+
+class SerializerTestCase( TestCase ):
+    fixtures = ['media']
+
+    def _count_queries( self, serializer, objects ):
+        with CaptureQueriesContext( connection ) as ctx:
+            serializer.serialize_list( objects )
+        return len( ctx.captured_queries )
+
+    def test_list_queries( self ):
+        """ list serialization runs the same number of queries for any number of objects """
+        images = list( Image.objects.all() )
+        self.assertTrue( len( images ) > 1 )
+        prefetch_resources( images )
+
+        for serializer_cls in ( AVMImageSerializer, MiniImageSerializer ):
+            serializer_cls().serialize_list( images )
+            self.assertEqual(
+                self._count_queries( serializer_cls(), images[:1] ),
+                self._count_queries( serializer_cls(), images )
+            )
+
+    def test_related_cache( self ):
+        images = list( Image.objects.all() )
+
+        cache = RelatedCache( images, 'subject_name' )
+        for image in images:
+            self.assertEqual( cache.get( image ), list( image.subject_name.all() ) )
+
+        cache = RelatedCache( images, 'imagecontact_set', filter_spec={ 'name': 'nobody' } )
+        for image in images:
+            self.assertEqual( cache.get( image ), list( image.imagecontact_set.filter( name='nobody' ) ) )
+
+        self.assertIsNone( cache.get( Image( id='not-primed' ) ) )
+
+
+class D2dQueryBudgetTestCase( TestCase ):
+    fixtures = ['media']
+
+    # Maximum number of queries for a page of a d2d feed, whatever the page
+    # size (count, page, prefetched relations, resource manifests...)
+    QUERY_BUDGET = 10
+
+    def _count_queries( self, view, count ):
+        cache.clear()
+        request = RequestFactory().get( '/d2d/', { 'count': count } )
+        with CaptureQueriesContext( connection ) as ctx:
+            response = view( request )
+            response.render()
+        self.assertEqual( response.status_code, 200 )
+        return len( ctx.captured_queries )
+
+    def test_query_budget( self ):
+        for view_cls in ( D2dImageList, D2dVideoList ):
+            view = view_cls.as_view()
+            # Warm up (e.g. current site)
+            self._count_queries( view, 100 )
+
+            queries = self._count_queries( view, 100 )
+            self.assertLessEqual( queries, self.QUERY_BUDGET )
+            self.assertEqual( self._count_queries( view, 1 ), queries )
+
+
+class D2dCursorPaginationTestCase( TestCase ):
+    fixtures = ['media']
+
+    def _get( self, url, params=None ):
+        cache.clear()
+        response = D2dImageList.as_view()( RequestFactory().get( url, params ) )
+        response.render()
+        self.assertEqual( response.status_code, 200 )
+        return json.loads( response.content )
+
+    def test_cursor_pagination( self ):
+        Image.objects.filter( id='image-2' ).update( priority=50 )
+        expected = list( Image.objects.order_by( '-priority', '-id' ).values_list( 'id', flat=True ) )
+
+        # Items with the same priority (and release date) are paginated on
+        # the primary key
+        for order_by in ( '-priority', '-release_date' ):
+            data = self._get( '/d2d/', { 'pagination': 'cursor', 'count': 1, 'order_by': order_by } )
+            self.assertNotIn( 'Previous', data )
+
+            ids = []
+            while True:
+                self.assertEqual( data['Count'], 3 )
+                self.assertEqual( len( data['Collections'] ), 1 )
+                ids.append( data['Collections'][0]['ID'] )
+                if 'Next' not in data:
+                    break
+                data = self._get( data['Next'] )
+
+            if order_by == '-priority':
+                self.assertEqual( ids, expected )
+            else:
+                self.assertEqual( ids, sorted( expected, reverse=True ) )
+
+            # Back to the first page
+            previous = []
+            while 'Previous' in data:
+                data = self._get( data['Previous'] )
+                previous.insert( 0, data['Collections'][0]['ID'] )
+            self.assertEqual( previous, ids[:-1] )
+
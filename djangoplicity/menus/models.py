@@ -37,7 +37,9 @@ from django.db.models import signals
 from django.utils import translation
 from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext_lazy as _
-from djangoplicity.translation.models import get_path_for_language, get_language_from_path
+from djangoplicity.translation.models import DEFAULT_PREFIX, \
+    get_path_for_language, get_language_from_path
+from djangoplicity.utils.cachekeys import make_cache_key
 from mptt.models import MPTTModel
 from operator import itemgetter
 
@@ -260,13 +262,19 @@ def build_menu( name ):
 
             urls.append((menuroot.link, current_item))
 
-        # Urls bust be sorted by key, otherwise the mark_selected and
-        # make_breadcrumb won't work.
+        # Index of the items by URL, used to find the item with the longest
+        # URL matching a path (the first primary item wins for duplicate URLs)
+        byprefix = {}
+        for url, item in urls:
+            byprefix.setdefault( url, item )
+
+        # Reverse-sorted list of URLs, kept for backwards compatibility
         urls.sort( key=itemgetter( 0 ), reverse=True )
 
         return {
             'tree': root,
             'byurls': urls,
+            'byprefix': byprefix,
         }
 
     except ObjectDoesNotExist:
@@ -275,62 +283,121 @@ def build_menu( name ):
         raise MenuDoesNotExist
 
 
-def mark_selected_item( byurls, path ):
+def _get_index( menu ):
     """
-    Highlighting of selected menu item
+    Return the URL index of the menu. For backwards compatibility menu can
+    also be a reverse-sorted list of (url, item) as in menu['byurls'].
+    """
+    if isinstance( menu, dict ):
+        return menu['byprefix']
+
+    byprefix = {}
+    for url, item in reversed( menu ):
+        byprefix[url] = item
+    return byprefix
 
-    Works like the bread crumb generation (see below).
+
+def find_item( byprefix, path, prefix=None, exclude=() ):
+    """
+    Return the item with the longest URL which is a prefix of path (e.g if
+    the path is /a/b/c/ and the menu has two items /a/ and /a/b/ then /a/b/
+    will be chosen), or None. Each prefix of path is looked up in the index,
+    so the cost doesn't depend on the size of the menu.
+
+    If a language prefix is given, URLs starting with DEFAULT_PREFIX are
+    matched as rewritten with get_path_for_language (e.g. /a/ as /de/a/).
+    URLs in exclude are ignored.
     """
+    if prefix == DEFAULT_PREFIX:
+        prefix = None
+
+    for i in xrange( len( path ), 0, -1 ):
+        url = path[:i]
+        if url in exclude:
+            continue
 
+        if prefix is not None and url.startswith( prefix ):
+            item = byprefix.get( DEFAULT_PREFIX + url[len( prefix ):] )
+            if item is not None:
+                return item
+
+        item = byprefix.get( url )
+        if item is not None and ( prefix is None or not url.startswith( DEFAULT_PREFIX ) ):
+            return item
+
+    return None
+
+
+def select_menu_item( menu, path ):
+    """
+    Highlighting of selected menu item
+
+    Returns the tree of the menu with the item matching path and its
+    parents marked as 'selected' (and the item itself as 'leaf_selected').
+    The menu is shared between requests, so it's not modified: only the
+    selected items and the lists of children containing them are copied.
+    """
     path = get_language_from_path(path)[2]
 
-    for url, val in byurls:
-        if path.startswith( url ) and url != '':
-            val['leaf_selected'] = True
-            while val:
-                if val['selected']:
-                    break
-                val['selected'] = True
-                val = val['parent']
-            return
+    tree = menu['tree']
+    val = find_item( _get_index( menu ), path, exclude=('',) )
+
+    selected = []
+    while val:
+        selected.append( val )
+        val = val['parent']
+    selected.reverse()
+
+    # The menu root item appended when hide_menu_root is False is not part
+    # of the tree
+    if not selected or selected[0] is not tree:
+        return tree
+
+    parent = None
+    for val in selected:
+        item = dict( val, selected=True, children=list( val['children'] ) )
+        if parent is not None:
+            item['parent'] = parent
+            parent['children'] = [item if c is val else c for c in parent['children']]
+        else:
+            tree = item
+        parent = item
+
+    parent['leaf_selected'] = True
 
+    return tree
 
-def make_breadcrumb( byurls, path ):
+
+def make_breadcrumb( menu, path ):
     """
     Breadcrumb generation
 
-    Takes a reverse-sorted list of URLs, and find the most specific
-    URL for the requested path. E.g if the path is /a/b/c/ and the menu
-    has two items /a/ and /a/b/ then /a/b/ will be chosen). Once the most
-    specific item is chosen, it gets the corresponding menu item and
-    follow it's parents to the root.
-
-    It is imperative that the byurls is reverse-sorted for this
-    breadcrumb generation to work as expected.
+    Find the most specific menu item for the requested path (see find_item)
+    and follow it's parents to the root.
     """
     if path == '/':
         return []
 
+    prefix = None
     if settings.USE_I18N:
         lang = translation.get_language()
+        prefix = get_path_for_language( lang, DEFAULT_PREFIX )
 
-    for url, val in byurls:
-        if settings.USE_I18N:
-            url = get_path_for_language(lang, url)
-        if path.startswith( url ) and url != '/' and url != '':
-            crumb = []
-            while val:
-                if 'hide_menu_root' in val and val['hide_menu_root']:
-                    break
-                if settings.USE_I18N:
-                    crumb.append( { 'title': val['title'], 'link': get_path_for_language(lang, val['link']), 'on_click': val['on_click'] } )
-                else:
-                    crumb.append( { 'title': val['title'], 'link': val['link'], 'on_click': val['on_click'] } )
-                val = val['parent']
-            crumb.reverse()
-            return crumb
+    val = find_item( _get_index( menu ), path, prefix=prefix, exclude=( '', '/' ) )
+    if val is None:
+        return None
 
-    return None
+    crumb = []
+    while val:
+        if 'hide_menu_root' in val and val['hide_menu_root']:
+            break
+        if settings.USE_I18N:
+            crumb.append( { 'title': val['title'], 'link': get_path_for_language(lang, val['link']), 'on_click': val['on_click'] } )
+        else:
+            crumb.append( { 'title': val['title'], 'link': val['link'], 'on_click': val['on_click'] } )
+        val = val['parent']
+    crumb.reverse()
+    return crumb
 
 
 def get_menu( name ):
@@ -340,7 +407,7 @@ def get_menu( name ):
     not in the cache. The cache is automatically invalidated, when a menu
     is updated.
     """
-    key = CACHE_KEY + str(name.__hash__())
+    key = make_cache_key( CACHE_KEY, name )
     menu = cache.get( key )
     if menu is None:
         menu = build_menu( name )
@@ -356,7 +423,7 @@ def invalidate_menu_cache( sender, instance, signal, raw=False, *args, **kwargs
     """
     if not raw:
         menu_name = instance.name
-        cache.delete( CACHE_KEY + str(menu_name.__hash__()) )
+        cache.delete( make_cache_key( CACHE_KEY, menu_name ) )
 
 
 def invalidate_menu_item_cache( sender, instance, signal, raw=False, *args, **kwargs ):
@@ -367,7 +434,7 @@ def invalidate_menu_item_cache( sender, instance, signal, raw=False, *args, **kw
     if not raw:
         menu = instance.get_root().menu
         if menu:
-            cache.delete( CACHE_KEY + str( menu.name.__hash__() ) )
+            cache.delete( make_cache_key( CACHE_KEY, menu.name ) )
 
 
 def update_children_menu( sender, instance, signal, raw=False, *args, **kwargs ):
@@ -392,14 +459,14 @@ def menu_cache_dependencies( sender, instance, signal, *args, **kwargs ):
     TODO: We should probably invalidate all cache pages as they all show
     the full menu structure
     '''
-    from djangoplicity.pages.models import Page, CACHE_KEY as PAGE_CACHE_KEY
+    from djangoplicity.pages.models import Page, page_cache_keys
 
     # Page caches need to be regenerated in case of menu changes
     qs = Page.objects.filter(embedded__exact=0)
     for p in qs:
         if not p.embedded:
             for url in p.url_set.all():
-                cache.delete(PAGE_CACHE_KEY['pages'] + str(url.url.__hash__()))
+                cache.delete_many(page_cache_keys(url.url))
 
 # Listen for signals sent when Menu or MenuItems are updated/created/deleted
 signals.post_save.connect(invalidate_menu_cache, sender=Menu)
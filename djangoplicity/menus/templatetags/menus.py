@@ -32,7 +32,7 @@
 from django import template
 from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
-from djangoplicity.menus.models import mark_selected_item, MenuDoesNotExist, MenuProxy, make_breadcrumb
+from djangoplicity.menus.models import select_menu_item, MenuDoesNotExist, MenuProxy, make_breadcrumb
 
 MENU_TMPL_NAME = u'menus/menu.html'
 
@@ -74,7 +74,9 @@ class MenuNode( template.Node ):
             menu = menu_proxy.get_menu()
 
             if 'request' in context:
-                mark_selected_item( menu['byurls'], context['request'].path )
+                root = select_menu_item( menu, context['request'].path )
+            else:
+                root = menu['tree']
 
         except MenuDoesNotExist, e:
             return node_error( u"The menu '%s' does not exists" % menu_proxy.menu_name )
@@ -91,7 +93,7 @@ class MenuNode( template.Node ):
 
         return t.render({
             'hide_root': menu['tree']['hide_menu_root'],
-            'root': menu['tree'],
+            'root': root,
             'template': self.template_name,
         })
 
@@ -182,7 +184,7 @@ class BreadcrumbNode( template.Node ):
 
             for proxy in menu_proxies:
                 menu = proxy.get_menu()
-                crumb = make_breadcrumb( menu['byurls'], context['request'].path )
+                crumb = make_breadcrumb( menu, context['request'].path )
                 if crumb is not None:
                     break
 
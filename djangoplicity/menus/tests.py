@@ -32,7 +32,8 @@
 from django.test import TestCase
 
 #test all the models
-from djangoplicity.menus.models import Menu, build_menu
+from djangoplicity.menus.models import Menu, build_menu, make_breadcrumb, \
+    select_menu_item
 
 
 class DeleteMenuItemBugTestCase( TestCase ):
@@ -85,3 +86,42 @@ class RecursionBugTestCase( TestCase ):
         element in the tuple (the URL), but where sorting on both elements.
         """
         build_menu( 'Main menu' )
+
+
+class MenuSelectionTestCase( TestCase ):
+    fixtures = [ 'recursion_bug.json' ]
+
+    def test_select_menu_item( self ):
+        menu = build_menu( 'Main menu' )
+        path = '/science/meetings/future/symposia/iau300/'
+
+        tree = select_menu_item( menu, path )
+        selected = []
+        items = tree['children']
+        while items:
+            items = [x for x in items if x['selected']]
+            if not items:
+                break
+            selected.append( items[0] )
+            items = items[0]['children']
+
+        self.assertTrue( tree['selected'] )
+        self.assertEqual( [x['title'] for x in selected], ['Science', 'Scientific Meetings', 'Future IAU Meetings', 'Symposia'] )
+        self.assertTrue( selected[-1]['leaf_selected'] )
+        self.assertFalse( selected[-2]['leaf_selected'] )
+
+        # The shared menu is not modified
+        self.assertFalse( menu['tree']['selected'] )
+        self.assertFalse( [x for x in menu['tree']['children'] if x['selected']] )
+
+    def test_make_breadcrumb( self ):
+        menu = build_menu( 'Main menu' )
+
+        crumb = make_breadcrumb( menu, '/science/meetings/future/symposia/iau300/' )
+        self.assertEqual( [x['title'] for x in crumb][-2:], ['Future IAU Meetings', 'Symposia'] )
+
+        # Same result with the legacy reverse-sorted list of URLs
+        self.assertEqual( make_breadcrumb( menu['byurls'], '/science/meetings/future/symposia/iau300/' ), crumb )
+
+        self.assertEqual( make_breadcrumb( menu, '/' ), [] )
+        self.assertIsNone( make_breadcrumb( menu, '/unknown/' ) )
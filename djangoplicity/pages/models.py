@@ -20,6 +20,7 @@ from django.template.base import TemplateSyntaxError
 from django.utils.translation import ugettext_lazy as _
 
 from djangoplicity.archives.translation import TranslationProxyMixin
+from djangoplicity.utils.cachekeys import make_cache_key
 from djangoplicity.translation.models import TranslationModel, \
     get_path_for_language
 
@@ -34,6 +35,20 @@ CACHE_KEY = {
 }
 
 
+def page_cache_keys( url, langs=None ):
+    """
+    Returns the cache keys used by view_page for the given URL for
+    internal and external requests, in the given languages (by default
+    all languages).
+    """
+    if not settings.USE_I18N:
+        langs = [None]
+    elif langs is None:
+        langs = [lang for lang, _name in settings.LANGUAGES]
+
+    return [make_cache_key( CACHE_KEY['pages'], url, lang=lang, internal=internal ) for lang in langs for internal in ( True, False )]
+
+
 class TemplateField(models.CharField):
     '''
     Custom field to avoid having choices caught by makemigrations
@@ -412,12 +427,7 @@ def page_cache_invalidator( sender, instance, signal, raw=False, *args, **kwargs
         else:
             urls = instance.source.url_set.all()
         for url in urls:
-            if settings.USE_I18N:
-                cache.delete('%s_%s_%s_internal' % (CACHE_KEY['pages'], str(url.url.__hash__()), instance.lang))
-                cache.delete('%s_%s_%s_external' % (CACHE_KEY['pages'], str(url.url.__hash__()), instance.lang))
-            else:
-                cache.delete('%s_%s_internal' % (CACHE_KEY['pages'], str(url.url.__hash__())))
-                cache.delete('%s_%s_external' % (CACHE_KEY['pages'], str(url.url.__hash__())))
+            cache.delete_many( page_cache_keys( url.url, [instance.lang] ) )
         build_urlindex()
         build_page_key_index()
 
@@ -428,8 +438,7 @@ def url_cache_invalidator( sender, instance, signal, raw=False, *args, **kwargs
     """
     if raw:
         return
-    cache.delete( '%s_%s_internal' % (CACHE_KEY['pages'], str(instance.url.__hash__())) )
-    cache.delete( '%s_%s_external' % (CACHE_KEY['pages'], str(instance.url.__hash__())) )
+    cache.delete_many( page_cache_keys( instance.url ) )
     build_urlindex()
     build_page_key_index()
 
@@ -458,8 +467,7 @@ def section_cache_invalidator( sender, instance, signal, raw=False, *args, **kwa
             cache.delete( CACHE_KEY['embedded_pages'] + str(p.pk) )
         else:
             for url in p.url_set.all():
-                cache.delete( '%s_%s_internal' % (CACHE_KEY['pages'], str(url.url.__hash__())) )
-                cache.delete( '%s_%s_external' % (CACHE_KEY['pages'], str(url.url.__hash__())) )
+                cache.delete_many( page_cache_keys( url.url ) )
 
 
 def generate_page_id(sender, instance, signal, raw=False, *args, **kwargs):
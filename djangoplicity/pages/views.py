@@ -50,8 +50,10 @@ from djangoplicity.pages.models import PageGroup
 from djangoplicity.archives.utils import is_internal
 from djangoplicity.archives.contrib.info.defaults import admin_edit_for_site
 from djangoplicity.pages.models import Page, PageProxy, CACHE_KEY, \
-    build_page_key_index, build_urlindex
+    build_page_key_index, build_urlindex, page_cache_keys
 from djangoplicity.translation.models import get_path_for_language, get_querystring_from_request
+from djangoplicity.utils.cachekeys import make_cache_key
+from djangoplicity.utils.conditional import make_etag, not_modified, set_validators
 
 
 logger = logging.getLogger(__name__)
@@ -112,8 +114,7 @@ def _authorize_pageview( request, page, no_unpublished=False ):
                 cache.delete( CACHE_KEY['embedded_pages'] + page.id )
             else:
                 for url in page.url_set.all():
-                    cache.delete( '%s_%s_internal' % (CACHE_KEY['pages'], str(url.url.__hash__())) )
-                    cache.delete( '%s_%s_external' % (CACHE_KEY['pages'], str(url.url.__hash__())) )
+                    cache.delete_many( page_cache_keys( url.url ) )
 
 
 def embed_page_key( request, page_key, no_unpublished=False ):
@@ -315,14 +316,7 @@ def view_page( request, url ):
         # We don't cache if user has permissions and in preview mode
         cache_key = None
     else:
-        cache_key = '%s_%s' % (CACHE_KEY['pages'], str(url.__hash__()))
-        if lang:
-            cache_key += '_%s' % lang
-
-        if is_internal(request):
-            cache_key += '_internal'
-        else:
-            cache_key += '_external'
+        cache_key = make_cache_key( CACHE_KEY['pages'], url, lang=lang, internal=is_internal(request) )
 
     if cache_key:
         page_cache = cache.get( cache_key )
@@ -405,13 +399,24 @@ def view_page( request, url ):
     htmlkey = 'html%s' % '-admin' if request.user.is_superuser else ''
     ctpl = None
 
+    # Conditional GET - static pages only change when the page is saved, so
+    # they can be validated without rendering them. Dynamic pages and pages
+    # which are not cached are always rendered.
+    etag = last_modified = None
+    if cache_key and not page.dynamic and page.is_online() and not request.user.has_perm('pages.change_page'):
+        last_modified = page.last_modified
+        etag = make_etag( cache_key, page.pk, last_modified, htmlkey )
+        response = not_modified( request, etag, last_modified )
+        if response is not None:
+            return response
+
     # We don't want to cache the page with the link to the admin page
     # so if the user has edit access we don't use the cache
     if page_cache is not None and not request.user.has_perm('pages.change_page'):
         # Cache
         if htmlkey in page_cache:
             # We already have a fully rendered page so return it.
-            return HttpResponse( page_cache[htmlkey] )
+            return set_validators( HttpResponse( page_cache[htmlkey] ), etag, last_modified )
         elif 'template' in page_cache:
             # We only have a compiled template, so we need to render the page
             ctpl = page_cache['template']
@@ -453,4 +458,4 @@ def view_page( request, url ):
                 page_cache[htmlkey] = html
                 cache.set( cache_key, page_cache )
 
-    return HttpResponse( html )
+    return set_validators( HttpResponse( html ), etag, last_modified )
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+#
+# djangoplicity-remotearchives
+# Copyright (c) 2007-2016, European Southern Observatory (ESO)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#
+#    * Neither the name of the European Southern Observatory nor the names
+#      of its contributors may be used to endorse or promote products derived
+#      from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY ESO ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL ESO BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE
+
+'''
+Fetching of the JSON data of remote archives.
+
+The URLs of all the archive items and languages are collected first so
+that each distinct URL is only downloaded once, then they are fetched
+concurrently with a shared session. The ETag and Last-Modified headers of
+the responses are kept in the data (under VALIDATORS_KEY, per language)
+and sent back on the next fetch so that unchanged documents are not
+downloaded again. All the fetched items are finally written with a single
+UPDATE per model: save() is not called on the items, and no pre_save or
+post_save signal is sent for them.
+'''
+
+import logging
+from collections import defaultdict
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from django.conf import settings
+from django.contrib.postgres.fields import JSONField
+from django.db.models import Case, F, Value, When
+
+logger = logging.getLogger(__name__)
+
+FETCH_TIMEOUT = 10
+
+# Number of concurrent requests
+FETCH_WORKERS = getattr(settings, 'DJANGOPLICITY_REMOTEARCHIVES_FETCH_WORKERS', 8)
+
+# Key of the ETag/Last-Modified validators in RemoteArchive.data
+VALIDATORS_KEY = '_validators'
+
+
+def make_session(workers=FETCH_WORKERS):
+    '''
+    Return a requests session keeping up to workers connections per host
+    '''
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def _fetch(session, url, validators, timeout):
+    '''
+    Fetch a JSON document, returns a tuple (data, validators) where data is
+    None if the document was not modified, or None if the fetch failed.
+    '''
+    headers = {}
+    if validators:
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+
+    try:
+        r = session.get(url, headers=headers, timeout=timeout)
+    except requests.RequestException as e:
+        logger.warning('Could not fetch JSON "%s": %s', url, e)
+        return None
+
+    if r.status_code == requests.codes.not_modified and headers:
+        return (None, validators)
+
+    if r.status_code != requests.codes.ok:
+        logger.warning('Could not fetch JSON "%s", status: %s', url, r.status_code)
+        return None
+
+    try:
+        data = r.json()
+    except ValueError:
+        logger.warning('Could not decode JSON "%s"', url)
+        return None
+
+    validators = {}
+    if r.headers.get('ETag'):
+        validators['etag'] = r.headers['ETag']
+    if r.headers.get('Last-Modified'):
+        validators['last_modified'] = r.headers['Last-Modified']
+
+    return (data, validators or None)
+
+
+def fetch_urls(urls, workers=None, session=None, timeout=FETCH_TIMEOUT):
+    '''
+    Fetch the JSON documents concurrently. urls is a dictionary of URL to
+    the validators returned by a previous fetch (or None).
+
+    Returns a dictionary of URL to (data, validators) for the successful
+    fetches, data is None if the document was not modified.
+    '''
+    urls = dict(urls)
+    if not urls:
+        return {}
+
+    if workers is None:
+        workers = FETCH_WORKERS
+    if session is None:
+        session = make_session(workers)
+
+    keys = list(urls)
+    pool = ThreadPool(min(workers, len(keys)))
+    try:
+        results = pool.map(lambda url: _fetch(session, url, urls[url], timeout), keys, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    return dict((url, result) for url, result in zip(keys, results) if result is not None)
+
+
+def _bulk_update(model, objects, changed, last_fetch):
+    '''
+    Set last_fetch of all the objects, and the data of the changed ones,
+    in a single query
+    '''
+    kwargs = {'last_fetch': last_fetch}
+
+    if changed:
+        kwargs['data'] = Case(
+            *[When(pk=o.pk, then=Value(o.data, output_field=JSONField())) for o in changed],
+            default=F('data'),
+            output_field=JSONField()
+        )
+
+    model.objects.filter(pk__in=[o.pk for o in objects]).update(**kwargs)
+
+
+def fetch_remote_archives(objects, workers=None, session=None):
+    '''
+    Fetch and update the JSON data of the given remote archive items in
+    each language defined. Returns the list of items whose data changed,
+    callers which relied on the post_save signal of RemoteArchive.save()
+    must handle them explicitly.
+    '''
+    objects = list(objects)
+    langs = [lang for lang, _name in settings.LANGUAGES]
+
+    targets = []  # (object, lang, url)
+    urls = {}  # url -> validators
+
+    for obj in objects:
+        data = obj.data or {}
+        stored = data.get(VALIDATORS_KEY) or {}
+
+        for lang in langs:
+            url = obj.get_url(lang)
+            targets.append((obj, lang, url))
+
+            # Only send a conditional request if every item and language
+            # sharing the URL already has the same version of the document
+            validators = stored.get(lang) if lang in data else None
+            if url not in urls:
+                urls[url] = validators
+            elif urls[url] != validators:
+                urls[url] = None
+
+    results = fetch_urls(urls, workers, session)
+
+    fetched = []
+    changed = []
+    pending = {}  # (model, pk) -> [data, changed]
+
+    for obj, lang, url in targets:
+        if url not in results:
+            continue
+
+        key = (type(obj), obj.pk)
+        if key not in pending:
+            pending[key] = [dict(obj.data or {}), False]
+            fetched.append(obj)
+
+        data, validators = results[url]
+        if data is None:
+            continue
+
+        entry = pending[key]
+        stored = dict(entry[0].get(VALIDATORS_KEY) or {})
+
+        if entry[0].get(lang) != data or stored.get(lang) != validators:
+            entry[0][lang] = data
+            if validators:
+                stored[lang] = validators
+            else:
+                stored.pop(lang, None)
+            entry[0][VALIDATORS_KEY] = stored
+            entry[1] = True
+
+    if not fetched:
+        return []
+
+    last_fetch = datetime.now()
+    by_model = defaultdict(lambda: ([], []))
+
+    for obj in fetched:
+        data, is_changed = pending[(type(obj), obj.pk)]
+        obj.last_fetch = last_fetch
+        by_model[type(obj)][0].append(obj)
+        if is_changed:
+            obj.data = data
+            by_model[type(obj)][1].append(obj)
+            changed.append(obj)
+
+    for model, (model_objects, model_changed) in by_model.items():
+        _bulk_update(model, model_objects, model_changed, last_fetch)
+
+    logger.info('Fetched %d URLs for %d remote archive items, %d changed',
+        len(results), len(fetched), len(changed))
+
+    return changed
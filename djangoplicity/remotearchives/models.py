@@ -29,20 +29,18 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE
 
-import logging
-import requests
-from datetime import datetime
-
 from django.conf import settings
 from django.contrib.postgres.fields import JSONField
 from django.db import models
 from django.utils.translation import ugettext as _
 
-logger = logging.getLogger(__name__)
+from djangoplicity.remotearchives.fetch import fetch_remote_archives
 
 
 class RemoteArchive(models.Model):
-    url = ''  # URL of the remote Archive JSON, {pk} is a placeholder for the archive PK
+    # URL of the remote Archive JSON, {pk} is a placeholder for the archive PK
+    # and {lang} for the language code
+    url = ''
     archive_title = None
     lang = None
 
@@ -70,36 +68,15 @@ class RemoteArchive(models.Model):
     def get_absolute_url(self):
         raise NotImplementedError('subclasses of RemoteArchive must provide a get_absolute_url() method')
 
-    def get_url(self):
-        return self.url.format(pk=self.pk)
+    def get_url(self, lang=None):
+        return self.url.format(pk=self.pk, lang=lang or settings.LANGUAGE_CODE)
 
     def fetch_data(self):
         '''
         Fetch and update the JSON data in each languages defined
+        (see djangoplicity.remotearchives.fetch)
         '''
-        url = self.get_url()
-        updated = False
-
-        if not self.data:
-            self.data = {}
-
-        for lang, _ in settings.LANGUAGES:
-            try:
-                r = requests.get(url, timeout=10)
-            except (requests.ConnectionError, requests.Timeout):
-                logger.warning('Could not fetch JSON "%s"', url)
-                continue
-
-            if r.status_code != requests.codes.ok:
-                logger.warning('Could not fetch JSON "%s", status: %s', url, r.status_code)
-                continue
-
-            self.data[lang] = r.json()
-            updated = True
-
-        if updated:
-            self.last_fetch = datetime.now()
-            self.save()
+        fetch_remote_archives([self])
 
     class Meta:
         abstract = True
@@ -34,6 +34,8 @@ from celery.utils.log import get_task_logger
 
 from django.apps import apps
 
+from djangoplicity.remotearchives.fetch import fetch_remote_archives
+
 logger = get_task_logger(__name__)
 
 
@@ -51,5 +53,5 @@ def fetch_remote_data(app_label, model_name, pks=None):
     if pks:
         qs = qs.filter(pk__in=pks)
 
-    for r in qs:
-        r.fetch_data()
+    changed = fetch_remote_archives(qs)
+    logger.info('Updated remote data for %d %s' % (len(changed), model_name))
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+#
+# djangoplicity-remotearchives
+# Copyright (c) 2007-2016, European Southern Observatory (ESO)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#
+#    * Neither the name of the European Southern Observatory nor the names
+#      of its contributors may be used to endorse or promote products derived
+#      from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY ESO ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL ESO BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE
+
+import json
+import threading
+from datetime import datetime
+
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from djangoplicity.remotearchives.fetch import VALIDATORS_KEY, \
+    _bulk_update, fetch_remote_archives, fetch_urls
+from test_project.models import RemoteTestArchive
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+try:
+    from mock import patch
+except ImportError:
+    from unittest.mock import patch
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    '''
+    Serves /<pk>.json with an ETag, /missing.json returns a 404
+    '''
+    def do_GET(self):
+        self.server.hits.append(self.path)
+
+        if self.path == '/missing.json':
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        etag = '"%s"' % self.path
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        body = json.dumps({'path': self.path}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeRemoteArchive(object):
+    def __init__(self, pk, url, data=None):
+        self.pk = pk
+        self.url = url
+        self.data = data
+        self.last_fetch = None
+
+    def get_url(self, lang=None):
+        return self.url.format(pk=self.pk, lang=lang)
+
+
+class StubServerMixin(object):
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.hits = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.base = 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FetchTestCase(StubServerMixin, SimpleTestCase):
+    def test_fetch_urls(self):
+        url = self.base + '/a.json'
+        missing = self.base + '/missing.json'
+
+        results = fetch_urls({url: None, missing: None}, workers=2)
+        self.assertEqual(list(results), [url])
+        data, validators = results[url]
+        self.assertEqual(data, {'path': '/a.json'})
+        self.assertEqual(validators, {'etag': '"/a.json"'})
+
+        # Not modified
+        self.assertEqual(fetch_urls({url: validators})[url], (None, validators))
+
+    @override_settings(LANGUAGES=(('en', 'English'), ('de', 'German'), ('fr', 'French')))
+    @patch('djangoplicity.remotearchives.fetch._bulk_update')
+    def test_fetch_remote_archives(self, bulk_update_mock):
+        objects = [FakeRemoteArchive(pk, self.base + '/{pk}.json') for pk in ('a', 'b')]
+
+        # One request per distinct URL, not per language
+        changed = fetch_remote_archives(objects, workers=2)
+        self.assertEqual(changed, objects)
+        self.assertEqual(sorted(self.server.hits), ['/a.json', '/b.json'])
+        self.assertEqual(objects[0].data['de'], {'path': '/a.json'})
+        self.assertEqual(objects[0].data[VALIDATORS_KEY]['fr'], {'etag': '"/a.json"'})
+        self.assertIsNotNone(objects[1].last_fetch)
+        self.assertEqual(bulk_update_mock.call_count, 1)
+
+        # Unchanged documents are not downloaded nor written again
+        del self.server.hits[:]
+        self.assertEqual(fetch_remote_archives(objects), [])
+        self.assertEqual(len(self.server.hits), 2)
+        _model, fetched, changed, _last_fetch = bulk_update_mock.call_args[0]
+        self.assertEqual(fetched, objects)
+        self.assertEqual(changed, [])
+
+
+class BulkUpdateTestCase(StubServerMixin, TestCase):
+    def setUp(self):
+        super(BulkUpdateTestCase, self).setUp()
+        self.a = RemoteTestArchive.objects.create(id='a', data={'en': {'title': 'Old'}})
+        self.b = RemoteTestArchive.objects.create(id='b')
+        self.c = RemoteTestArchive.objects.create(id='c', data={'en': {'title': 'Other'}})
+
+    def test_bulk_update(self):
+        last_fetch = datetime(2020, 1, 2, 3, 4, 5)
+        self.a.data = {'en': {'title': u'N\xe9bula', 'tags': [1, 2]}, VALIDATORS_KEY: {'en': {'etag': '"a"'}}}
+
+        with self.assertNumQueries(1):
+            _bulk_update(RemoteTestArchive, [self.a, self.b], [self.a], last_fetch)
+
+        a = RemoteTestArchive.objects.get(pk='a')
+        self.assertEqual(a.data, self.a.data)
+        self.assertEqual(a.last_fetch, last_fetch)
+
+        # Fetched but unchanged: only last_fetch is written
+        b = RemoteTestArchive.objects.get(pk='b')
+        self.assertIsNone(b.data)
+        self.assertEqual(b.last_fetch, last_fetch)
+
+        # Not fetched
+        c = RemoteTestArchive.objects.get(pk='c')
+        self.assertEqual(c.data, {'en': {'title': 'Other'}})
+        self.assertIsNone(c.last_fetch)
+
+    @override_settings(LANGUAGES=(('en', 'English'), ('de', 'German')))
+    def test_fetch_remote_archives(self):
+        objects = list(RemoteTestArchive.objects.filter(pk__in=['a', 'b']).order_by('pk'))
+        for obj in objects:
+            obj.url = self.base + '/{pk}.json'
+
+        changed = fetch_remote_archives(objects, workers=2)
+        self.assertEqual([o.pk for o in changed], ['a', 'b'])
+
+        a = RemoteTestArchive.objects.get(pk='a')
+        self.assertEqual(a.data['en'], {'path': '/a.json'})
+        self.assertEqual(a.data['de'], {'path': '/a.json'})
+        self.assertEqual(a.data[VALIDATORS_KEY]['de'], {'etag': '"/a.json"'})
+        self.assertIsNotNone(a.last_fetch)
+
+        # The stored validators are sent back from the database
+        del self.server.hits[:]
+        objects = list(RemoteTestArchive.objects.filter(pk__in=['a', 'b']))
+        for obj in objects:
+            obj.url = self.base + '/{pk}.json'
+        self.assertEqual(fetch_remote_archives(objects), [])
+        self.assertEqual(len(self.server.hits), 2)
@@ -37,6 +37,60 @@ from django.db.models.constants import LOOKUP_SEP
 from django.utils import translation
 
 
+# Kinds of lookups rewritten by TranslationQuerySet
+REWRITE_PK = 'pk'
+REWRITE_TRANSLATED = 'translated'
+
+# Strategies to rewrite lookups on translated relations:
+# * 'join' - Q(field__x=v) | Q(source__field__x=v), which OR's two chains of
+#   JOINs and prevents the database from using indexes.
+# * 'subquery' - the objects matching the lookup are selected in a subquery:
+#   Q(pk__in=matching) | Q(source__in=matching)
+STRATEGY_JOIN = 'join'
+STRATEGY_SUBQUERY = 'subquery'
+
+
+def get_lookup_rewrites( model ):
+    """
+    Returns a dictionary of field name -> kind of rewrite (REWRITE_PK or
+    REWRITE_TRANSLATED) for the lookups on the given translation model.
+    Fields which are not in the dictionary are directly accessible from
+    translation objects and are not rewritten.
+
+    The dictionary is computed once per model (relations to other models
+    are only known once all models are loaded).
+    """
+    rewrites = model.__dict__.get( '_translation_lookup_rewrites' )
+    if rewrites is not None:
+        return rewrites
+
+    # List of model fields directly accessible from Translation objects
+    direct_fields = set( model.Translation.fields + model.Translation.excludes + ['lang', 'source'] )
+    # Let's add the sacred trinity; we don't want to mess with those guys
+    direct_fields.update( ['published', 'release_date', 'embargo_date'] )
+
+    # If the query concerns the private key we also look in the
+    # source, to match e.g.: 'ann1401' and 'ann1401de'
+    rewrites = { 'pk': REWRITE_PK, model._meta.pk.name: REWRITE_PK }
+
+    for field in model._meta.get_fields():
+        if field.name in direct_fields or field.name in rewrites:
+            continue
+
+        # The field is not directly stored in the model (i.e.: it's a foreign
+        # key or many to many), so we check if the relation is a "Translation" one
+        try:
+            field_type = field.get_internal_type()
+        except AttributeError:
+            continue
+
+        if field_type.startswith( 'Translation' ):
+            rewrites[field.name] = REWRITE_TRANSLATED
+
+    model._translation_lookup_rewrites = rewrites
+    return rewrites
+
+
 class TranslationQuerySet( QuerySet ):
     """
     QuerySet that knows how to
@@ -51,20 +105,45 @@ class TranslationQuerySet( QuerySet ):
 
         super( TranslationQuerySet, self ).__init__( model, query, **kwargs )
 
+    def _translated_lookup( self, field, lookups ):
+        """
+        Returns the Q object for lookups on a translated relation, which is
+        not directly accessible from translation objects, so we access the one
+        from the source as well.
+
+        lookups is a list of (arg, parts, value) AND'ed together on the same
+        relation, which are kept together so that they match the same related
+        objects as in a single filter() call, e.g.:
+        filter(releaseimage__main_visual=True, releaseimage__archive_item=x)
+        """
+        strategy = getattr( settings, 'TRANSLATION_LOOKUP_STRATEGY', STRATEGY_SUBQUERY )
+        children = [( arg, value ) for ( arg, parts, value ) in lookups]
+
+        # Expressions (e.g. F('...')) refer to the outer query and can't be
+        # moved to a subquery
+        if strategy == STRATEGY_SUBQUERY and not any( hasattr( value, 'resolve_expression' ) for ( arg, value ) in children ):
+            # Plain QuerySet to include sources and translations and prevent
+            # the rewriting of the lookup
+            matching = QuerySet( self.model ).filter( Q( *children ) ).values( 'pk' )
+            return Q( pk__in=matching ) | Q( source__in=matching )
+
+        source_children = [( LOOKUP_SEP.join( ['source', field] + parts ), value ) for ( arg, parts, value ) in lookups]
+        return Q( *children ) | Q( *source_children )
+
     def _traverse_tree( self, q_object, negate=False ):
         """
         Helper function that traverse a Q tree object,
         replacing filter expression involving the primary key
         and other fields not present on the Translation object
         """
-
-        # List of model fields directly accessible from Translation objects
-        direct_fields = self.model.Translation.fields + self.model.Translation.excludes + ['lang', 'source']
-        # Let's add the sacred trinity; we don't want to mess with those guys
-        direct_fields += ['published', 'release_date', 'embargo_date']
+        rewrites = get_lookup_rewrites( self.model )
 
         new_children = []
 
+        # Lookups on translated relations, per relation, which are
+        # rewritten together if they are AND'ed
+        translated = {}
+
         # Iterate over children and generate a new list of children
         # - if a child contains a filter expression with the primary key
         #   it's replaced.
@@ -80,42 +159,27 @@ class TranslationQuerySet( QuerySet ):
                 if not parts:
                     raise FieldError("Cannot parse keyword query %r" % arg)
 
-                # Check if we're filter expression involves the primary key
                 field = parts.pop(0)
+                rewrite = rewrites.get( field )
 
                 # If it's a negated expression we bypass the inclusion of source__pk
-                if not negate:
-
-                    # If the query concerns the private key we also look in the
-                    # source, to match e.g.: 'ann1401' and 'ann1401de'
-                    if field == 'pk' or field == self.model._meta.pk.name:
-                        new_children.append( Q( **{ arg: value } ) | Q( **{ LOOKUP_SEP.join( ['source', 'pk'] + parts ): value } ) )
-                        continue
-
-                    if field not in direct_fields:
-                        # The field is not directly stored in the model (i.e.: it's a foreign
-                        # key or many to many), so we check if the relation is a "Translation" one
-
-                        field_type = ''
-                        # Get FieldType name
-                        try:
-                            field_type = self.model._meta.get_field(field).get_internal_type()
-                        except AttributeError:
-                            if hasattr(self.model, field + '_set'):
-                                field_type = getattr(self.model, field + '_set').related.field.get_internal_type()
-
-                        if field_type.startswith('Translation'):
-                            # Field is translated and not directly accessible so
-                            # we access the one from the source instead
-                            # Note: this (can) create massive SQL JOINs (at least as of
-                            # Django 1.5). Ideally this could be replaced by something
-                            # smarter, for example by using directly the source_pk in
-                            # the ForeignKey to remove an extra JOIN
-                            #  new_children.append( Q( **{ LOOKUP_SEP.join( ['source', field] + parts ): value } ) )
-                            new_children.append( Q( **{ arg: value } ) | Q( **{ LOOKUP_SEP.join( ['source', field] + parts ): value } ) )
-                            continue
-
-                new_children.append( child )
+                if not negate and rewrite == REWRITE_PK:
+                    new_children.append( Q( **{ arg: value } ) | Q( **{ LOOKUP_SEP.join( ['source', 'pk'] + parts ): value } ) )
+                elif not negate and rewrite == REWRITE_TRANSLATED:
+                    if q_object.connector != Q.AND:
+                        new_children.append( self._translated_lookup( field, [( arg, parts, value )] ) )
+                    elif field in translated:
+                        translated[field][1].append( ( arg, parts, value ) )
+                    else:
+                        # The lookup is set once all the lookups on the
+                        # relation are known
+                        translated[field] = ( len( new_children ), [( arg, parts, value )] )
+                        new_children.append( None )
+                else:
+                    new_children.append( child )
+
+        for field, ( index, lookups ) in translated.items():
+            new_children[index] = self._translated_lookup( field, lookups )
 
         q_object.children = new_children
         return q_object
@@ -3,11 +3,14 @@ from datetime import datetime
 
 from django.conf import settings
 from django.db.models import Q
+from django.test import override_settings
 
 from djangoplicity.media.models import Image
 from djangoplicity.metadata.models import TaggingStatus
 from djangoplicity.releases.models import Release, ReleaseType, \
     ReleaseContact, ReleaseTranslationContact, ReleaseImage
+from djangoplicity.translation.query import get_lookup_rewrites, \
+    REWRITE_PK, REWRITE_TRANSLATED, STRATEGY_JOIN, STRATEGY_SUBQUERY
 
 
 # To run:
@@ -422,6 +425,65 @@ def test_filter_api():
     assert list(Release.objects.language('da').filter(pk__icontains='eso150').order_by('pk')) == [t1_da, t2_da]
 
 
+@pytest.mark.django_db
+def test_translated_lookup_strategies():
+    t = typ()
+    other = ReleaseType(name='Other type')
+    other.save()
+
+    # Setup
+    t1 = Release(release_type=t, title='Release 1', id='eso1501')
+    t2 = Release(release_type=other, title='Release 2', id='eso1502')
+    t1_da = Release(title='Release 1da', source=t1, lang='da', id='eso1501da')
+    t2_da = Release(title='Release 2da', source=t2, lang='da', id='eso1502da')
+    _ = [x.save() for x in [t1, t2, t1_da, t2_da]]
+
+    assert get_lookup_rewrites(Release)['release_type'] == REWRITE_TRANSLATED
+    assert get_lookup_rewrites(Release)['id'] == REWRITE_PK
+    assert 'title' not in get_lookup_rewrites(Release)
+
+    for strategy in (STRATEGY_JOIN, STRATEGY_SUBQUERY):
+        with override_settings(TRANSLATION_LOOKUP_STRATEGY=strategy):
+            qs = Release.objects.language('da').filter(release_type__name='Other type')
+            assert list(qs) == [t2_da]
+            assert list(Release.objects.filter(release_type=t)) == [t1]
+
+    # The translated relation is looked up in a subquery instead of being joined
+    qs = Release.objects.language('da').filter(release_type__name='Other type')
+    assert 'IN (SELECT' in str(qs.query)
+
+
+@pytest.mark.django_db
+def test_translated_lookup_same_related_object():
+    t = typ()
+
+    # Setup
+    t1 = Release(release_type=t, title='Release 1', id='eso1501')
+    t1_da = Release(title='Release 1da', source=t1, lang='da', id='eso1501da')
+    i1 = Image(title='Image 1', priority=10, pk='eso1501a')
+    i2 = Image(title='Image 2', priority=10, pk='eso1501b')
+    _ = [x.save() for x in [t1, t1_da, i1, i2]]
+
+    ReleaseImage(archive_item=i1, release=t1, main_visual=True).save()
+    ReleaseImage(archive_item=i2, release=t1, main_visual=False).save()
+
+    for strategy in (STRATEGY_JOIN, STRATEGY_SUBQUERY):
+        with override_settings(TRANSLATION_LOOKUP_STRATEGY=strategy):
+            # The lookups of a filter() call on a multi-valued relation
+            # must match the same related object
+            assert list(Release.objects.filter(releaseimage__main_visual=True, releaseimage__archive_item=i1)) == [t1]
+            assert list(Release.objects.filter(releaseimage__main_visual=True, releaseimage__archive_item=i2)) == []
+            assert list(Release.objects.language('da').filter(releaseimage__main_visual=True, releaseimage__archive_item=i1)) == [t1_da]
+            assert list(Release.objects.language('da').filter(releaseimage__main_visual=True, releaseimage__archive_item=i2)) == []
+
+            # Separate filter() calls can match different related objects
+            qs = Release.objects.filter(releaseimage__main_visual=True).filter(releaseimage__archive_item=i2)
+            assert list(qs) == [t1]
+
+    # A single subquery for both lookups
+    qs = Release.objects.filter(releaseimage__main_visual=True, releaseimage__archive_item=i1)
+    assert str(qs.query).count('IN (SELECT') == 2
+
 @pytest.mark.django_db
 def test_non_en_source():
     t = typ()
@@ -0,0 +1,60 @@
+# Djangoplicity
+# Copyright 2007-2008 ESA/Hubble
+#
+# Authors:
+#   Lars Holm Nielsen <lnielsen@eso.org>
+#   Luis Clara Gomes <lcgomes@eso.org>
+#
+
+"""
+Helpers to derive cache keys for views from the requested path.
+
+Keys must not be built with Python's hash() as its value differs between
+interpreter builds and between processes when hash randomization is enabled,
+which prevents workers from sharing cache entries and can lead to collisions.
+"""
+
+import hashlib
+
+from django.utils.encoding import force_bytes
+from django.utils.http import urlunquote
+
+
+def normalize_path( path ):
+    """
+    Normalize a path so that e.g. '/a%20b/' and u'/a b/' give the same key
+    """
+    return force_bytes( urlunquote( path ) )
+
+
+def digest( *values ):
+    """
+    Returns a stable hexadecimal digest of the given values
+    """
+    return hashlib.sha1( b'\0'.join( [force_bytes( v ) for v in values] ) ).hexdigest()
+
+
+def make_cache_key( prefix, path, lang=None, internal=None, params=None ):
+    """
+    Returns a cache key for the page at 'path' which is stable across
+    processes and hosts.
+
+    * lang - language of the page if it depends on the active language
+    * internal - True/False if the page differs for internal/external requests
+    * params - dictionary (or list of pairs) of GET parameters the page
+      depends on. Other GET parameters must be dropped by the caller.
+    """
+    parts = [normalize_path( path ), lang or '']
+
+    if internal is not None:
+        parts.append( 'internal' if internal else 'external' )
+    else:
+        parts.append( '' )
+
+    if params:
+        if hasattr( params, 'items' ):
+            params = params.items()
+        for k, v in sorted( params ):
+            parts.append( force_bytes( k ) + b'=' + force_bytes( v ) )
+
+    return '%s%s' % ( prefix, digest( *parts ) )
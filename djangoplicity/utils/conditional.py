@@ -0,0 +1,95 @@
+# Djangoplicity
+# Copyright 2007-2008 ESA/Hubble
+#
+# Authors:
+#   Lars Holm Nielsen <lnielsen@eso.org>
+#   Luis Clara Gomes <lcgomes@eso.org>
+#
+
+"""
+Helpers for conditional GET requests (ETag/Last-Modified validators).
+
+Views compute the validators from values which are cheap to get (cache keys,
+cache generations, cache record versions, last modification dates) before
+running any query or rendering any template, and answer with 304 Not
+Modified if the client already has the current version::
+
+    etag = make_etag( key, version )
+    response = not_modified( request, etag, last_modified )
+    if response is not None:
+        return response
+    ...
+    return set_validators( HttpResponse( html ), etag, last_modified )
+"""
+
+import calendar
+import time
+
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
+
+from djangoplicity.utils.cachekeys import digest
+
+
+def make_etag( *values ):
+    """
+    Returns a (quoted) ETag for the given values
+    """
+    return '"%s"' % digest( *values )
+
+
+def _timestamp( dt ):
+    """
+    Returns the datetime as a POSIX timestamp
+    """
+    if timezone.is_aware( dt ):
+        return calendar.timegm( dt.utctimetuple() )
+    return int( time.mktime( dt.timetuple() ) )
+
+
+# Request headers the pages depend on besides the URL: the user (admin
+# links, permissions) and the preferred language cookie. The language is
+# otherwise given by the URL prefix, not negotiated from Accept-Language
+# (see djangoplicity.translation.middleware), so varying on it would only
+# split the caches per browser language.
+VARY_HEADERS = ( 'Cookie', )
+
+
+def _add_validators( response, etag, last_modified ):
+    if etag:
+        response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date( _timestamp( last_modified ) )
+    patch_vary_headers( response, VARY_HEADERS )
+    return response
+
+
+def set_validators( response, etag=None, last_modified=None ):
+    """
+    Add the ETag, Last-Modified and Vary headers to a successful response
+    """
+    if response.status_code != 200 or ( etag is None and last_modified is None ):
+        return response
+    return _add_validators( response, etag, last_modified )
+
+
+def not_modified( request, etag=None, last_modified=None ):
+    """
+    Returns a 304 Not Modified response (with the validators) if the
+    client's copy matches the ETag/Last-Modified date, otherwise None.
+    """
+    if request.method not in ( 'GET', 'HEAD' ) or ( etag is None and last_modified is None ):
+        return None
+
+    response = get_conditional_response(
+        request,
+        etag=etag,
+        last_modified=_timestamp( last_modified ) if last_modified else None
+    )
+
+    if response is None or response.status_code != 304:
+        return None
+
+    # The 304 response must carry the same validators as the full response
+    return _add_validators( response, etag, last_modified )
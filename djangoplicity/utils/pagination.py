@@ -6,9 +6,17 @@
 #   Luis Clara Gomes <lcgomes@eso.org>
 #
 
+from math import ceil
+
 from django.urls import reverse
 from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet, FieldDoesNotExist
 from django.core.paginator import Paginator as corePaginator, QuerySetPaginator as coreQSetPaginator
+from django.db.models import Q
+from django.utils.functional import cached_property
+
+from djangoplicity.utils.cachekeys import digest
 
 
 def _adj_range(adjacent_pages, page_obj, page_range):
@@ -49,6 +57,203 @@ class DjangoplicityPaginator (corePaginator):
         return _adj_range(self.adjacent_pages, page_obj, self.page_range)
 
 
+def get_keyset_ordering(qs):
+    """
+    Returns the ordering of the queryset as a list of (attname, descending,
+    nullable) tuples, with the primary key appended to make it unique.
+    Returns None if the ordering can't be used for keyset pagination (e.g.
+    ordering on related fields or expressions).
+    """
+    if not hasattr(qs, 'query'):
+        return None
+
+    order = list(qs.query.order_by)
+    if not order and qs.query.default_ordering:
+        order = list(qs.model._meta.ordering)
+
+    opts = qs.model._meta
+    ordering = []
+    for o in order:
+        if not isinstance(o, basestring) or '__' in o or o.lstrip('-') in ('', '?'):
+            return None
+
+        name = o.lstrip('-')
+        try:
+            field = opts.pk if name == 'pk' else opts.get_field(name)
+        except FieldDoesNotExist:
+            return None
+
+        if not field.concrete:
+            return None
+
+        ordering.append((field.attname, o.startswith('-'), field.null))
+
+    if opts.pk.attname not in [o[0] for o in ordering]:
+        ordering.append((opts.pk.attname, ordering[-1][1] if ordering else False, False))
+
+    return ordering
+
+
+def _keyset_after_q(name, desc, value):
+    """
+    Returns a Q object for the values of field 'name' strictly after
+    'value' in the given direction, or None if there can't be any. NULLs are
+    considered larger than any other value (as in PostgreSQL).
+    """
+    if value is None:
+        return Q(**{'%s__isnull' % name: False}) if desc else None
+    if desc:
+        return Q(**{'%s__lt' % name: value})
+    return Q(**{'%s__gt' % name: value}) | Q(**{'%s__isnull' % name: True})
+
+
+def keyset_q(ordering, values):
+    """
+    Returns a Q object selecting the rows located after the row with the
+    given values in the given ordering (as returned by get_keyset_ordering),
+    e.g. for ordering (-release_date, -id)::
+
+        release_date < v1 OR (release_date = v1 AND id < v2)
+    """
+    q = None
+    for i, (name, desc, _null) in enumerate(ordering):
+        clause = _keyset_after_q(name, desc, values[i])
+        if clause is None:
+            continue
+
+        for (prev_name, _desc, _null), prev_value in zip(ordering[:i], values[:i]):
+            if prev_value is None:
+                clause &= Q(**{'%s__isnull' % prev_name: True})
+            else:
+                clause &= Q(**{prev_name: prev_value})
+
+        q = clause if q is None else q | clause
+
+    # The boundary is the last row
+    return q if q is not None else Q(pk__in=[])
+
+
+def cached_count(qs, cache_key_prefix, timeout=300, cache_key=None):
+    """
+    Returns qs.count(), cached for timeout seconds under a key derived from
+    cache_key_prefix and cache_key.
+
+    cache_key must identify the query (e.g. the name of the archive query
+    and the request parameters it depends on). If it is not given the SQL
+    of the query is used instead, which only works for queries which don't
+    depend on the current time (e.g. the archive queries filtering on the
+    release date can't use it as their SQL changes on each request).
+    """
+    if cache_key is None:
+        try:
+            cache_key = digest(qs.query)
+        except EmptyResultSet:
+            return 0
+
+    key = '%s_count_%s' % (cache_key_prefix, cache_key)
+
+    count = cache.get(key)
+    if count is None:
+        count = qs.count()
+        cache.set(key, count, timeout)
+
+    return count
+
+
+class KeysetPaginator(DjangoplicityPaginator):
+    """
+    Paginator for querysets which avoids scanning the whole table for deep
+    pages:
+
+    * The total count is cached.
+    * The ordering keys of the last object of each page are cached, so the
+      next page is fetched by seeking from these keys instead of using an
+      OFFSET (e.g. crawlers following the "next" links).
+    * Otherwise pages in the second half are fetched with the reverse
+      ordering, so e.g. the last page costs the same as the first one.
+
+    cache_key_prefix must change when the data changes, e.g. by including
+    the archive's cache generation. cache_key identifies the query (see
+    cached_count), the ordering and page size are added to it.
+
+    If the ordering of the queryset can't be used (see get_keyset_ordering)
+    it behaves like DjangoplicityPaginator except for the cached count.
+    """
+    def __init__(self, object_list, per_page, cache_key_prefix='', cache_timeout=300, cache_key=None, **kwargs):
+        super(KeysetPaginator, self).__init__(object_list, per_page, **kwargs)
+        self.cache_timeout = cache_timeout
+        self.keyset_ordering = get_keyset_ordering(object_list)
+
+        if self.keyset_ordering:
+            # Make the ordering explicit and unique
+            self.object_list = object_list.order_by(*[
+                '%s%s' % ('-' if desc else '', name) for (name, desc, _null) in self.keyset_ordering
+            ])
+
+        self.cache_key_prefix = None
+        self.cache_key = None
+        if hasattr(self.object_list, 'query'):
+            if cache_key is None:
+                try:
+                    cache_key = digest(self.object_list.query)
+                except EmptyResultSet:
+                    cache_key = None
+            else:
+                cache_key = digest(cache_key, *self.object_list.query.order_by)
+
+            if cache_key is not None:
+                self.cache_key = cache_key
+                self.cache_key_prefix = '%s_%s' % (cache_key_prefix, digest(cache_key, per_page))
+
+    @cached_property
+    def count(self):
+        if self.cache_key_prefix is None:
+            return super(KeysetPaginator, self).count
+        return cached_count(self.object_list, self.cache_key_prefix, self.cache_timeout, self.cache_key)
+
+    def _boundary_key(self, number):
+        return '%s_boundary_%s' % (self.cache_key_prefix, number)
+
+    def page(self, number):
+        number = self.validate_number(number)
+
+        if not self.keyset_ordering or self.cache_key_prefix is None:
+            return super(KeysetPaginator, self).page(number)
+
+        bottom = (number - 1) * self.per_page
+        top = bottom + self.per_page
+        if top + self.orphans >= self.count:
+            top = self.count
+        size = top - bottom
+
+        boundary = cache.get(self._boundary_key(number - 1)) if number > 1 else None
+
+        if boundary is not None:
+            # Seek from the last object of the previous page. The condition
+            # is added with add_q() so that querysets rewriting filter()
+            # arguments (e.g. TranslationQuerySet) leave it untouched.
+            qs = self.object_list.all()
+            qs.query.add_q(keyset_q(self.keyset_ordering, boundary))
+            object_list = list(qs[:size])
+        elif number > ceil(self.num_pages / 2.0):
+            # Fetch from the end of the list
+            end = self.count - top
+            object_list = list(self.object_list.reverse()[end:end + size])
+            object_list.reverse()
+        else:
+            object_list = list(self.object_list[bottom:top])
+
+        if object_list:
+            last = object_list[-1]
+            cache.set(
+                self._boundary_key(number),
+                [getattr(last, name) for (name, _desc, _null) in self.keyset_ordering],
+                self.cache_timeout
+            )
+
+        return self._get_page(object_list, number, self)
+
+
 class DjangoplicityQuerySetPaginator (coreQSetPaginator):
     def __init__(self, *args, **kwargs):
         self.adjacent_pages = kwargs.get("adjacent_pages", None)
@@ -7,8 +7,15 @@
 #
 
 from djangoplicity.utils import datetimes
+from djangoplicity.utils.cachekeys import make_cache_key
+from djangoplicity.utils.conditional import make_etag, not_modified, set_validators
+from djangoplicity.utils.pagination import KeysetPaginator, get_keyset_ordering
+from django.core.cache import cache
 from datetime import datetime
-from django.test import TestCase
+from django.http import HttpResponse
+from django.db import connection
+from django.test import RequestFactory, TestCase
+from django.test.utils import CaptureQueriesContext
 from django.conf import settings
 
 class TestDatetimes(TestCase):
@@ -136,3 +143,85 @@ class UtilsTestCase(TestCase):
         self.assertRaises(AttributeError,history.add_admin_history, AnInstance(), "mmm")
 
 
+class TestCacheKeys(TestCase):
+    def test_make_cache_key(self):
+        """ test cache keys are stable and depend on all given parameters """
+        key = make_cache_key('prefix_', '/images/', lang='en', internal=False)
+        self.assertEqual(key, 'prefix_0d2a712835ad0e91f2bedf0c0116c6a8a235ca82')
+
+        self.assertEqual(key, make_cache_key('prefix_', u'/images/', lang='en', internal=False))
+        self.assertEqual(make_cache_key('p', '/a%20b/'), make_cache_key('p', u'/a b/'))
+        self.assertNotEqual(key, make_cache_key('prefix_', '/images/', lang='en', internal=True))
+        self.assertNotEqual(key, make_cache_key('prefix_', '/images/', lang='es', internal=False))
+        self.assertNotEqual(key, make_cache_key('prefix_', '/images/', lang='en', internal=False, params={'sort': 'title'}))
+        self.assertEqual(
+            make_cache_key('p', '/', params={'a': '1', 'b': '2'}),
+            make_cache_key('p', '/', params=[('b', '2'), ('a', '1')])
+        )
+
+
+class TestConditional(TestCase):
+    def test_not_modified(self):
+        """ 304 responses are only returned if the client has the current version """
+        factory = RequestFactory()
+        etag = make_etag('key', 1)
+        modified = datetime(2017, 3, 1, 12, 0)
+
+        self.assertIsNone(not_modified(factory.get('/'), etag, modified))
+        self.assertIsNone(not_modified(factory.get('/', HTTP_IF_NONE_MATCH=make_etag('key', 2)), etag, modified))
+        self.assertIsNone(not_modified(factory.post('/', HTTP_IF_NONE_MATCH=etag), etag, modified))
+
+        response = not_modified(factory.get('/', HTTP_IF_NONE_MATCH=etag), etag, modified)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertIn('Cookie', response['Vary'])
+
+        # The language is in the URL
+        with self.settings(USE_I18N=True):
+            response = set_validators(HttpResponse('page'), etag, modified)
+        self.assertNotIn('Accept-Language', response['Vary'])
+
+        response = set_validators(HttpResponse('page'), etag, modified)
+        response = not_modified(factory.get('/', HTTP_IF_MODIFIED_SINCE=response['Last-Modified']), None, modified)
+        self.assertEqual(response.status_code, 304)
+
+
+class TestKeysetPaginator(TestCase):
+    fixtures = ['media']
+
+    def setUp(self):
+        from djangoplicity.media.models import Image
+        self.qs = Image.objects.order_by('-release_date')
+        self.expected = [i.pk for i in self.qs.order_by('-release_date', '-id')]
+        cache.clear()
+
+    def test_keyset_ordering(self):
+        self.assertEqual(get_keyset_ordering(self.qs), [('release_date', True, True), ('id', True, False)])
+        self.assertIsNone(get_keyset_ordering(self.qs.order_by('source__title')))
+
+    def test_sequential_pages(self):
+        """ pages fetched by seeking from the previous page match the offset pages """
+        for number, pk in enumerate(self.expected, 1):
+            paginator = KeysetPaginator(self.qs, per_page=1, cache_key_prefix='test')
+            self.assertEqual(paginator.count, len(self.expected))
+            self.assertEqual([i.pk for i in paginator.page(number).object_list], [pk])
+
+    def test_cache_key(self):
+        """ counts are cached for queries whose SQL contains the current time """
+        from djangoplicity.media.models import Image
+        from djangoplicity.media.options import ImageOptions
+
+        def count_queries():
+            qs = ImageOptions.Queries.default.queryset(Image, ImageOptions, None)[0].order_by('-release_date')
+            paginator = KeysetPaginator(qs, per_page=1, cache_key_prefix='test', cache_key='default')
+            with CaptureQueriesContext(connection) as ctx:
+                paginator.page(1)
+            return len([q for q in ctx.captured_queries if 'COUNT(' in q['sql'].upper()])
+
+        self.assertEqual(count_queries(), 1)
+        self.assertEqual(count_queries(), 0)
+
+    def test_last_page(self):
+        """ last pages are fetched with the reverse ordering """
+        paginator = KeysetPaginator(self.qs, per_page=2, cache_key_prefix='test')
+        self.assertEqual([i.pk for i in paginator.page(paginator.num_pages).object_list], self.expected[2:])
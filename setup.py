@@ -28,6 +28,7 @@ setup(
         'icalendar == 2.1',
         'ipython == 5.5.0',  # Last version compatible with python 2.7
         'Pillow',
+        'numpy < 1.17',  # Used for image colours
         'pycountry == 1.16',
         'ephem == 3.7.6.0',
         'pysftp',               # Used for contentserver
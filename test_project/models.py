@@ -0,0 +1,11 @@
+from djangoplicity.remotearchives.models import RemoteArchive
+
+
+class RemoteTestArchive(RemoteArchive):
+    '''
+    Concrete remote archive used by the djangoplicity.remotearchives tests
+    '''
+    url = 'http://localhost/{pk}.json'
+
+    def get_absolute_url(self):
+        return '/remote/%s/' % self.pk